@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, unicode_literals, print_function)
 
+import os
+import re
+import sys
+import logging
+
 
 # Once a submodule has been imported, its name will be stored here.
 name = None
@@ -21,5 +26,21 @@ class AutoEncoderBackend(object):
 # Automatically import the recommended backend if none was manually imported.
 def setup():
     if name == None:
-        from . import lasagne 
+        try:
+            from . import lasagne
+        except ImportError as e:
+            logging.getLogger('sknn').warning("Lasagne backend unavailable (%s), using NumPy backend instead." % e)
+            from . import numpy
     assert name is not None, "No backend for module sknn was imported."
+
+
+# The data type used for arrays, shared by all backends so it can be set in one place.
+def floatX():
+    """Floating-point type of the training and prediction arrays: Theano's `floatX` once it
+    was imported, otherwise the one requested via `THEANO_FLAGS` (e.g. by `sknn.platform`).
+    """
+    if 'theano' in sys.modules:
+        return sys.modules['theano'].config.floatX
+    match = re.search(r'floatX=(\w+)', os.environ.get('THEANO_FLAGS', ''))
+    return match.group(1) if match else 'float64'
+
@@ -1,5 +1,17 @@
 # -*- coding: utf-8 -*-
-from __future__ import (absolute_import, unicode_literals, print_function)
+from __future__ import (absolute_import, division, unicode_literals, print_function)
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+
+from . import floatX
 
 
 class BaseBackend(object):
@@ -10,7 +22,7 @@ class BaseBackend(object):
 
     def __init__(self, spec):
         self.spec = spec
-    
+
     def __getattr__(self, key):
         return getattr(self.spec, key)
 
@@ -19,3 +31,115 @@ class BaseBackend(object):
             self.spec.__setattr__(key, value)
         else:
             super(BaseBackend, self).__setattr__(key, value)
+
+    def _iterate_data(self, batch_size, X, y=None, w=None, shuffle=False):
+        dtype = floatX()
+
+        def cast(array, indices):
+            if array is None:
+                return None
+
+            # Support for pandas.DataFrame, requires custom indexing by position.  Its
+            # values are used from here on, so the batches are plain arrays for every backend.
+            if type(array).__name__ == 'DataFrame':
+                array = array.iloc[indices].values
+            else:
+                array = array[indices]
+
+                # Support for scipy.sparse; convert after slicing, to an array rather than
+                # a `numpy.matrix` so that products stay elementwise.
+                if hasattr(array, 'toarray'):
+                    array = array.toarray()
+
+            return array.astype(dtype)
+
+        def batches(indices):
+            for index in range(0, total_size, batch_size):
+                excerpt = indices[index:index + batch_size]
+                Xb, yb, wb = cast(X, excerpt), cast(y, excerpt), cast(w, excerpt)
+                yield Xb, yb, wb, excerpt
+
+        # Shuffle straight away, so the random sequence does not depend on when batches are read.
+        total_size = X.shape[0]
+        indices = numpy.arange(total_size)
+        if shuffle:
+            numpy.random.shuffle(indices)
+        return batches(indices)
+
+    def _prefetch(self, iterator, size):
+        """Runs the batch iterator on a background thread, keeping up to `size` batches
+        ready in a bounded queue while the current one is processed.
+        """
+        done, stop = object(), threading.Event()
+        batches = queue.Queue(maxsize=size)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def work():
+            try:
+                for item in iterator:
+                    put(item)
+                    if stop.is_set():
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def _print(self, text):
+        if self.verbose:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def _has_batch_callbacks(self):
+        if self.callback is None:
+            return False
+        if isinstance(self.callback, dict):
+            return any(e in self.callback for e in ('on_batch_start', 'on_batch_finish'))
+        return True
+
+    def _batch_impl(self, X, y, w, processor, mode, output, shuffle):
+        progress, batches = 0, X.shape[0] / self.batch_size
+        loss, count = 0.0, 0
+        iterator = self._iterate_data(self.batch_size, X, y, w, shuffle)
+        if self.prefetch:
+            iterator = self._prefetch(iterator, self.prefetch)
+        for Xb, yb, wb, _ in iterator:
+            self._do_callback('on_batch_start', locals())
+
+            if mode == 'train':
+                loss += processor(Xb, yb, wb if wb is not None else 1.0)
+            elif mode == 'train_obj':
+                loss += processor(Xb, yb)
+            else:
+                loss += processor(Xb, yb)
+            count += 1
+
+            while count / batches > progress / 60:
+                self._print(output)
+                progress += 1
+
+            self._do_callback('on_batch_finish', locals())
+
+        self._print('\r')
+        return loss / count
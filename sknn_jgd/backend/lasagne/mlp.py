@@ -8,8 +8,11 @@ import sys
 import math
 import time
 import types
+import hashlib
 import logging
+import weakref
 import itertools
+import collections
 
 log = logging.getLogger('sknn')
 
@@ -33,6 +36,90 @@ def explin(x):
     return x * (x>=0) + (x<0) * (T.exp(x) - 1)
 
 
+# Networks with their compiled functions, most recently used last, so that a new network
+# with the same architecture reuses them instead of compiling again.  The parameters are
+# shared variables, and are overwritten with the new network's values.  Each entry also
+# keeps its trainers for the last few training settings, most recently used last.
+GRAPH_CACHE_SIZE = 4
+TRAINER_CACHE_SIZE = 4
+_graphs = collections.OrderedDict()
+
+# Training data uploaded to Theano shared variables for each pass of an epoch, shared by all
+# networks in the process so it is only kept once however many networks are trained on it,
+# and the order of the rows processed by each pass.
+_uploads = {}
+_indices = {}
+
+# Number of rows hashed to notice when the uploaded arrays were changed in place.
+FINGERPRINT_ROWS = 1024
+
+
+def _fingerprint(array):
+    """Shape, type and strides of an array and a hash of up to `FINGERPRINT_ROWS` of its rows,
+    spread evenly, which is cheap compared to a pass over the data.
+    """
+    if array is None:
+        return None
+    n = array.shape[0]
+    rows = numpy.unique(numpy.linspace(0, n - 1, min(n, FINGERPRINT_ROWS)).astype('int64'))
+    sample = numpy.ascontiguousarray(array[rows])
+    return (array.shape, array.dtype.str, array.strides, hashlib.sha1(sample.tobytes()).hexdigest())
+
+
+def _uploaded(mode, *arrays):
+    """Check if the arrays last uploaded for the pass `mode` start with these ones, and were
+    not changed in place since.
+    """
+    upload = _uploads.get((mode, theano.config.floatX))
+    if upload is None:
+        return False
+    return all((r() if r is not None else None) is a and f == _fingerprint(a)
+               for r, f, a in zip(upload['source'], upload['fingerprint'], arrays))
+
+
+def _upload(mode, X, y, w):
+    """Training arrays cast to `floatX` once and kept in the Theano shared variables of the
+    pass `mode`.  The arrays are only uploaded again if different arrays are passed in, or
+    if they were changed in place.  Those uploaded are tracked by weak reference, so the
+    caller's arrays can still be freed once training is done.
+    """
+    def cast(array):
+        return numpy.array(array, dtype=theano.config.floatX, copy=True)
+
+    arrays = (X, y, w)
+    if _uploaded(mode, *arrays):
+        return _uploads[(mode, theano.config.floatX)]
+    upload = _uploads.get((mode, theano.config.floatX))
+
+    # Without sample weights `w` is left empty, as the functions then don't read it.
+    w = w if w is not None else numpy.zeros((0,))
+    if upload is None:
+        upload = _uploads[(mode, theano.config.floatX)] = {
+            'X': theano.shared(cast(X), borrow=True),
+            'y': theano.shared(cast(y), borrow=True),
+            'w': theano.shared(cast(w), borrow=True)}
+    else:
+        upload['X'].set_value(cast(X), borrow=True)
+        upload['y'].set_value(cast(y), borrow=True)
+        upload['w'].set_value(cast(w), borrow=True)
+
+    upload['source'] = tuple(weakref.ref(a) if a is not None else None for a in arrays)
+    upload['fingerprint'] = tuple(_fingerprint(a) for a in arrays)
+    return upload
+
+
+def _release(mode):
+    """Empty the shared variables of the pass `mode`, which are kept for the functions
+    compiled to read them.
+    """
+    upload = _uploads.get((mode, theano.config.floatX))
+    if upload is None or upload['source'] == (None, None, None):
+        return
+    for v in (upload['X'], upload['y'], upload['w']):
+        v.set_value(numpy.zeros((0,) * v.ndim, dtype=theano.config.floatX), borrow=True)
+    upload['source'] = upload['fingerprint'] = (None, None, None)
+
+
 class MultiLayerPerceptronBackend(BaseBackend):
     """
     Abstract base class for wrapping the multi-layer perceptron functionality
@@ -46,6 +133,11 @@ class MultiLayerPerceptronBackend(BaseBackend):
         self.trainer = None
         self.validator = None
         self.regularizer = None
+        self._learning_rule = None
+        self._slots = {}
+        self._compiled = None
+        self._graph = None
+        self._stash = None
 
     def _create_mlp_trainer(self, params):
         # Aggregate all regularization parameters into common dictionaries.
@@ -56,14 +148,8 @@ class MultiLayerPerceptronBackend(BaseBackend):
                 layer_decay[l.name] = l.weight_decay or wd
         assert len(layer_decay) == 0 or self.regularize in ('L1', 'L2', None)
 
-        if len(layer_decay) > 0:
-            if self.regularize is None:
-                self.auto_enabled['regularize'] = 'L2'
-            regularize = self.regularize or 'L2'
-            penalty = getattr(lasagne.regularization, regularize.lower())
-            apply_regularize = lasagne.regularization.apply_penalty
-            self.regularizer = sum(layer_decay[s.name] * apply_regularize(l.get_params(regularizable=True), penalty)
-                                   for s, l in zip(self.layers, self.mlp))
+        if len(layer_decay) > 0 and self.regularize is None:
+            self.auto_enabled['regularize'] = 'L2'
 
         if self.normalize is None and any([l.normalize != None for l in self.layers]):
             self.auto_enabled['normalize'] = 'batch'
@@ -73,12 +159,50 @@ class MultiLayerPerceptronBackend(BaseBackend):
         assert loss_type in cost_functions,\
                     "Loss type `%s` not supported by Lasagne backend." % loss_type
         self.cost_function = getattr(lasagne.objectives, cost_functions[loss_type])
-        cost_symbol = self.cost_function(self.trainer_output, self.data_output)
+
+        # The trainers compiled for this network so far, one for each setting they depend on.
+        key = repr((sorted(layer_decay.items()), self.regularize, loss_type, self.data_mask.ndim,
+                    self.learning_rule, self.learning_rate, self.learning_momentum))
+        trainers = self._graph['trainers']
+        compiled = trainers.pop(key, None)
+        if compiled is not None:
+            trainers[key] = compiled
+            log.debug("Reusing the compiled trainer of a previous network.")
+            self.data_output, self.data_mask, self.data_correct = compiled['symbols']
+            self.regularizer, self._learning_rule = compiled['regularizer'], compiled['updates']
+            self._cost, self._compare, self._slots = compiled['cost'], compiled['compare'], {}
+            self._compiled = compiled
+
+            # Start the learning rule from scratch, e.g. with zero momentum velocities.
+            trained = set(id(p) for p in params)
+            for v in self._learning_rule.keys():
+                if id(v) not in trained:
+                    v.set_value(numpy.zeros_like(v.get_value(borrow=True)))
+            return compiled['trainer'], compiled['validator']
+
+        if len(layer_decay) > 0:
+            regularize = self.regularize or 'L2'
+            penalty = getattr(lasagne.regularization, regularize.lower())
+            apply_regularize = lasagne.regularization.apply_penalty
+            self.regularizer = sum(layer_decay[s.name] * apply_regularize(l.get_params(regularizable=True), penalty)
+                                   for s, l in zip(self.layers, self.mlp))
+
+        trainer_output = lasagne.layers.get_output(self.mlp[-1], deterministic=False)
+        cost_symbol = self.cost_function(trainer_output, self.data_output)
         cost_symbol = lasagne.objectives.aggregate(cost_symbol.T, self.data_mask, mode='mean')
 
         if self.regularizer is not None:
             cost_symbol = cost_symbol + self.regularizer
-        return self._create_trainer_function(params, cost_symbol)
+        trainer, validator = self._create_trainer_function(params, cost_symbol)
+
+        self._compiled = trainers[key] = {
+            'symbols': (self.data_output, self.data_mask, self.data_correct),
+            'regularizer': self.regularizer, 'updates': self._learning_rule,
+            'cost': self._cost, 'compare': self._compare, 'functions': {},
+            'trainer': trainer, 'validator': validator}
+        while len(trainers) > TRAINER_CACHE_SIZE:
+            trainers.popitem(last=False)
+        return trainer, validator
 
     def _create_trainer_function(self, params, cost):
         if self.learning_rule in ('sgd', 'adagrad', 'adadelta', 'rmsprop', 'adam'):
@@ -100,6 +224,10 @@ class MultiLayerPerceptronBackend(BaseBackend):
         compare = self.cost_function(self.network_output, self.data_correct).mean()
         validator = theano.function([self.data_input, self.data_correct], compare,
                                     allow_input_downcast=True)
+
+        # Kept to compile the versions that read batches from shared variables, see `_slot`.
+        self._cost, self._compare = cost, compare
+        self._slots = {}
         return trainer, validator
 
     def _get_activation(self, l):
@@ -171,6 +299,84 @@ class MultiLayerPerceptronBackend(BaseBackend):
             network = lasagne.layers.batch_norm(network)
         return network
 
+    def _graph_key(self, X):
+        """Everything the layers and their compiled functions depend on besides the values
+        of the parameters: the layer specifications, the shape of the input and Theano's
+        settings.
+        """
+        layers = [(type(l).__name__, sorted((k, repr(v)) for k, v in l.__dict__.items()))
+                  for l in self.layers]
+        return repr((layers, X.shape[1:], self.dropout_rate, self.normalize,
+                     theano.config.floatX, theano.config.device))
+
+    def _create_graph(self, X):
+        """Compile the prediction function for the layers just created, or reuse the layers
+        and functions of a previous network with the same architecture after copying the new
+        initial parameters into them.
+        """
+        key = self._graph_key(X)
+        graph = _graphs.pop(key, None)
+        if graph is None:
+            output = lasagne.layers.get_output(self.mlp[-1], deterministic=True)
+            graph = {'mlp': self.mlp, 'input': self.data_input, 'output': output,
+                     'f': theano.function([self.data_input], output, allow_input_downcast=True),
+                     'trainers': collections.OrderedDict(), 'owner': weakref.ref(self)}
+            self._graph = graph
+        else:
+            log.debug("Reusing the compiled network of a previous network.")
+            self._graph = graph
+            self._acquire()
+            self._copy_to_graph(self.mlp, graph['mlp'])
+
+        _graphs[key] = graph
+        while len(_graphs) > GRAPH_CACHE_SIZE:
+            _graphs.popitem(last=False)
+
+        self.mlp, self.data_input = graph['mlp'], graph['input']
+        self.network_output, self.f = graph['output'], graph['f']
+
+    def _copy_to_graph(self, source, target):
+        for p, d in zip(lasagne.layers.get_all_params(target[-1]),
+                        lasagne.layers.get_all_params(source[-1])):
+            p.set_value(d.get_value(borrow=True))
+
+        # Dropout layers seed their random streams when created, and create the streams
+        # themselves when the training output is built.  Build it for the new layers too,
+        # so the cached streams continue exactly as the new ones would.
+        dropouts = [(l, k) for l, k in zip(lasagne.layers.get_all_layers(source[-1]),
+                                           lasagne.layers.get_all_layers(target[-1]))
+                    if getattr(l, '_srng', None) is not None]
+        if not dropouts:
+            return
+        rstates = [numpy.array(l._srng.rstate) for l, _ in dropouts]
+        lasagne.layers.get_output(source[-1], deterministic=False)
+        for (l, k), rstate in zip(dropouts, rstates):
+            k._srng.rstate = rstate
+            for (s, _), (d, _) in zip(k._srng.state_updates, l._srng.state_updates):
+                s.set_value(d.get_value())
+
+    def _acquire(self):
+        """Make sure the shared variables of the cached graph hold the state of this network,
+        saving the state of the network that used them last for when it needs them again.
+        """
+        graph = self._graph
+        owner = graph['owner']() if graph is not None else self
+        if owner is self:
+            return
+        if owner is not None:
+            owner._stash = [(v, v.get_value()) for v in owner._graph_variables()]
+        graph['owner'] = weakref.ref(self)
+        for v, d in self._stash or []:
+            v.set_value(d)
+        self._stash = None
+
+    def _graph_variables(self):
+        variables = lasagne.layers.get_all_params(self.mlp[-1]) + self._random_streams()
+        if self._learning_rule is not None:
+            known = set(id(v) for v in variables)
+            variables.extend(v for v in self._learning_rule.keys() if id(v) not in known)
+        return variables
+
     def _create_mlp(self, X, w=None):
         self.data_input = T.tensor4('X') if self.is_convolution(input=True) else T.matrix('X')
         self.data_output = T.tensor4('y') if self.is_convolution(output=True) else T.matrix('y')
@@ -215,6 +421,8 @@ class MultiLayerPerceptronBackend(BaseBackend):
                 assert count == space[1],\
                     "Mismatch in the calculated number of dense layer outputs. {} != {}".format(count, space[1])
 
+        self._create_graph(X)
+
         if self.weights is not None:
             l  = min(len(self.weights), len(self.mlp))
             log.info("Reloading parameters for %i layer weights and biases." % (l,))
@@ -223,10 +431,6 @@ class MultiLayerPerceptronBackend(BaseBackend):
 
         log.debug("")
 
-        self.network_output = lasagne.layers.get_output(network, deterministic=True)
-        self.trainer_output = lasagne.layers.get_output(network, deterministic=False)
-        self.f = theano.function([self.data_input], self.network_output, allow_input_downcast=True)
-
     def _conv_transpose(self, arr):
         ok = arr.shape[-1] not in (1,3) and arr.shape[1] in (1,3)
         return arr if ok else numpy.transpose(arr, (0, 3, 1, 2))
@@ -266,6 +470,7 @@ class MultiLayerPerceptronBackend(BaseBackend):
         return X, y
 
     def _predict_impl(self, X):
+        self._acquire()
         if self.is_convolution():
             X = numpy.transpose(X, (0, 3, 1, 2))
 
@@ -281,61 +486,78 @@ class MultiLayerPerceptronBackend(BaseBackend):
             y[idx] = yb
         return y
 
-    def _iterate_data(self, batch_size, X, y=None, w=None, shuffle=False):
-        def cast(array, indices):
-            if array is None:
-                return None
-
-            # Support for pandas.DataFrame, requires custom indexing.
-            if type(array).__name__ == 'DataFrame':
-                array = array.loc[indices]
+    def _can_use_slots(self, X, y, w):
+        # Batch callbacks expect the minibatch arrays, which the shared path never creates.
+        if self._has_batch_callbacks() or self.is_convolution():
+            return False
+        # Memory-mapped data is streamed batch by batch rather than loaded whole.
+        if any(isinstance(a, numpy.memmap) for a in (X, y, w)):
+            return False
+        return all(a is None or (isinstance(a, numpy.ndarray) and not hasattr(a, 'todense'))
+                   for a in (X, y, w))
+
+    def _slot(self, mode, X, y, w):
+        """Function compiled to process the batch `index[start:stop]` of the training arrays
+        uploaded for this pass of the epoch by `_upload`, via `givens`.  The functions are kept
+        with the compiled trainer, for the next network with the same architecture.
+        """
+        # The training objective evaluated on all of the training data reads the arrays
+        # uploaded for training, rather than a second copy of them.
+        if mode == 'train_obj' and w is None and _uploaded('train', X, y):
+            upload, key = _uploads[('train', theano.config.floatX)], (mode, 'train')
+            _release(mode)
+        else:
+            upload, key = _upload(mode, X, y, w), (mode, w is None)
+        if mode not in _indices:
+            _indices[mode] = theano.shared(numpy.zeros((0,), dtype='int64'), borrow=True)
+        index = _indices[mode]
+
+        function = self._compiled['functions'].get(key)
+        if function is None:
+            start, stop = T.lscalar('start'), T.lscalar('stop')
+            rows = index[start:stop]
+            if mode == 'train':
+                mask = upload['w'][rows] if w is not None else T.constant(numpy.cast[theano.config.floatX](1.0))
+                givens = {self.data_input: upload['X'][rows], self.data_output: upload['y'][rows],
+                          self.data_mask: mask}
+                function = theano.function([start, stop], self._cost, updates=self._learning_rule,
+                                           givens=givens, on_unused_input='ignore')
             else:
-                array = array[indices]
+                givens = {self.data_input: upload['X'][rows], self.data_correct: upload['y'][rows]}
+                function = theano.function([start, stop], self._compare, givens=givens)
+            self._compiled['functions'][key] = function
 
-                # Support for scipy.sparse; convert after slicing.
-                if hasattr(array, 'todense'):
-                    array = array.todense()
-
-            return array.astype(theano.config.floatX)
+        slot = self._slots[mode] = {'function': function, 'index': index}
+        return slot
 
+    def _slot_batch_impl(self, X, y, w, mode, output, shuffle):
+        slot = self._slot(mode, X, y, w)
         total_size = X.shape[0]
+        # Same random sequence as `_iterate_data`, but only the index vector is permuted.
         indices = numpy.arange(total_size)
         if shuffle:
             numpy.random.shuffle(indices)
+        slot['index'].set_value(indices, borrow=True)
 
-        for index in range(0, total_size, batch_size):
-            excerpt = indices[index:index + batch_size]
-            Xb, yb, wb = cast(X, excerpt), cast(y, excerpt), cast(w, excerpt)
-            yield Xb, yb, wb, excerpt
-
-    def _print(self, text):
-        if self.verbose:
-            sys.stdout.write(text)
-            sys.stdout.flush()
-
-    def _batch_impl(self, X, y, w, processor, mode, output, shuffle):
-        progress, batches = 0, X.shape[0] / self.batch_size
+        progress, batches = 0, total_size / self.batch_size
         loss, count = 0.0, 0
-        for Xb, yb, wb, _ in self._iterate_data(self.batch_size, X, y, w, shuffle):
-            self._do_callback('on_batch_start', locals())
-
-            if mode == 'train':
-                loss += processor(Xb, yb, wb if wb is not None else 1.0)
-            elif mode == 'train_obj':
-                loss += processor(Xb, yb)
-            else:
-                loss += processor(Xb, yb)
+        for start in range(0, total_size, self.batch_size):
+            loss += slot['function'](start, min(start + self.batch_size, total_size))
             count += 1
 
             while count / batches > progress / 60:
                 self._print(output)
                 progress += 1
 
-            self._do_callback('on_batch_finish', locals())
-
         self._print('\r')
         return loss / count
 
+    def _batch_impl(self, X, y, w, processor, mode, output, shuffle):
+        self._acquire()
+        if self._can_use_slots(X, y, w):
+            return self._slot_batch_impl(X, y, w, mode, output, shuffle)
+        return super(MultiLayerPerceptronBackend, self)._batch_impl(X, y, w, processor, mode, output, shuffle)
+
     def _train_impl(self, X, y, w=None):
         return self._batch_impl(X, y, w, self.trainer, mode='train', output='.', shuffle=True)
 
@@ -366,9 +588,52 @@ class MultiLayerPerceptronBackend(BaseBackend):
         return params
 
     def _mlp_to_array(self):
+        self._acquire()
         return [[p.get_value() for p in self._mlp_get_layer_params(l)] for l in self.mlp]
 
+    def _get_train_state(self):
+        """Everything needed besides the training loop counters to continue training
+        exactly: the parameters, the state of the learning rule (e.g. momentum velocities)
+        and the random generators used by the layers.
+        """
+        self._acquire()
+        return {'weights': self._mlp_to_array(),
+                'updates': [v.get_value() for v in self._learning_rule.keys()],
+                'streams': [s.get_value() for s in self._random_streams()],
+                'rng': lasagne.random.get_rng().get_state()}
+
+    def _set_train_state(self, state):
+        self._acquire()
+        self._array_to_mlp(state['weights'], self.mlp)
+        for v, d in zip(self._learning_rule.keys(), state['updates']):
+            v.set_value(d)
+        for s, d in zip(self._random_streams(), state['streams']):
+            s.set_value(d)
+        lasagne.random.get_rng().set_state(state['rng'])
+
+    def _random_streams(self):
+        # Dropout layers draw their masks from their own symbolic random streams.
+        streams = []
+        for layer in lasagne.layers.get_all_layers(self.mlp[-1]):
+            srng = getattr(layer, '_srng', None)
+            if srng is not None:
+                streams.extend(s for s, _ in srng.state_updates)
+        return streams
+
+    def _mlp_snapshot(self, snapshot=None):
+        """Copy the current parameters into the arrays of a previous snapshot, in the same
+        layout as `_mlp_to_array()`, so no new arrays are allocated after the first call.
+        """
+        if not snapshot:
+            return self._mlp_to_array()
+        self._acquire()
+        for layer, data in zip(self.mlp, snapshot):
+            for p, d in zip(self._mlp_get_layer_params(layer), data):
+                numpy.copyto(d, p.get_value(borrow=True))
+        return snapshot
+
     def _array_to_mlp(self, array, nn):
+        self._acquire()
         for layer, data in zip(nn, array):
             if data is None:
                 continue
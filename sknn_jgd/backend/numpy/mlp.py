@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, unicode_literals, print_function)
+
+__all__ = ['MultiLayerPerceptronBackend']
+
+import types
+import logging
+
+log = logging.getLogger('sknn')
+
+
+import numpy
+import sklearn.cross_validation
+
+from .. import floatX
+from ..base import BaseBackend
+from ...nn import Layer, Convolution, Native, ansi
+from ...numeric import ACTIVATIONS, LEARNING_RULES, apply_rule
+
+
+# Constants of Lasagne's `BatchNormLayer`, so both backends normalize the same way.
+BATCH_NORM_EPSILON = 1e-4
+BATCH_NORM_ALPHA = 0.1
+
+
+class DenseLayer(object):
+    """Fully connected layer, with optional dropout of its inputs and batch normalization.
+    The parameters are stored in the same order as by the Lasagne backend, so weights can
+    be exchanged between the two.
+    """
+
+    def __init__(self, name, activation, n_in, n_out, dropout=None, normalize=None):
+        dtype = floatX()
+        self.name = name
+        self.activation, self.gradient = ACTIVATIONS[activation]
+        self.dropout = dropout
+        self.normalize = normalize
+
+        # Same random draws as the Lasagne layers: the seed of the dropout stream, then the
+        # weights with Glorot's uniform initialization.
+        self.srng = numpy.random.RandomState(numpy.random.randint(1, 2147462579)) if dropout else None
+        scale = numpy.sqrt(6.0 / (n_in + n_out))
+        self.W = numpy.random.uniform(-scale, scale, (n_in, n_out)).astype(dtype)
+        if normalize == 'batch':
+            self.beta, self.gamma = numpy.zeros(n_out, dtype), numpy.ones(n_out, dtype)
+            self.mean, self.inv_std = numpy.zeros(n_out, dtype), numpy.ones(n_out, dtype)
+        else:
+            self.b = numpy.zeros(n_out, dtype)
+
+    def get_params(self):
+        if self.normalize == 'batch':
+            return [self.beta, self.gamma, self.mean, self.inv_std, self.W]
+        return [self.W, self.b]
+
+    def get_trainable(self):
+        if self.normalize == 'batch':
+            return [self.W, self.beta, self.gamma]
+        return [self.W, self.b]
+
+    def forward(self, X, train=False):
+        """Output of the layer for the inputs `X`.  When training, dropout is applied, batch
+        statistics are used and updated, and the intermediate values are kept for `backward`.
+        """
+        mask = None
+        if train and self.dropout:
+            retain = 1.0 - self.dropout
+            mask = (self.srng.uniform(size=X.shape) < retain).astype(X.dtype) / X.dtype.type(retain)
+            X = X * mask
+
+        z = X.dot(self.W)
+        if self.normalize == 'batch':
+            if train:
+                mean, inv_std = z.mean(axis=0), 1.0 / numpy.sqrt(z.var(axis=0) + BATCH_NORM_EPSILON)
+                self.mean *= 1.0 - BATCH_NORM_ALPHA
+                self.mean += BATCH_NORM_ALPHA * mean
+                self.inv_std *= 1.0 - BATCH_NORM_ALPHA
+                self.inv_std += BATCH_NORM_ALPHA * inv_std
+            else:
+                mean, inv_std = self.mean, self.inv_std
+            z_norm = (z - mean) * inv_std
+            z = z_norm * self.gamma + self.beta
+        else:
+            z += self.b
+
+        a = self.activation(z)
+        if train:
+            self._cache = (X, mask, z, a, z_norm, inv_std) if self.normalize == 'batch' else (X, mask, z, a)
+        return a
+
+    def backward(self, d, inputs=True, delta=False):
+        """Gradients of the trainable parameters, in the order of `get_trainable()`, and of
+        the inputs given the gradient `d` of the output of the last training `forward`.  If
+        `delta` is set, `d` is already the gradient before the nonlinearity.
+        """
+        X, mask, z, a = self._cache[:4]
+        if not delta:
+            d = self.gradient(z, a, d)
+
+        if self.normalize == 'batch':
+            z_norm, inv_std = self._cache[4:]
+            grads = [None, d.sum(axis=0), (d * z_norm).sum(axis=0)]
+            d = d * self.gamma
+            d = (inv_std / d.shape[0]) * (d.shape[0] * d - d.sum(axis=0) - z_norm * (d * z_norm).sum(axis=0))
+        else:
+            grads = [None, d.sum(axis=0)]
+        grads[0] = X.T.dot(d)
+
+        dX = None
+        if inputs:
+            dX = d.dot(self.W.T)
+            if mask is not None:
+                dX *= mask
+        return grads, dX
+
+
+class MultiLayerPerceptronBackend(BaseBackend):
+    """
+    Implementation of the multi-layer perceptron in NumPy only, as an alternative to
+    the Lasagne backend that needs no compilation.  Supports dense layers.
+    """
+
+    def __init__(self, spec):
+        super(MultiLayerPerceptronBackend, self).__init__(spec)
+        self.mlp = None
+        self.regularizer = None
+        self.cost_type = None
+        self._rule_state = []
+        self._rule_step = 0
+
+    def _create_mlp_trainer(self):
+        # Aggregate all regularization parameters into common dictionaries.
+        layer_decay = {}
+        if self.regularize in ('L1', 'L2') or any(l.weight_decay for l in self.layers):
+            wd = self.weight_decay or 0.0001
+            for l in self.layers:
+                layer_decay[l.name] = l.weight_decay or wd
+        assert len(layer_decay) == 0 or self.regularize in ('L1', 'L2', None)
+
+        if len(layer_decay) > 0:
+            if self.regularize is None:
+                self.auto_enabled['regularize'] = 'L2'
+            regularize = self.regularize or 'L2'
+            self.regularizer = (regularize, [layer_decay[s.name] for s in self.layers])
+
+        if self.normalize is None and any([l.normalize != None for l in self.layers]):
+            self.auto_enabled['normalize'] = 'batch'
+
+        loss_type = self.loss_type or ('mcc' if self.is_classifier else 'mse')
+        assert loss_type in ('mse', 'mcc'),\
+                    "Loss type `%s` not supported by NumPy backend." % loss_type
+        self.cost_type = loss_type
+
+        if self.learning_rule not in LEARNING_RULES:
+            raise NotImplementedError(
+                "Learning rule type `%s` is not supported." % self.learning_rule)
+        self._rule_state = [[numpy.zeros_like(p) for _ in range(LEARNING_RULES[self.learning_rule])]
+                            for p in self._trainable_params()]
+        self._rule_step = 0
+
+    def _create_layer(self, name, layer, n_in, n_out):
+        if isinstance(layer, (Convolution, Native)):
+            raise NotImplementedError("Layer `%s` of type `%s` is not supported by the NumPy backend."
+                                      % (name, layer.__class__.__name__))
+
+        self._check_layer(layer, required=['units'])
+        assert layer.type in ACTIVATIONS,\
+            "Layer type `%s` is not supported for `%s`." % (layer.type, layer.name)
+        return DenseLayer(name, layer.type, n_in, n_out,
+                          dropout=layer.dropout or self.dropout_rate,
+                          normalize=layer.normalize or self.normalize)
+
+    def _create_mlp(self, X):
+        # The Lasagne backend seeds the global generator the same way, so shuffling matches.
+        numpy.random.seed(self.random_state)
+
+        self.mlp = []
+        for layer, n_in, n_out in zip(self.layers, self.unit_counts[:-1], self.unit_counts[1:]):
+            self.mlp.append(self._create_layer(layer.name, layer, n_in, n_out))
+
+        log.info(
+            "Initializing neural network with %i layers, %i inputs and %i outputs.",
+            len(self.layers), self.unit_counts[0], self.layers[-1].units)
+
+        for l in self.layers:
+            log.debug("  - Dense: {}{: <10}{} Units:  {}{: <4}{}".format(
+                ansi.BOLD, l.type, ansi.ENDC, ansi.BOLD, l.units, ansi.ENDC))
+
+        if self.weights is not None:
+            l  = min(len(self.weights), len(self.mlp))
+            log.info("Reloading parameters for %i layer weights and biases." % (l,))
+            self._array_to_mlp(self.weights, self.mlp)
+            self.weights = None
+
+        log.debug("")
+
+    def _initialize_impl(self, X, y=None, w=None):
+        if self.mlp is None:
+            self._create_mlp(X)
+
+        # Can do partial initialization when predicting, no trainer needed.
+        if y is None:
+            return
+
+        if self.valid_size > 0.0:
+            assert self.valid_set is None, "Can't specify valid_size and valid_set together."
+            X, X_v, y, y_v = sklearn.cross_validation.train_test_split(
+                                X, y,
+                                test_size=self.valid_size,
+                                random_state=self.random_state)
+            self.valid_set = X_v, y_v
+
+        self._create_mlp_trainer()
+        return X, y
+
+    def _trainable_params(self):
+        return [p for spec, layer in zip(self.layers, self.mlp) if not spec.frozen
+                  for p in layer.get_trainable()]
+
+    def _forward(self, X, train=False):
+        for layer in self.mlp:
+            X = layer.forward(X, train)
+        return X
+
+    def _penalty(self):
+        if self.regularizer is None:
+            return 0.0
+        regularize, decays = self.regularizer
+        if regularize == 'L1':
+            return sum(decay * numpy.abs(layer.W).sum() for decay, layer in zip(decays, self.mlp))
+        return sum(decay * (layer.W * layer.W).sum() for decay, layer in zip(decays, self.mlp))
+
+    def _train_batch(self, Xb, yb, wb):
+        out = self._forward(Xb, train=True)
+        wb = wb[:, None] if numpy.ndim(wb) else wb
+
+        # Mean cost over the batch as in the Lasagne backend, weighted by the sample mask.
+        delta = False
+        if self.cost_type == 'mse':
+            diff = out - yb
+            cost = (diff * diff * wb).mean()
+            d = diff * (wb * (2.0 / diff.size))
+        else:
+            cost = (-(yb * numpy.log(out)) * wb).sum() / out.shape[0]
+            if self.layers[-1].type == 'Softmax':
+                # Gradient of cross-entropy through the softmax, without dividing by `out`.
+                d, delta = (out * yb.sum(axis=1, keepdims=True) - yb) * (wb / out.shape[0]), True
+            else:
+                d = -yb / out * (wb / out.shape[0])
+
+        # Backpropagate down to the lowest layer that is trained.
+        grads, trainable = [], [not s.frozen for s in self.layers]
+        bottom = trainable.index(True) if any(trainable) else len(self.mlp)
+        for i in reversed(range(bottom, len(self.mlp))):
+            g, d = self.mlp[i].backward(d, inputs=i > bottom, delta=delta)
+            delta = False
+            if trainable[i]:
+                if self.regularizer is not None:
+                    regularize, decays = self.regularizer
+                    W = self.mlp[i].W
+                    g[0] += decays[i] * (numpy.sign(W) if regularize == 'L1' else 2.0 * W)
+                grads[:0] = g
+
+        self._apply_rule(self._trainable_params(), grads)
+        return cost + self._penalty()
+
+    def _apply_rule(self, params, grads):
+        self._rule_step += 1
+        apply_rule(self.learning_rule, params, grads, self._rule_state, self._rule_step,
+                   self.learning_rate, self.learning_momentum)
+
+    def _compare_batch(self, Xb, yb):
+        out = self._forward(Xb)
+        if self.cost_type == 'mse':
+            return ((out - yb) ** 2).mean()
+        return -(yb * numpy.log(out)).sum() / out.shape[0]
+
+    def _predict_impl(self, X):
+        y = None
+        for Xb, _, _, idx in self._iterate_data(self.batch_size, X, shuffle=False):
+            yb = self._forward(Xb)
+            if y is None:
+                y = numpy.zeros(X.shape[:1] + yb.shape[1:], dtype=floatX())
+            y[idx] = yb
+        return y
+
+    def _train_impl(self, X, y, w=None):
+        return self._batch_impl(X, y, w, self._train_batch, mode='train', output='.', shuffle=True)
+
+    def _train_obj_impl(self, X, y, w=None):
+        return self._batch_impl(X, y, w, self._compare_batch, mode='train_obj', output=' ', shuffle=False)
+
+    def _valid_impl(self, X, y, w=None):
+        return self._batch_impl(X, y, w, self._compare_batch, mode='valid', output=' ', shuffle=False)
+
+    @property
+    def is_initialized(self):
+        """Check if the neural network was setup already.
+        """
+        return not (self.mlp is None)
+
+    def _mlp_to_array(self):
+        return [[p.copy() for p in l.get_params()] for l in self.mlp]
+
+    def _get_train_state(self):
+        """Everything needed besides the training loop counters to continue training
+        exactly: the parameters, the state of the learning rule (e.g. momentum velocities)
+        and the random generators used by the layers.
+        """
+        return {'weights': self._mlp_to_array(),
+                'updates': [[s.copy() for s in state] for state in self._rule_state],
+                'step': self._rule_step,
+                'streams': [l.srng.get_state() for l in self.mlp if l.srng is not None]}
+
+    def _set_train_state(self, state):
+        self._array_to_mlp(state['weights'], self.mlp)
+        for current, saved in zip(self._rule_state, state['updates']):
+            for s, d in zip(current, saved):
+                s[...] = d
+        self._rule_step = state['step']
+        for l, s in zip([l for l in self.mlp if l.srng is not None], state['streams']):
+            l.srng.set_state(s)
+
+    def _mlp_snapshot(self, snapshot=None):
+        """Copy the current parameters into the arrays of a previous snapshot, in the same
+        layout as `_mlp_to_array()`, so no new arrays are allocated after the first call.
+        """
+        if not snapshot:
+            return self._mlp_to_array()
+        for layer, data in zip(self.mlp, snapshot):
+            for p, d in zip(layer.get_params(), data):
+                numpy.copyto(d, p)
+        return snapshot
+
+    def _array_to_mlp(self, array, nn):
+        for layer, data in zip(nn, array):
+            if data is None:
+                continue
+
+            # Handle namedtuple format returned by get_parameters() as special case.
+            # Must remove the last `name` item in the tuple since it's not a parameter.
+            string_types = getattr(types, 'StringTypes', tuple([str]))
+            data = tuple([d for d in data if not isinstance(d, string_types)])
+
+            params = layer.get_params()
+            assert len(data) == len(params),\
+                            "Mismatch in data size for layer `%s`. %i != %i"\
+                            % (layer.name, len(data), len(params))
+
+            for p, d in zip(params, data):
+                assert p.shape == d.shape, "Layer parameter shape mismatch: %r != %r" % (p.shape, d.shape)
+                p[...] = d
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, unicode_literals, print_function)
+
+__all__ = ['EnsembleRegressor']
+
+import math
+import time
+import logging
+import itertools
+
+log = logging.getLogger('sknn')
+
+
+import numpy
+import sklearn.base
+
+from . import backend
+from .nn import Convolution, Native
+from .numeric import ACTIVATIONS, LEARNING_RULES, apply_rule
+from .predict import EnsemblePredictor, stacked_dot
+
+
+class EnsembleRegressor(sklearn.base.BaseEstimator, sklearn.base.RegressorMixin):
+    """Ensemble of regressors with the same layers, trained together in NumPy as one
+    network whose weights are stacked along a first axis of size `n_members`.  Every
+    member is initialized, split into training and validation data, resampled and shuffled
+    with its own random generator, and stops early on its own, so the result is the same
+    kind of ensemble as from training each member separately, in a fraction of the time.
+
+    Parameters
+    ----------
+    regressor: sknn.mlp.Regressor
+        Untrained network specifying the layers and the training parameters of every member:
+        `n_iter`, `n_stable`, `f_stable`, `batch_size`, the learning rule, regularization,
+        `valid_size` or `valid_set`, `eval_every`, `eval_subsample` and `callback`.  Only
+        dense layers without dropout or batch normalization, and the `mse` loss are
+        supported.
+
+    n_members: int, optional
+        Number of networks in the ensemble.
+
+    bootstrap: bool, optional
+        Train each member on a bootstrap sample of its training rows, drawn with replacement,
+        instead of all of them.
+
+    random_state: int, optional
+        Seed of the random generators of the members.  By default, the one of `regressor`.
+    """
+
+    def __init__(self, regressor, n_members=10, bootstrap=True, random_state=None):
+        self.regressor = regressor
+        self.n_members = n_members
+        self.bootstrap = bootstrap
+        self.random_state = random_state
+        self.weights = None
+
+    def _check_spec(self):
+        spec = self.regressor
+        if spec.is_classifier:
+            raise NotImplementedError("Only regressors are supported in ensembles.")
+        assert spec.n_iter or spec.n_stable,\
+            "Neither n_iter nor n_stable were specified; training would loop forever."
+        for l in spec.layers:
+            if isinstance(l, (Convolution, Native)) or l.type not in ACTIVATIONS:
+                raise NotImplementedError("Layer `%s` is not supported in ensembles." % l.name)
+            if l.dropout or spec.dropout_rate or l.normalize or spec.normalize:
+                raise NotImplementedError("Dropout and normalization are not supported in ensembles.")
+        assert spec.loss_type in (None, 'mse'),\
+            "Loss type `%s` not supported in ensembles." % spec.loss_type
+        if spec.learning_rule not in LEARNING_RULES:
+            raise NotImplementedError(
+                "Learning rule type `%s` is not supported." % spec.learning_rule)
+
+    def _reshape(self, X, y=None):
+        X = numpy.asarray(X)
+        if X.ndim > 2:
+            X = X.reshape((X.shape[0], -1))
+        if y is not None:
+            y = numpy.asarray(y)
+            if y.ndim == 1:
+                y = y.reshape((y.shape[0], 1))
+        return X, y
+
+    def _member_rows(self, rng, n_samples):
+        # The member's own validation split, then its bootstrap sample of the remaining rows.
+        rows = rng.permutation(n_samples)
+        n_valid = int(math.ceil(self.regressor.valid_size * n_samples))
+        valid, train = rows[:n_valid], rows[n_valid:]
+        if self.bootstrap:
+            train = rng.choice(train, size=train.shape[0], replace=True)
+        return train, valid
+
+    def _create_params(self, rngs, unit_counts, dtype):
+        # Glorot's uniform initialization, as in the backends, drawn by each member.
+        params = []
+        for n_in, n_out in zip(unit_counts[:-1], unit_counts[1:]):
+            scale = numpy.sqrt(6.0 / (n_in + n_out))
+            W = numpy.array([r.uniform(-scale, scale, (n_in, n_out)) for r in rngs], dtype=dtype)
+            params.append([W, numpy.zeros((len(rngs), n_out), dtype=dtype)])
+        return params
+
+    def _forward(self, params, X, train=False):
+        """Outputs of all members, shape (n_members, n_samples, n_outputs), for inputs that
+        are either shared, shape (n_samples, n_inputs), or per member, (n_members, ...).
+        """
+        cache = []
+        for l, (W, b) in zip(self.regressor.layers, params):
+            z = stacked_dot(X, W)
+            z += b[:, None, :]
+            a = ACTIVATIONS[l.type][0](z)
+            if train:
+                cache.append((X, z, a))
+            X = a
+        return X, cache
+
+    def _penalty(self, params):
+        if self.regularizer is None:
+            return 0.0
+        regularize, decays = self.regularizer
+        if regularize == 'L1':
+            return sum(decay * numpy.abs(W).sum(axis=(1, 2)) for decay, (W, _) in zip(decays, params))
+        return sum(decay * (W * W).sum(axis=(1, 2)) for decay, (W, _) in zip(decays, params))
+
+    def _train_batch(self, params, states, t, Xb, yb, wb):
+        out, cache = self._forward(params, Xb, train=True)
+        wb = 1.0 if wb is None else wb[:, :, None]
+
+        # Mean cost over each member's batch as in the backends, weighted by the sample mask.
+        diff = out - yb
+        cost = (diff * diff * wb).mean(axis=(1, 2))
+        d = diff * (wb * (2.0 / (diff.shape[1] * diff.shape[2])))
+
+        grads = [None] * len(params)
+        for i in reversed(range(len(params))):
+            X, z, a = cache[i]
+            W = params[i][0]
+            d = ACTIVATIONS[self.regressor.layers[i].type][1](z, a, d)
+            g = [stacked_dot(X, d, transpose_a=True), d.sum(axis=1)]
+            if self.regularizer is not None:
+                regularize, decays = self.regularizer
+                g[0] += decays[i] * (numpy.sign(W) if regularize == 'L1' else 2.0 * W)
+            if i > 0:
+                d = stacked_dot(d, W, transpose_b=True)
+            grads[i] = g
+
+        spec = self.regressor
+        trainable = [l for l in range(len(params)) if not spec.layers[l].frozen]
+        apply_rule(spec.learning_rule, [p for l in trainable for p in params[l]],
+                   [g for l in trainable for g in grads[l]], states, t,
+                   spec.learning_rate, spec.learning_momentum)
+        return cost + self._penalty(params)
+
+    def _errors(self, params, X, y, rows):
+        # Mean squared error of each member over its own rows, a batch of columns at a time.
+        total = numpy.zeros(rows.shape[0])
+        size = max(self.regressor.batch_size, 1024)
+        for start in range(0, rows.shape[1], size):
+            r = rows[:, start:start + size]
+            out, _ = self._forward(params, X[r].astype(params[0][0].dtype))
+            total += ((out - y[r]) ** 2).sum(axis=(1, 2))
+        return total / (rows.shape[1] * y.shape[1])
+
+    def _do_callback(self, event, variables):
+        callback = self.regressor.callback
+        if callback is None:
+            return
+
+        del variables['self']
+        if isinstance(callback, dict):
+            function = callback.get(event, None)
+            return function(**variables) if function else True
+        else:
+            return callback(event, **variables)
+
+    def fit(self, X, y, w=None):
+        """Fit all the members of the ensemble to the given continuous data.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            Training vectors as real numbers, where n_samples is the number of
+            samples and n_inputs is the number of input features.
+
+        y : array-like, shape (n_samples, n_outputs)
+            Target values are real numbers used as regression targets.
+
+        w : array-like (optional), shape (n_samples)
+            Floating point weights for each of the training samples, used as mask to
+            modify the cost function during optimization.
+
+        Returns
+        -------
+        self : object
+            Returns this instance.
+        """
+        self._check_spec()
+        spec, M = self.regressor, self.n_members
+        X, y = self._reshape(X, y)
+        dtype = backend.floatX()
+        n_out = spec.layers[-1].units or y.shape[1]
+        assert n_out == y.shape[1], "Mismatch between dataset size and units in output layer."
+        unit_counts = [X.shape[1]] + [l.units for l in spec.layers[:-1]] + [n_out]
+
+        # Every member draws its weights, data split, bootstrap sample and shuffles from its
+        # own generator.
+        rng = numpy.random.RandomState(self.random_state if self.random_state is not None
+                                       else spec.random_state)
+        rngs = [numpy.random.RandomState(s) for s in rng.randint(2**31 - 1, size=M)]
+        splits = [self._member_rows(r, X.shape[0]) for r in rngs]
+        train_rows = numpy.array([t for t, _ in splits])
+        X_v, y_v, valid_rows = X, y, None
+        if spec.valid_set is not None:
+            assert spec.valid_size == 0.0, "Can't specify valid_size and valid_set together."
+            X_v, y_v = self._reshape(*spec.valid_set)
+            valid_rows = numpy.tile(numpy.arange(X_v.shape[0]), (M, 1))
+        elif spec.valid_size > 0.0:
+            valid_rows = numpy.array([v for _, v in splits])
+        # The training rows are in random order, so the first ones are a random subsample.
+        obj_rows = train_rows[:, :spec.eval_subsample] if spec.eval_subsample else train_rows
+        n_train = train_rows.shape[1]
+
+        layer_decay = {}
+        if spec.regularize in ('L1', 'L2') or any(l.weight_decay for l in spec.layers):
+            wd = spec.weight_decay or 0.0001
+            for l in spec.layers:
+                layer_decay[l.name] = l.weight_decay or wd
+        self.regularizer = None
+        if len(layer_decay) > 0:
+            self.regularizer = (spec.regularize if spec.regularize in ('L1', 'L2') else 'L2',
+                                [layer_decay[l.name] for l in spec.layers])
+
+        params = self._create_params(rngs, unit_counts, dtype)
+        best_params = [[p.copy() for p in layer] for layer in params]
+        states = [[numpy.zeros_like(p) for _ in range(LEARNING_RULES[spec.learning_rule])]
+                  for l, layer in zip(spec.layers, params) if not l.frozen for p in layer]
+
+        log.info("Training an ensemble of %i networks with %i layers, %i inputs and %i outputs.",
+                 M, len(spec.layers), unit_counts[0], n_out)
+
+        # Members still training, in the order of the stacked arrays.  The others are removed.
+        active = numpy.arange(M)
+        best_train_errors = numpy.full(M, numpy.inf)
+        best_train_obj_errors = numpy.full(M, numpy.inf)
+        best_valid_errors = numpy.full(M, numpy.inf)
+        stable = numpy.zeros(M, dtype=int)
+        self.history = [[] for _ in range(M)]
+        i_prev_eval, t = 0, 0
+        self._do_callback('on_train_start', locals())
+
+        for i in itertools.count(1):
+            start_time = time.time()
+            self._do_callback('on_epoch_start', locals())
+
+            order = numpy.array([rngs[m].permutation(n_train) for m in active])
+            rows = train_rows[active[:, None], order]
+            loss, count = 0.0, 0
+            for start in range(0, n_train, spec.batch_size):
+                r = rows[:, start:start + spec.batch_size]
+                t += 1
+                loss += self._train_batch(params, states, t, X[r].astype(dtype), y[r].astype(dtype),
+                                          None if w is None else w[r].astype(dtype))
+                count += 1
+            train_errors = loss / count
+            if numpy.isnan(train_errors).any():
+                raise RuntimeError("Training diverged and returned NaN.")
+            best_train_errors[active] = numpy.minimum(best_train_errors[active], train_errors)
+            is_best_train = train_errors < best_train_errors[active] * (1.0 + spec.f_stable)
+
+            is_eval_epoch = i % spec.eval_every == 0 or (spec.n_iter is not None and i >= spec.n_iter)
+
+            train_obj_errors, valid_errors = None, None
+            is_best_valid = numpy.zeros(len(active), dtype=bool)
+            if is_eval_epoch:
+                train_obj_errors = self._errors(params, X, y, obj_rows[active])
+                best_train_obj_errors[active] = numpy.minimum(best_train_obj_errors[active], train_obj_errors)
+                if valid_rows is not None:
+                    valid_errors = self._errors(params, X_v, y_v, valid_rows[active])
+                    best_valid_errors[active] = numpy.minimum(best_valid_errors[active], valid_errors)
+                    is_best_valid = valid_errors < best_valid_errors[active] * (1.0 + spec.f_stable)
+
+            for k, m in enumerate(active):
+                self.history[m].append((
+                    train_errors[k], best_train_errors[m],
+                    valid_errors[k] if valid_errors is not None else None, best_valid_errors[m],
+                    train_obj_errors[k] if train_obj_errors is not None else None,
+                    best_train_obj_errors[m]))
+
+            # The errors of the members still training, averaged, as the callbacks of a
+            # single network receive them.
+            avg_train_error, best_train_error = _mean(train_errors), _mean(best_train_errors[active])
+            avg_valid_error, best_valid_error = _mean(valid_errors), _mean(best_valid_errors[active])
+            avg_train_obj_error = _mean(train_obj_errors)
+            best_train_obj_error = _mean(best_train_obj_errors[active])
+
+            log.debug("\r{:>5}         {:>10.3e}            {}        {:>5.1f}s   {:>3} members".format(
+                      i, avg_train_error,
+                      "{:>10.3e}".format(avg_valid_error) if (avg_valid_error is not None) else "     N/A  ",
+                      time.time() - start_time, len(active)))
+
+            is_best = is_best_valid if valid_rows is not None else is_best_train
+            for layer, best in zip(params, best_params):
+                for p, b in zip(layer, best):
+                    b[active[is_best]] = p[is_best]
+            if valid_rows is None or is_eval_epoch:
+                # With a validation set, stability is counted in evaluations.
+                stable[active] = numpy.where(is_best, 0, stable[active] + 1)
+
+            if self._do_callback('on_epoch_finish', locals()) == False:
+                log.debug("")
+                log.info("User defined callback terminated at %i iterations.", i)
+                break
+            if is_eval_epoch:
+                i_prev_eval = i
+
+            if spec.n_stable is not None:
+                stopped = stable[active] >= spec.n_stable
+                if stopped.any():
+                    log.info("Early termination condition fired for %i members at %i iterations.",
+                             stopped.sum(), i)
+                    keep = ~stopped
+                    active = active[keep]
+                    params = [[p[keep] for p in layer] for layer in params]
+                    states = [[s[keep] for s in state] for state in states]
+                    if len(active) == 0:
+                        break
+            if spec.n_iter is not None and i >= spec.n_iter:
+                log.debug("")
+                log.info("Terminating after specified %i total iterations.", i)
+                break
+        self._do_callback('on_train_finish', locals())
+        self.weights = best_params
+        return self
+
+    def predict_members(self, X):
+        """Calculate the predictions of every member of the ensemble.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            The input samples as a numpy array.
+
+        Returns
+        -------
+        y : array, shape (n_members, n_samples, n_outputs)
+            The predicted values of each member.
+        """
+        return self.predictor().predict_members(X)
+
+    def predict(self, X):
+        """Calculate the mean prediction of the members of the ensemble.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            The input samples as a numpy array.
+
+        Returns
+        -------
+        y : array, shape (n_samples, n_outputs)
+            The predicted values as a numpy array.
+        """
+        return self.predictor().predict(X)
+
+    def predictor(self, batch_size=8192):
+        """Build the `EnsemblePredictor` of the trained members, which also computes the
+        spread of their predictions.
+        """
+        assert self.weights is not None,\
+            "Ensemble was not trained; could not compute predictions."
+        return EnsemblePredictor([l.type for l in self.regressor.layers], self.weights,
+                                 batch_size=batch_size)
+
+    def regressors(self):
+        """Split the ensemble into ordinary networks.
+
+        Returns
+        -------
+        members : list of sknn.mlp.Regressor
+            A copy of `regressor` for each member, set up with its trained weights, which
+            can predict, be pickled or continue training like any other network.
+        """
+        assert self.weights is not None,\
+            "Ensemble was not trained; could not retrieve network parameters."
+        members = []
+        for m in range(self.weights[0][0].shape[0]):
+            nn = sklearn.base.clone(self.regressor)
+            nn.layers[-1].units = self.weights[-1][0].shape[2]
+            nn.set_parameters([[p[m] for p in layer] for layer in self.weights])
+            members.append(nn)
+        return members
+
+
+def _mean(errors):
+    return None if errors is None else float(errors.mean())
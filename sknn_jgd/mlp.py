@@ -8,6 +8,7 @@ import sys
 import math
 import time
 import logging
+import pickle
 import itertools
 import contextlib
 
@@ -15,7 +16,6 @@ log = logging.getLogger('sknn')
 
 
 import numpy
-import theano
 import sklearn.base
 import sklearn.pipeline
 import sklearn.preprocessing
@@ -142,9 +142,23 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
             float("inf"), float("inf"), float("inf")
         best_params = [] 
         n_stable = 0
+        X_obj, y_obj = self._eval_subsample(X, y)
+        i_prev_eval = 0
+        history = []
+        i_start = 1
+
+        # Continue from the loop state of a checkpoint, see `_fit(resume=True)`.
+        state, self._resume_state = getattr(self, '_resume_state', None), None
+        if state is not None:
+            best_train_error, best_train_obj_error, best_valid_error = \
+                state['best_train_error'], state['best_train_obj_error'], state['best_valid_error']
+            best_params, n_stable = state['best_params'], state['n_stable']
+            i_prev_eval, history = state['i_prev_eval'], state['history']
+            i_start = state['i'] + 1
+        last_checkpoint = time.time()
         self._do_callback('on_train_start', locals())
 
-        for i in itertools.count(1):
+        for i in itertools.count(i_start):
             start_time = time.time()
             self._do_callback('on_epoch_start', locals())
 
@@ -157,21 +171,29 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
                 best_train_error = min(best_train_error, avg_train_error)
                 is_best_train = bool(avg_train_error < best_train_error * (1.0 + self.f_stable))
 
+            # The extra evaluation passes only run every `eval_every` epochs, and always on the last.
+            is_eval_epoch = i % self.eval_every == 0 or (self.n_iter is not None and i >= self.n_iter)
+
             # jgd
             is_best_train_obj = False
-            avg_train_obj_error = self._backend._train_obj_impl(X, y)
+            avg_train_obj_error = None
+            if is_eval_epoch:
+                avg_train_obj_error = self._backend._train_obj_impl(X_obj, y_obj)
             if avg_train_obj_error is not None:
                 best_train_obj_error = min(best_train_obj_error, avg_train_obj_error)
                 is_best_train_obj = bool(avg_train_obj_error < best_train_obj_error * (1.0 + self.f_stable))
 
             is_best_valid = False
             avg_valid_error = None
-            if self.valid_set is not None:
+            if self.valid_set is not None and is_eval_epoch:
                 avg_valid_error = self._backend._valid_impl(*self.valid_set)
                 if avg_valid_error is not None:
                     best_valid_error = min(best_valid_error, avg_valid_error)
                     is_best_valid = bool(avg_valid_error < best_valid_error * (1.0 + self.f_stable))
 
+            history.append((avg_train_error, best_train_error, avg_valid_error, best_valid_error,
+                            avg_train_obj_error, best_train_obj_error))
+
             finish_time = time.time()
             log.debug("\r{:>5}         {}{}{}            {}{}{}        {:>5.1f}s".format(
                       i,
@@ -187,15 +209,18 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
                       ))
 
             if is_best_valid or (self.valid_set is None and is_best_train):
-                best_params = self._backend._mlp_to_array()
+                best_params = self._backend._mlp_snapshot(best_params)
                 n_stable = 0
-            else:
+            elif self.valid_set is None or is_eval_epoch:
+                # With a validation set, stability is counted in evaluations.
                 n_stable += 1
 
             if self._do_callback('on_epoch_finish', locals()) == False:
                 log.debug("")
                 log.info("User defined callback terminated at %i iterations.", i)
                 break
+            if is_eval_epoch:
+                i_prev_eval = i
 
             if self.n_stable is not None and n_stable >= self.n_stable:
                 log.debug("")
@@ -205,10 +230,58 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
                 log.debug("")
                 log.info("Terminating after specified %i total iterations.", i)
                 break
+
+            if self.checkpoint is not None and (
+                    (self.checkpoint_every and i % self.checkpoint_every == 0) or
+                    (self.checkpoint_secs and time.time() - last_checkpoint >= self.checkpoint_secs)):
+                self._write_checkpoint(locals())
+                last_checkpoint = time.time()
         self._do_callback('on_train_finish', locals())
         self._backend._array_to_mlp(best_params, self._backend.mlp)
 
-    def _fit(self, X, y, w=None):
+    def _eval_subsample(self, X, y):
+        if self.eval_subsample is None or self.eval_subsample >= X.shape[0]:
+            return X, y
+        # The same rows are used every epoch so the errors are comparable.
+        rng = numpy.random.RandomState(self.random_state)
+        idx = numpy.sort(rng.choice(X.shape[0], self.eval_subsample, replace=False))
+        # Rows of a pandas.DataFrame are selected by position, as in `_iterate_data`.
+        take = lambda a: a.iloc[idx] if type(a).__name__ == 'DataFrame' else a[idx]
+        return take(X), take(y)
+
+    def _write_checkpoint(self, variables):
+        state = {k: variables[k] for k in ('i', 'best_train_error', 'best_train_obj_error',
+                                           'best_valid_error', 'best_params', 'n_stable',
+                                           'i_prev_eval', 'history')}
+        state['backend'] = self._backend._get_train_state()
+        state['rng'] = numpy.random.get_state()
+        state['init_rng'] = self._init_rng_state
+
+        # Write to a temporary file first so an interrupted write never replaces a good checkpoint.
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(temp, self.checkpoint)
+        log.debug("  - Saved checkpoint at epoch %i to `%s`.", variables['i'], self.checkpoint)
+
+    def read_checkpoint(self):
+        """Load the training state saved at the `checkpoint` path, if any.
+
+        Returns
+        -------
+        state : dict or None
+            The saved state, including the epoch ``i`` and the per-epoch ``history`` of
+            (train, best train, valid, best valid, train objective, best train objective)
+            errors, or None if there is no checkpoint.
+        """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint, 'rb') as f:
+            return pickle.load(f)
+
+    def _fit(self, X, y, w=None, resume=False):
         assert X.shape[0] == y.shape[0],\
             "Expecting same number of input and output samples."
         data_shape = X.shape
@@ -216,9 +289,21 @@ class MultiLayerPerceptron(NeuralNetwork, sklearn.base.BaseEstimator):
         data_size = '{:,}'.format(X.size+y.size) if known_size else 'N/A'
         X, y = self._reshape(X, y)
 
+        state = self.read_checkpoint() if resume else None
+        if state is not None:
+            # Replay the random state used to initialize, so the validation split is the same.
+            numpy.random.set_state(state['init_rng'])
+        self._init_rng_state = numpy.random.get_state()
+
         if not self.is_initialized:
             X, y = self._initialize(X, y, w)
 
+        if state is not None:
+            self._backend._set_train_state(state['backend'])
+            numpy.random.set_state(state['rng'])
+            log.info("Resuming training after epoch %i from checkpoint `%s`.", state['i'], self.checkpoint)
+        self._resume_state = state
+
         log.info("Training on dataset of {:,} samples with {} total size.".format(data_shape[0], data_size))
         if data_shape[1:] != X.shape[1:]:
             log.warning("  - Reshaping input array from {} to {}.".format(data_shape, X.shape))
@@ -279,7 +364,7 @@ class Regressor(MultiLayerPerceptron, sklearn.base.RegressorMixin):
     # Regressor compatible with sklearn that wraps various NN implementations.
     # The constructor and bulk of documentation is inherited from MultiLayerPerceptron.
 
-    def fit(self, X, y, w=None):
+    def fit(self, X, y, w=None, resume=False):
         """Fit the neural network to the given continuous data as a regression problem.
 
         Parameters
@@ -295,6 +380,10 @@ class Regressor(MultiLayerPerceptron, sklearn.base.RegressorMixin):
             Floating point weights for each of the training samples, used as mask to
             modify the cost function during optimization. 
 
+        resume : bool (optional)
+            Continue training from the state saved at the `checkpoint` path, if it
+            exists, rather than from the start.
+
         Returns
         -------
         self : object
@@ -304,7 +393,7 @@ class Regressor(MultiLayerPerceptron, sklearn.base.RegressorMixin):
         if self.valid_set is not None:
             self.valid_set = self._reshape(*self.valid_set)
 
-        return super(Regressor, self)._fit(X, y, w)
+        return super(Regressor, self)._fit(X, y, w, resume=resume)
 
     def predict(self, X):
         """Calculate predictions for specified inputs.
@@ -348,7 +437,7 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
         yield
         spl.type_of_target = backup
 
-    def fit(self, X, y, w=None):
+    def fit(self, X, y, w=None, resume=False):
         """Fit the neural network to symbolic labels as a classification problem.
 
         Parameters
@@ -365,6 +454,10 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
             Floating point weights for each of the training samples, used as mask to
             modify the cost function during optimization.
 
+        resume : bool (optional)
+            Continue training from the state saved at the `checkpoint` path, if it
+            exists, rather than from the start.
+
         Returns
         -------
         self : object
@@ -388,7 +481,7 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
         self.label_binarizers = [LB() for _ in range(y.shape[1])]
         with self._patch_sklearn():
             ys = [lb.fit_transform(y[:,i]) for i, lb in enumerate(self.label_binarizers)]
-        yp = numpy.concatenate(ys, axis=1).astype(theano.config.floatX)
+        yp = numpy.concatenate(ys, axis=1).astype(backend.floatX())
 
         # Also transform the validation set if it was explicitly specified.
         if self.valid_set is not None:
@@ -401,7 +494,7 @@ class Classifier(MultiLayerPerceptron, sklearn.base.ClassifierMixin):
             self.valid_set = (X_v, y_vp)
 
         # Now train based on a problem transformed into regression.
-        return super(Classifier, self)._fit(X, yp, w)
+        return super(Classifier, self)._fit(X, yp, w, resume=resume)
 
     def partial_fit(self, X, y, classes=None):
         if y.ndim == 1:
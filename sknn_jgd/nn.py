@@ -14,7 +14,6 @@ log = logging.getLogger('sknn')
 
 
 import numpy
-import theano
 
 
 class ansi:
@@ -333,6 +332,11 @@ class NeuralNetwork(object):
         gradient descent (technically, a "minibatch").  By default each sample is
         treated on its own, with ``batch_size=1``.  Larger batches are usually faster.
 
+    prefetch: int, optional
+        Number of minibatches to prepare ahead on a background thread while the current
+        one is trained, when batches are gathered one at a time (e.g. from memory-mapped
+        data or with batch callbacks).  Default is ``0``, no prefetching.
+
     n_iter: int, optional
         The number of iterations of gradient descent to perform on the
         neural network's weights when training with ``fit()``.
@@ -350,6 +354,17 @@ class NeuralNetwork(object):
         stable. The training set is used as fallback if there's no validation set. Default
         is ``0.001`.
 
+    eval_every: int, optional
+        Number of epochs between the evaluation passes over the training set (the
+        training objective error) and over the validation set.  Epochs in between
+        report ``None`` for those errors, and with a validation set ``n_stable`` is
+        then counted in evaluations rather than epochs.  The last epoch of ``n_iter``
+        is always evaluated.  Default is ``1``, every epoch.
+
+    eval_subsample: int, optional
+        Number of rows of the training set, drawn once at random, on which the
+        training objective error is evaluated.  Default is ``None``, all rows.
+
     valid_set: tuple of array-like, optional
         Validation set (X_v, y_v) to be used explicitly while training.  Both
         arrays should have the same size for the first dimention, and the second
@@ -381,6 +396,17 @@ class NeuralNetwork(object):
         to be randomly excluded during training, e.g. 0.75 means only 25% of inputs
         will be included in the training.
 
+    checkpoint: str, optional
+        Path of a file where the full training state (parameters, learning rule state,
+        random state, epoch counter, best parameters and error history) is saved during
+        training, to continue later with ``fit(..., resume=True)``.  Default is ``None``.
+
+    checkpoint_every: int, optional
+        Save a checkpoint every this many epochs.
+
+    checkpoint_secs: float, optional
+        Save a checkpoint when this many seconds have passed since the last one.
+
     loss_type: string, optional
         The cost function to use when training the network.  There are two valid options:
 
@@ -445,12 +471,18 @@ class NeuralNetwork(object):
             weight_decay=None,
             dropout_rate=None,
             batch_size=1,
+            prefetch=0,
             n_iter=None,
             n_stable=10,
             f_stable=0.001,
+            eval_every=1,
+            eval_subsample=None,
             valid_set=None,
             valid_size=0.0,
             loss_type=None,
+            checkpoint=None,
+            checkpoint_every=None,
+            checkpoint_secs=None,
             callback=None,
             debug=False,
             verbose=None,
@@ -485,6 +517,8 @@ class NeuralNetwork(object):
             "Unknown type of regularization specified: %s." % regularize
         assert loss_type in ('mse', 'mae', 'mcc', None),\
             "Unknown loss function type specified: %s." % loss_type
+        assert eval_every >= 1,\
+            "Evaluation cadence must be at least one epoch: %s." % eval_every
 
         self.weights = parameters
         self.random_state = random_state
@@ -497,12 +531,18 @@ class NeuralNetwork(object):
         self.weight_decay = weight_decay
         self.dropout_rate = dropout_rate
         self.batch_size = batch_size
+        self.prefetch = prefetch
         self.n_iter = n_iter
         self.n_stable = n_stable
         self.f_stable = f_stable
+        self.eval_every = eval_every
+        self.eval_subsample = eval_subsample
         self.valid_set = valid_set
         self.valid_size = valid_size
         self.loss_type = loss_type
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_secs = checkpoint_secs
         self.debug = debug
         self.verbose = verbose
         self.callback = callback
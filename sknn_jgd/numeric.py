@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, unicode_literals, print_function)
+
+import numpy
+
+from .predict import NONLINEARITIES
+
+
+# For each layer type, the nonlinearity and the gradient through it given the input `x`,
+# output `a` and gradient of the output `d`.  All work on the last axis, so the same
+# functions serve single networks and stacks of networks.
+ACTIVATIONS = {
+    'Rectifier': (NONLINEARITIES['Rectifier'], lambda x, a, d: d * (x > 0)),
+    'Sigmoid': (NONLINEARITIES['Sigmoid'], lambda x, a, d: d * a * (1 - a)),
+    'Tanh': (NONLINEARITIES['Tanh'], lambda x, a, d: d * (1 - a * a)),
+    'Softmax': (NONLINEARITIES['Softmax'], lambda x, a, d: a * (d - (d * a).sum(axis=-1, keepdims=True))),
+    'Linear': (NONLINEARITIES['Linear'], lambda x, a, d: d),
+    'ExpLin': (NONLINEARITIES['ExpLin'], lambda x, a, d: d * numpy.where(x >= 0, 1, a + 1)),
+}
+
+# Number of state arrays kept for each parameter by the learning rules.
+LEARNING_RULES = {'sgd': 0, 'momentum': 1, 'nesterov': 1, 'adagrad': 1, 'adadelta': 2,
+                  'rmsprop': 1, 'adam': 2}
+
+
+def apply_rule(rule, params, grads, states, t, learning_rate, momentum):
+    """Update the parameters in place following the learning rule, with the same formulas
+    and default constants as `lasagne.updates`.  The `states` are the arrays counted in
+    `LEARNING_RULES` for each parameter, and `t` the number of this update starting at 1.
+    """
+    lr = learning_rate
+    for p, g, state in zip(params, grads, states):
+        if rule == 'sgd':
+            p -= lr * g
+        elif rule == 'momentum':
+            v, = state
+            v *= momentum
+            v -= lr * g
+            p += v
+        elif rule == 'nesterov':
+            v, = state
+            v *= momentum
+            v -= lr * g
+            p += momentum * v - lr * g
+        elif rule == 'adagrad':
+            accu, = state
+            accu += g * g
+            p -= lr * g / numpy.sqrt(accu + 1e-6)
+        elif rule == 'rmsprop':
+            accu, = state
+            accu *= 0.9
+            accu += 0.1 * g * g
+            p -= lr * g / numpy.sqrt(accu + 1e-6)
+        elif rule == 'adadelta':
+            accu, delta_accu = state
+            accu *= 0.95
+            accu += 0.05 * g * g
+            update = g * numpy.sqrt(delta_accu + 1e-6) / numpy.sqrt(accu + 1e-6)
+            p -= lr * update
+            delta_accu *= 0.95
+            delta_accu += 0.05 * update * update
+        elif rule == 'adam':
+            m, v = state
+            m *= 0.9
+            m += 0.1 * g
+            v *= 0.999
+            v += 0.001 * g * g
+            p -= (lr * numpy.sqrt(1 - 0.999**t) / (1 - 0.9**t)) * m / (numpy.sqrt(v) + 1e-8)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+__all__ = ['Predictor', 'EnsemblePredictor']
+
+import types
+
+import numpy
+
+from .nn import Convolution, Native
+
+
+def softmax(x):
+    e = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def explin(x):
+    return numpy.where(x >= 0, x, numpy.expm1(numpy.minimum(x, 0)))
+
+
+def stacked_dot(A, B, transpose_a=False, transpose_b=False):
+    """Matrix products of stacks of matrices along their first axis, the members of an
+    ensemble.  `A` may also be a single matrix shared by all members.  Without transposes
+    it is multiplied by every matrix of `B` in one product with their columns side by side.
+    Otherwise there is one product per member, each done by BLAS into the preallocated
+    result, as `numpy.einsum` and `numpy.matmul` over the stacks do not use it in NumPy 1.11.
+    """
+    if A.ndim == 2 and not (transpose_a or transpose_b):
+        n_in, n_out = B.shape[1:]
+        z = A.dot(B.transpose(1, 0, 2).reshape((n_in, -1)))
+        return z.reshape((A.shape[0], -1, n_out)).transpose(1, 0, 2)
+
+    rows = A.shape[-1] if transpose_a else A.shape[-2]
+    cols = B.shape[1] if transpose_b else B.shape[2]
+    out = numpy.empty((B.shape[0], rows, cols), dtype=numpy.result_type(A, B))
+    for a, b, o in zip(A if A.ndim == 3 else [A] * B.shape[0], B, out):
+        numpy.dot(a.T if transpose_a else a, b.T if transpose_b else b, out=o)
+    return out
+
+
+# The nonlinearity of each type of dense layer, computed the same way as by the backends.
+NONLINEARITIES = {
+    'Rectifier': lambda x: numpy.maximum(x, 0),
+    'Sigmoid': lambda x: 0.5 * (1.0 + numpy.tanh(0.5 * x)),
+    'Tanh': numpy.tanh,
+    'Softmax': softmax,
+    'Linear': lambda x: x,
+    'ExpLin': explin,
+}
+
+
+class Predictor(object):
+    """Forward pass of a trained stack of dense layers, computed in NumPy only.  This does
+    not import Theano or build a backend, so loading a saved network and predicting with
+    it takes milliseconds rather than the time needed to compile the graph.
+
+    Parameters
+    ----------
+    layers: list of str
+        The type of each layer, for example ``['Rectifier', 'Linear']``.
+
+    weights: list of tuples
+        For each layer, the parameters in the order stored by the backends: ``(W, b)``,
+        or ``(beta, gamma, mean, inv_std, W)`` for layers with batch normalization.
+        This is the format of the `weights` attribute of a pickled network and of
+        the list returned by `get_parameters()`.
+
+    batch_size: int, optional
+        Number of samples passed through the network at once, which bounds the memory
+        used for the hidden layers.  If `None`, all the samples are processed together.
+    """
+
+    def __init__(self, layers, weights, batch_size=8192):
+        assert len(layers) == len(weights),\
+            "Mismatch in number of layers. %i != %i" % (len(layers), len(weights))
+
+        string_types = getattr(types, 'StringTypes', tuple([str]))
+        self.layers, self.weights = [], []
+        for layer, data in zip(layers, weights):
+            if layer not in NONLINEARITIES:
+                raise NotImplementedError("Layer type `%s` is not supported for prediction." % layer)
+            # Remove the `layer` name of the tuples returned by get_parameters().
+            data = [numpy.asarray(d) for d in data if not isinstance(d, string_types)]
+            if len(data) not in (2, 5):
+                raise NotImplementedError("Unexpected number of parameters (%i) for layer `%s`."
+                                          % (len(data), layer))
+            self.layers.append(layer)
+            self.weights.append(data)
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_mlp(cls, mlp, batch_size=8192):
+        """Build the predictor from a trained `Regressor` or `Classifier`, either in
+        memory or loaded with pickle, in which case its backend is never created.
+        """
+        for l in mlp.layers:
+            if isinstance(l, (Convolution, Native)):
+                raise NotImplementedError("Layer `%s` is not supported for prediction." % l.name)
+
+        if mlp.is_initialized:
+            weights = mlp._backend._mlp_to_array()
+        else:
+            weights = mlp.weights
+            assert weights is not None,\
+                "Network was not trained; could not retrieve network parameters."
+            if isinstance(weights, dict):
+                weights = [weights[l.name] for l in mlp.layers]
+        return cls([l.type for l in mlp.layers], weights, batch_size=batch_size)
+
+    def _forward(self, X):
+        for layer, data in zip(self.layers, self.weights):
+            if len(data) == 5:
+                beta, gamma, mean, inv_std, W = data
+                z = (X.dot(W) - mean) * (inv_std * gamma) + beta
+            else:
+                W, b = data
+                z = X.dot(W)
+                z += b
+            X = NONLINEARITIES[layer](z)
+        return X
+
+    def predict(self, X):
+        """Calculate predictions for the specified inputs, as the network's `predict()`.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            The input samples as a numpy array.
+
+        Returns
+        -------
+        y : array, shape (n_samples, n_outputs)
+            The predicted values as a numpy array.
+        """
+        X = numpy.asarray(X)
+        if X.ndim > 2:
+            X = X.reshape((X.shape[0], -1))
+
+        dtype = self.weights[-1][-1].dtype
+        units = self.weights[-1][-1].shape[-1]
+        size = self.batch_size or max(X.shape[0], 1)
+        y = numpy.empty((X.shape[0], units), dtype=dtype)
+        for i in range(0, X.shape[0], size):
+            y[i:i + size] = self._forward(X[i:i + size].astype(dtype, copy=False))
+        return y
+
+
+class EnsemblePredictor(object):
+    """Forward pass of an ensemble of trained networks with the same layers, computed in
+    NumPy for all the members at once.  The parameters of the members are stacked into
+    arrays whose first axis is the member, as the `N_e` dimension of the weights exported
+    for the GCM, and so are the scalings of their inputs and outputs.
+
+    Parameters
+    ----------
+    layers: list of str
+        The type of each layer, for example ``['Rectifier', 'Linear']``.
+
+    weights: list of tuples
+        For each layer, the stacked parameters ``(W, b)`` of shapes (n_members, n_inputs,
+        n_outputs) and (n_members, n_outputs), as the `weights` of a trained
+        `EnsembleRegressor`.
+
+    x_center, x_scale: array-like, shape (n_members, n_inputs), optional
+        Scaling of the raw inputs of each member, which are given to the network as
+        ``(X - x_center) / x_scale``.  By default the inputs are not scaled.
+
+    y_center, y_scale: array-like, shape (n_members, n_outputs), optional
+        Scaling of the outputs of each member, which are returned as
+        ``y * y_scale + y_center``.  By default the outputs are not scaled.
+
+    batch_size: int, optional
+        Number of samples passed through the members at once, which bounds the memory
+        used for the hidden layers.  If `None`, all the samples are processed together.
+    """
+
+    def __init__(self, layers, weights, x_center=None, x_scale=None, y_center=None,
+                 y_scale=None, batch_size=8192):
+        assert len(layers) == len(weights),\
+            "Mismatch in number of layers. %i != %i" % (len(layers), len(weights))
+
+        self.layers, self.weights = [], []
+        for layer, data in zip(layers, weights):
+            if layer not in NONLINEARITIES:
+                raise NotImplementedError("Layer type `%s` is not supported for prediction." % layer)
+            if len(data) != 2:
+                raise NotImplementedError("Unexpected number of parameters (%i) for layer `%s`."
+                                          % (len(data), layer))
+            self.layers.append(layer)
+            self.weights.append([numpy.asarray(d) for d in data])
+
+        def stack(z):
+            return None if z is None else numpy.asarray(z)
+        self.x_center, self.x_scale = stack(x_center), stack(x_scale)
+        self.y_center, self.y_scale = stack(y_center), stack(y_scale)
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_predictors(cls, predictors, x_center=None, x_scale=None, y_center=None,
+                        y_scale=None, batch_size=8192):
+        """Stack the parameters of a list of `Predictor` with the same layers, one for each
+        member.  Batch normalization is folded into the weights of its layer.
+        """
+        layers = predictors[0].layers
+        for p in predictors:
+            assert p.layers == layers, "All the members must have the same layers."
+
+        weights = []
+        for i in range(len(layers)):
+            data = [_fold_normalization(p.weights[i]) for p in predictors]
+            weights.append([numpy.array([W for W, _ in data]), numpy.array([b for _, b in data])])
+        return cls(layers, weights, x_center=x_center, x_scale=x_scale, y_center=y_center,
+                   y_scale=y_scale, batch_size=batch_size)
+
+    @property
+    def n_members(self):
+        return self.weights[0][0].shape[0]
+
+    def _forward(self, X):
+        dtype = self.weights[-1][-1].dtype
+        if self.x_center is not None or self.x_scale is not None:
+            # Each member's scaled inputs, stored in the weights' type for the products.
+            Xs = numpy.empty((self.n_members,) + X.shape, dtype=dtype)
+            numpy.subtract(X, 0.0 if self.x_center is None else self.x_center[:, None, :], out=Xs)
+            if self.x_scale is not None:
+                numpy.divide(Xs, self.x_scale[:, None, :], out=Xs)
+            X = Xs
+        else:
+            X = X.astype(dtype, copy=False)
+        for layer, (W, b) in zip(self.layers, self.weights):
+            z = stacked_dot(X, W)
+            z += b[:, None, :]
+            X = NONLINEARITIES[layer](z)
+        if self.y_scale is not None:
+            X *= self.y_scale[:, None, :]
+        if self.y_center is not None:
+            X += self.y_center[:, None, :]
+        return X
+
+    def _batches(self, X):
+        # The predictions of all the members for each batch of the inputs.
+        X = numpy.asarray(X)
+        if X.ndim > 2:
+            X = X.reshape((X.shape[0], -1))
+        size = self.batch_size or max(X.shape[0], 1)
+        for i in range(0, X.shape[0], size):
+            yield slice(i, i + size), self._forward(X[i:i + size])
+
+    def _empty(self, X, members=False):
+        shape = (len(X), self.weights[-1][-1].shape[-1])
+        return numpy.empty((self.n_members,) + shape if members else shape,
+                           dtype=self.weights[-1][-1].dtype)
+
+    def predict_members(self, X):
+        """Calculate the predictions of every member for the specified inputs.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            The input samples as a numpy array.
+
+        Returns
+        -------
+        y : array, shape (n_members, n_samples, n_outputs)
+            The predicted values of each member.
+        """
+        y = self._empty(X, members=True)
+        for s, yb in self._batches(X):
+            y[:, s] = yb
+        return y
+
+    def predict(self, X):
+        """Calculate the mean prediction of the members for the specified inputs.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            The input samples as a numpy array.
+
+        Returns
+        -------
+        y : array, shape (n_samples, n_outputs)
+            The mean of the predicted values as a numpy array.
+        """
+        return self.predict_spread(X)[0]
+
+    def predict_spread(self, X, members=False):
+        """Calculate the mean and the spread of the predictions of the members in a single
+        pass over the inputs.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_samples, n_inputs)
+            The input samples as a numpy array.
+
+        members : bool, optional
+            Also return the predictions of every member.
+
+        Returns
+        -------
+        mean : array, shape (n_samples, n_outputs)
+            The mean of the predicted values.
+
+        spread : array, shape (n_samples, n_outputs)
+            The standard deviation of the predicted values over the members.
+
+        y : array, shape (n_members, n_samples, n_outputs)
+            The predicted values of each member, if `members` is true.
+        """
+        mean, spread = self._empty(X), self._empty(X)
+        y = self._empty(X, members=True) if members else None
+        for s, yb in self._batches(X):
+            mean[s] = yb.mean(axis=0)
+            spread[s] = yb.std(axis=0)
+            if members:
+                y[:, s] = yb
+        return (mean, spread, y) if members else (mean, spread)
+
+
+def _fold_normalization(data):
+    # Batch normalization applies an affine map per unit, merged into the weights and bias.
+    if len(data) == 2:
+        return data
+    beta, gamma, mean, inv_std, W = data
+    k = inv_std * gamma
+    return W * k, beta - mean * k
@@ -1 +1,5 @@
-from sknn.backend import lasagne
+import os
+import importlib
+
+# Run the tests against the backend named in `SKNN_BACKEND`, by default Lasagne.
+importlib.import_module('sknn.backend.' + os.environ.get('SKNN_BACKEND', 'lasagne'))
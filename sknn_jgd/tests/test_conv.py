@@ -5,10 +5,12 @@ import io
 import pickle
 import numpy
 
+import sknn
 from sknn.mlp import Regressor as MLPR
 from sknn.mlp import Layer as L, Convolution as C
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestConvolution(unittest.TestCase):
 
     def _run(self, nn, a_in=None, fit=True):
@@ -111,6 +113,7 @@ class TestConvolution(unittest.TestCase):
 
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestUpscaling(unittest.TestCase):
 
     def _run(self, nn, scale):
@@ -198,6 +201,7 @@ class TestConvolutionSpecs(unittest.TestCase):
         assert_raises(NotImplementedError, C,
                       "Rectifier", channels=4, kernel_shape=(3,3), border_mode='unknown')
 
+    @unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
     def test_MultiLayerPooling(self):
         nn = MLPR(layers=[
                     C("Rectifier", channels=4, kernel_shape=(3,3), pool_shape=(2,2)),
@@ -218,6 +222,7 @@ class TestConvolutionSpecs(unittest.TestCase):
         assert_equal(nn.unit_counts, [1024, 64 * 64 * 4, 5])
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestActivationTypes(unittest.TestCase):
 
     def _run(self, activation):
@@ -263,6 +268,7 @@ class TestConvolutionRGB(TestConvolution):
         assert_equal(type(a_out), type(a_in))
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestSerialization(unittest.TestCase):
 
     def setUp(self):
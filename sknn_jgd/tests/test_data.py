@@ -7,6 +7,7 @@ import io
 import logging
 
 import numpy
+import sknn
 from sknn.mlp import Regressor as MLPR, Classifier as MLPC
 from sknn.mlp import Layer as L, Convolution as C
 
@@ -38,6 +39,82 @@ class TestDataAugmentation(unittest.TestCase):
         assert_raises(RuntimeError, self.nn._fit, a_in, a_out)
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
+class TestSharedBatches(unittest.TestCase):
+
+    def _train(self, callback, w=None):
+        numpy.random.seed(0)
+        nn = MLPR(layers=[L("Rectifier", units=8), L("Linear")], n_iter=2, batch_size=3,
+                  random_state=1, callback=callback)
+        a_in = numpy.random.uniform(size=(10,16))
+        a_out = numpy.random.uniform(size=(10,4))
+        nn._fit(a_in, a_out, w)
+        return nn
+
+    def test_SameAsPerBatchArrays(self):
+        nn1 = self._train(None)
+        nn2 = self._train({'on_batch_start': lambda **_: None})
+        assert_true(len(nn1._backend._slots) > 0)
+        assert_equals(0, len(nn2._backend._slots))
+        for p1, p2 in zip(nn1.get_parameters(), nn2.get_parameters()):
+            assert_true(numpy.allclose(p1.weights, p2.weights))
+            assert_true(numpy.allclose(p1.biases, p2.biases))
+
+    def test_TrainingObjectiveSharesData(self):
+        nn = self._train(None, numpy.linspace(0.5, 1.5, 10))
+        assert_in(('train_obj', 'train'), nn._backend._compiled['functions'])
+
+    def test_ChangedInPlaceUploadedAgain(self):
+        from sknn.backend.lasagne.mlp import _upload
+        a_in, a_out = numpy.random.uniform(size=(10,16)), numpy.random.uniform(size=(10,4))
+        first = _upload('test', a_in, a_out, None)['X'].get_value().copy()
+        a_in *= 2.0
+        second = _upload('test', a_in, a_out, None)['X'].get_value()
+        assert_true(numpy.allclose(2.0 * first, second))
+
+    def test_SameAsPerBatchArraysWeighted(self):
+        w = numpy.linspace(0.5, 1.5, 10)
+        nn1 = self._train(None, w)
+        nn2 = self._train({'on_batch_start': lambda **_: None}, w)
+        for p1, p2 in zip(nn1.get_parameters(), nn2.get_parameters()):
+            assert_true(numpy.allclose(p1.weights, p2.weights))
+
+
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
+class TestGraphCache(unittest.TestCase):
+
+    def _train(self, a_in, a_out, **params):
+        nn = MLPR(layers=[L("Tanh", units=8), L("Linear")], n_iter=2, random_state=1, **params)
+        nn.fit(a_in, a_out)
+        return nn
+
+    def test_SameArchitectureReused(self):
+        a_in, a_out = numpy.random.uniform(size=(10,16)), numpy.random.uniform(size=(10,4))
+        nn1 = self._train(a_in, a_out)
+        nn2 = self._train(a_in, a_out)
+        assert_true(nn1._backend.f is nn2._backend.f)
+        assert_true(nn1._backend.trainer is nn2._backend.trainer)
+        assert_true(numpy.allclose(nn1.predict(a_in), nn2.predict(a_in)))
+
+    def test_OtherNetworkNotOverwritten(self):
+        a_in, a_out = numpy.random.uniform(size=(10,16)), numpy.random.uniform(size=(10,4))
+        nn1 = self._train(a_in, a_out)
+        p1 = nn1.predict(a_in)
+        nn2 = self._train(a_in, 2.0 * a_out, learning_rate=0.05)
+        assert_true(nn1._backend.f is nn2._backend.f)
+        assert_true(numpy.allclose(p1, nn1.predict(a_in)))
+        assert_true(not numpy.allclose(p1, nn2.predict(a_in)))
+
+    def test_DataSharedBetweenTrainers(self):
+        from sknn.backend.lasagne.mlp import TRAINER_CACHE_SIZE
+        a_in, a_out = numpy.random.uniform(size=(10,16)), numpy.random.uniform(size=(10,4))
+        nns = [self._train(a_in, a_out, learning_rate=0.01 * (i + 1))
+               for i in range(TRAINER_CACHE_SIZE + 2)]
+        assert_true(nns[0]._backend.trainer is not nns[1]._backend.trainer)
+        assert_true(nns[0]._backend._slots['train']['index'] is nns[1]._backend._slots['train']['index'])
+        assert_equals(TRAINER_CACHE_SIZE, len(nns[-1]._backend._graph['trainers']))
+
+
 class TestNetworkParameters(unittest.TestCase):
     
     def setUp(self):
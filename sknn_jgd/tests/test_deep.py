@@ -97,6 +97,7 @@ class TestDeepDeterminism(unittest.TestCase):
         self.run_EqualityTest(lambda a: self.make(a, train=True, dropout=0.5), self.serialize, assert_true)
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestConvolutionDeterminism(TestDeepDeterminism):
 
     def setUp(self):
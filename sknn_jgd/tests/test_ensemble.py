@@ -0,0 +1,107 @@
+import unittest
+from nose.tools import (assert_equal, assert_raises, assert_true, assert_false)
+
+import pickle
+import numpy
+
+from sknn.mlp import Regressor as MLPR, Classifier as MLPC
+from sknn.mlp import Layer as L
+from sknn.ensemble import EnsembleRegressor
+from sknn.predict import Predictor
+
+
+class TestEnsembleRegressor(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, 1.0, (64, 16))
+        self.a_out = numpy.random.uniform(-1.0, 1.0, (64, 4))
+
+    def make(self, n_iter=2, **params):
+        nn = MLPR(layers=[L("Rectifier", units=8), L("Linear")], n_iter=n_iter, **params)
+        return EnsembleRegressor(nn, n_members=3, random_state=1)
+
+    def test_PredictMembers(self):
+        ens = self.make().fit(self.a_in, self.a_out)
+        members = ens.predict_members(self.a_in)
+        assert_equal(members.shape, (3, 64, 4))
+        assert_true(numpy.allclose(ens.predict(self.a_in), members.mean(axis=0)))
+        assert_false(numpy.allclose(members[0], members[1]))
+
+    def test_SplitRegressors(self):
+        ens = self.make(learning_rule='momentum').fit(self.a_in, self.a_out)
+        members = ens.predict_members(self.a_in)
+        for m, nn in enumerate(ens.regressors()):
+            nn = pickle.loads(pickle.dumps(nn))
+            assert_true(numpy.allclose(nn.predict(self.a_in), members[m], atol=1e-5))
+
+    def test_SameSeedSameEnsemble(self):
+        a = self.make().fit(self.a_in, self.a_out).predict(self.a_in)
+        b = self.make().fit(self.a_in, self.a_out).predict(self.a_in)
+        assert_true(numpy.allclose(a, b))
+
+    def test_EarlyStoppingPerMember(self):
+        ens = self.make(n_iter=None, n_stable=2, valid_size=0.25).fit(self.a_in, self.a_out)
+        assert_equal(len(ens.history), 3)
+        for h in ens.history:
+            assert_true(len(h) >= 3)
+            assert_true(h[-1][2] is not None)
+
+    def test_EarlyStoppingRestoresBest(self):
+        nn = MLPR(layers=[L("Rectifier", units=8), L("Linear")], n_stable=3, f_stable=1e-9,
+                  valid_size=0.25, learning_rate=0.05)
+        ens = EnsembleRegressor(nn, n_members=3, random_state=1).fit(self.a_in, self.a_out)
+        members = ens.predict_members(self.a_in)
+
+        # Each member's validation rows are the first of its generator's permutation.
+        seeds = numpy.random.RandomState(1).randint(2**31 - 1, size=3)
+        restarted = 0
+        for m, seed in enumerate(seeds):
+            valid = numpy.random.RandomState(seed).permutation(64)[:16]
+            error = ((members[m][valid] - self.a_out[valid]) ** 2).mean()
+            errors = [h[2] for h in ens.history[m]]
+            assert_true(numpy.allclose(error, min(errors), rtol=1e-4))
+            restarted += errors[-1] > min(errors)
+        assert_true(restarted > 0)
+
+    def test_SameAsSingleNetwork(self):
+        params = dict(layers=[L("Tanh", units=8), L("Linear")], n_iter=3, batch_size=10,
+                      learning_rule='adam', weight_decay=0.001)
+        ens = EnsembleRegressor(MLPR(**params), n_members=1, bootstrap=False, random_state=7)
+        ens.fit(self.a_in, self.a_out)
+
+        # The member's generator draws the order of its rows, then the weights of each layer,
+        # then one shuffle per epoch, which the backend draws from the global generator.
+        rng = numpy.random.RandomState(numpy.random.RandomState(7).randint(2**31 - 1, size=1)[0])
+        rows = rng.permutation(64)
+        weights = []
+        for n_in, n_out in [(16, 8), (8, 4)]:
+            scale = numpy.sqrt(6.0 / (n_in + n_out))
+            weights.append((rng.uniform(-scale, scale, (n_in, n_out)), numpy.zeros(n_out)))
+        def on_train_start(**_):
+            numpy.random.set_state(rng.get_state())
+        nn = MLPR(parameters=weights, callback={'on_train_start': on_train_start}, **params)
+        nn.fit(self.a_in[rows], self.a_out[rows])
+
+        for (W, b), (W_e, b_e) in zip(Predictor.from_mlp(nn).weights, ens.weights):
+            assert_true(numpy.allclose(W, W_e[0]))
+            assert_true(numpy.allclose(b, b_e[0]))
+
+    def test_CallbackAverageErrors(self):
+        errors = []
+        def on_epoch_finish(avg_train_error, **_):
+            errors.append(avg_train_error)
+        ens = self.make(callback={'on_epoch_finish': on_epoch_finish})
+        ens.fit(self.a_in, self.a_out)
+        assert_equal(len(errors), 2)
+        assert_true(all(isinstance(e, float) for e in errors))
+
+    def test_FromPickle(self):
+        ens = self.make().fit(self.a_in, self.a_out)
+        copy = pickle.loads(pickle.dumps(ens))
+        assert_true(numpy.allclose(ens.predict(self.a_in), copy.predict(self.a_in)))
+
+    def test_UnsupportedNetworks(self):
+        nn = MLPR(layers=[L("Rectifier", units=8, dropout=0.5), L("Linear")], n_iter=1)
+        assert_raises(NotImplementedError, EnsembleRegressor(nn).fit, self.a_in, self.a_out)
+        nn = MLPC(layers=[L("Softmax")], n_iter=1)
+        assert_raises(NotImplementedError, EnsembleRegressor(nn).fit, self.a_in, self.a_out)
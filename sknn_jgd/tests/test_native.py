@@ -5,13 +5,16 @@ import io
 import pickle
 import numpy
 
+import sknn
 from sknn.mlp import Regressor as MLPR
 from sknn.mlp import Native as N, Layer as L
 
-import lasagne.layers as ly
-import lasagne.nonlinearities as nl
+if sknn.backend.name == 'lasagne':
+    import lasagne.layers as ly
+    import lasagne.nonlinearities as nl
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestNativeLasagneLayer(unittest.TestCase):
 
     def _run(self, nn):
@@ -25,7 +25,7 @@ class TestLossTypes(unittest.TestCase):
         nn = MLPR(layers=[L("Linear")], loss_type='mse', n_iter=1)
         self._run(nn)
     
-    @unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
+    @unittest.skipIf(sknn.backend.name not in ('lasagne', 'numpy'), 'only lasagne and numpy')
     def test_CategoricalCrossEntropyLinear(self):
         nn = MLPR(layers=[L("Softmax")], loss_type='mcc', n_iter=1)
         self._run(nn)
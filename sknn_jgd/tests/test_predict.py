@@ -0,0 +1,107 @@
+import unittest
+from nose.tools import (assert_equal, assert_raises, assert_true)
+
+import pickle
+import numpy
+
+from sknn.mlp import Regressor as MLPR
+from sknn.mlp import Layer as L, Convolution as C
+from sknn.predict import Predictor, EnsemblePredictor, stacked_dot
+
+
+class TestPredictor(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, 1.0, (64, 16))
+        self.a_out = numpy.random.uniform(-1.0, 1.0, (64, 4))
+
+    def _check(self, nn):
+        nn.fit(self.a_in, self.a_out)
+        p = Predictor.from_mlp(nn)
+        assert_true(numpy.allclose(nn.predict(self.a_in), p.predict(self.a_in), atol=1e-5))
+
+    def test_DenseActivations(self):
+        for activation in ['Rectifier', 'Sigmoid', 'Tanh', 'ExpLin']:
+            self._check(MLPR(layers=[L(activation, units=8), L("Linear")], n_iter=1))
+
+    def test_BatchNormalization(self):
+        self._check(MLPR(layers=[L("Rectifier", units=8, normalize='batch'), L("Linear")], n_iter=2))
+
+    def test_FromPickle(self):
+        nn = MLPR(layers=[L("Tanh", units=8), L("Linear")], n_iter=1)
+        nn.fit(self.a_in, self.a_out)
+        nn = pickle.loads(pickle.dumps(nn))
+        p = Predictor.from_mlp(nn)
+        assert_true(nn._backend is None)
+        assert_true(numpy.allclose(nn.predict(self.a_in), p.predict(self.a_in), atol=1e-5))
+
+    def test_SmallBatches(self):
+        nn = MLPR(layers=[L("Rectifier", units=8), L("Linear")], n_iter=1)
+        nn.fit(self.a_in, self.a_out)
+        full = Predictor.from_mlp(nn, batch_size=None).predict(self.a_in)
+        batched = Predictor.from_mlp(nn, batch_size=10).predict(self.a_in)
+        assert_equal(batched.shape, (64, 4))
+        assert_true(numpy.allclose(full, batched))
+
+    def test_UntrainedNetwork(self):
+        nn = MLPR(layers=[L("Linear")])
+        assert_raises(AssertionError, Predictor.from_mlp, nn)
+
+    def test_ConvolutionNotSupported(self):
+        nn = MLPR(layers=[C("Rectifier", channels=4, kernel_shape=(3,3)), L("Linear")])
+        assert_raises(NotImplementedError, Predictor.from_mlp, nn)
+
+
+class TestEnsemblePredictor(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, 1.0, (64, 16))
+        self.a_out = numpy.random.uniform(-1.0, 1.0, (64, 4))
+        self.members = []
+        for i, normalize in enumerate([None, None, 'batch']):
+            nn = MLPR(layers=[L("Tanh", units=8, normalize=normalize), L("Linear")],
+                      n_iter=1, random_state=i)
+            nn.fit(self.a_in, self.a_out)
+            self.members.append(Predictor.from_mlp(nn))
+
+    def test_MembersMatch(self):
+        ens = EnsemblePredictor.from_predictors(self.members, batch_size=10)
+        y = ens.predict_members(self.a_in)
+        assert_equal(y.shape, (3, 64, 4))
+        for m, p in enumerate(self.members):
+            assert_true(numpy.allclose(p.predict(self.a_in), y[m], atol=1e-5))
+
+    def test_MeanAndSpread(self):
+        ens = EnsemblePredictor.from_predictors(self.members)
+        mean, spread, y = ens.predict_spread(self.a_in, members=True)
+        assert_true(numpy.allclose(mean, y.mean(axis=0)))
+        assert_true(numpy.allclose(spread, y.std(axis=0)))
+        assert_true(numpy.allclose(ens.predict(self.a_in), mean))
+
+    def test_MemberScalings(self):
+        xc, xs = numpy.random.uniform(-1.0, 1.0, (3, 16)), numpy.random.uniform(1.0, 2.0, (3, 16))
+        yc, ys = numpy.random.uniform(-1.0, 1.0, (3, 4)), numpy.random.uniform(1.0, 2.0, (3, 4))
+        ens = EnsemblePredictor.from_predictors(self.members, x_center=xc, x_scale=xs,
+                                                y_center=yc, y_scale=ys)
+        y = ens.predict_members(self.a_in)
+        for m, p in enumerate(self.members):
+            expected = p.predict((self.a_in - xc[m]) / xs[m]) * ys[m] + yc[m]
+            assert_true(numpy.allclose(expected, y[m], atol=1e-4))
+
+    def test_DifferentLayers(self):
+        other = Predictor(['Rectifier', 'Linear'], self.members[0].weights)
+        assert_raises(AssertionError, EnsemblePredictor.from_predictors, [self.members[0], other])
+
+
+class TestStackedDot(unittest.TestCase):
+
+    def test_Transposes(self):
+        A, B = numpy.random.uniform(size=(3, 4, 4)), numpy.random.uniform(size=(3, 4, 4))
+        for a in [A, A[0]]:
+            a_m = a if a.ndim == 3 else numpy.array([a] * 3)
+            for ta in [False, True]:
+                for tb in [False, True]:
+                    expected = numpy.einsum('mij,mjk->mik', a_m.transpose(0, 2, 1) if ta else a_m,
+                                            B.transpose(0, 2, 1) if tb else B)
+                    result = stacked_dot(a, B, transpose_a=ta, transpose_b=tb)
+                    assert_true(numpy.allclose(expected, result))
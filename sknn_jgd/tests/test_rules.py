@@ -80,6 +80,7 @@ class TestRegularization(LoggingTestCase):
         super(TestRegularization, self).tearDown()
         sknn.mlp.log.removeHandler(self.hnd2)
 
+    @unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
     def test_BatchNormExplicit(self):
         nn = MLPR(layers=[C("Tanh", channels=2, kernel_shape=(3,3)),
                           L("Sigmoid", units=8), L("Linear",)],
@@ -92,6 +93,7 @@ class TestRegularization(LoggingTestCase):
         assert_in('Reshaping input array', self.buf.getvalue())
         self.buf = io.StringIO()
 
+    @unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
     def test_BatchNormPerLayer(self):
         nn = MLPR(layers=[C("Sigmoid", normalize='batch', channels=2, kernel_shape=(3,3)),
                           L("Rectifier", normalize='batch', units=8), L("Linear",)],
@@ -164,3 +166,54 @@ class TestRegularization(LoggingTestCase):
         self._run(nn)
         assert_in('Using `L2` for regularization, auto-enabled from layers.',
                   self.output.getvalue())
+
+
+@unittest.skipIf(sknn.backend.name != 'numpy', 'only numpy')
+class TestGradients(unittest.TestCase):
+
+    def setUp(self):
+        self.a_in = numpy.random.uniform(-1.0, 1.0, (8, 4))
+        self.a_out = numpy.random.uniform(0.1, 1.0, (8, 3))
+        self.a_mask = numpy.random.uniform(0.5, 1.5, (8,))
+
+    def _check(self, nn):
+        nn._initialize(self.a_in, self.a_out)
+        backend = nn._backend
+        for layer in backend.mlp:
+            layer.W, layer.b = layer.W.astype(numpy.float64), layer.b.astype(numpy.float64)
+        params = backend._trainable_params()
+
+        # With plain SGD at a rate of one, a training step subtracts the gradient exactly,
+        # and at a rate of zero it only returns the regularized cost.
+        def cost():
+            nn.learning_rate = 0.0
+            return backend._train_batch(self.a_in, self.a_out, self.a_mask)
+
+        before = [p.copy() for p in params]
+        nn.learning_rate = 1.0
+        backend._train_batch(self.a_in, self.a_out, self.a_mask)
+        grads = [b - p for p, b in zip(params, before)]
+        for p, b in zip(params, before):
+            p[...] = b
+
+        for p, b, grad in zip(params, before, grads):
+            numeric, eps = numpy.zeros_like(p), 1e-6
+            for i in numpy.ndindex(*p.shape):
+                p[i] = b[i] + eps
+                plus = cost()
+                p[i] = b[i] - eps
+                numeric[i] = (plus - cost()) / (2.0 * eps)
+                p[i] = b[i]
+            assert_true(numpy.allclose(grad, numeric, rtol=1e-4, atol=1e-7))
+
+    def test_MeanSquaredError(self):
+        self._check(MLPR(layers=[L("Tanh", units=5), L("Linear")],
+                         learning_rule='sgd', regularize='L2', weight_decay=0.01))
+
+    def test_CrossEntropySoftmax(self):
+        self._check(MLPR(layers=[L("Sigmoid", units=5), L("Softmax")], loss_type='mcc',
+                         learning_rule='sgd', regularize='L2', weight_decay=0.01))
+
+    def test_CrossEntropySigmoid(self):
+        self._check(MLPR(layers=[L("Rectifier", units=5), L("Sigmoid")], loss_type='mcc',
+                         learning_rule='sgd', regularize='L2', weight_decay=0.01))
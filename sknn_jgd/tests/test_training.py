@@ -1,8 +1,10 @@
 import unittest
-from nose.tools import (assert_in, assert_raises, assert_equals)
+from nose.tools import (assert_in, assert_raises, assert_equals, assert_true)
 
 import io
+import os
 import logging
+import tempfile
 
 import numpy
 from sknn.mlp import MultiLayerPerceptron as MLP
@@ -12,6 +14,11 @@ from sknn.mlp import Layer as L
 
 import sknn.mlp
 
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
 
 class TestTrainingProcedure(unittest.TestCase):
 
@@ -34,6 +41,18 @@ class TestTrainingProcedure(unittest.TestCase):
 
         self.nn._fit(a_in, a_out)
         
+    def test_SnapshotReusesArrays(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.ones((8,4))
+        self.nn = MLP(layers=[L("Linear")], learning_rate=0.01, n_iter=1)
+        self.nn._fit(a_in, a_out)
+        first = self.nn._backend._mlp_snapshot()
+        arrays = [d for data in first for d in data]
+        self.nn._fit(a_in, a_out)
+        second = self.nn._backend._mlp_snapshot(first)
+        assert_true(all(a is b for a, b in zip(arrays, [d for data in second for d in data])))
+        for a, b in zip(arrays, [d for data in self.nn._backend._mlp_to_array() for d in data]):
+            assert_true(numpy.array_equal(a, b))
+
     def test_TrainingInfinite(self):
         a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
         self.nn = MLP(layers=[L("Linear")], n_iter=None, n_stable=None)
@@ -53,6 +72,105 @@ class TestTrainingProcedure(unittest.TestCase):
         assert_equals(self.counter, 1)
 
 
+class TestEvaluationCadence(unittest.TestCase):
+
+    def setUp(self):
+        self.errors = []
+
+    def _store(self, i, avg_train_obj_error, avg_valid_error, **_):
+        self.errors.append((i, avg_train_obj_error, avg_valid_error))
+
+    def test_EvaluateEveryFewEpochs(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn = MLP(layers=[L("Linear")], n_iter=5, n_stable=None, eval_every=2,
+                 valid_size=0.25, callback={'on_epoch_finish': self._store})
+        nn._fit(a_in, a_out)
+        evaluated = [i for i, t, v in self.errors if t is not None and v is not None]
+        skipped = [i for i, t, v in self.errors if t is None and v is None]
+        assert_equals([2, 4, 5], evaluated)
+        assert_equals([1, 3], skipped)
+
+    def test_EvaluateSubsample(self):
+        a_in, a_out = numpy.zeros((16,16)), numpy.zeros((16,4))
+        nn = MLP(layers=[L("Linear")], n_iter=1, eval_subsample=4)
+        X, y = nn._eval_subsample(a_in, a_out)
+        assert_equals(4, X.shape[0])
+        assert_equals(4, y.shape[0])
+        nn._fit(a_in, a_out)
+
+    @unittest.skipIf(pandas is None, 'pandas not installed')
+    def test_EvaluateSubsampleDataFrame(self):
+        a_in = numpy.random.uniform(size=(16,16))
+        a_out = numpy.random.uniform(size=(16,4))
+        nn = MLP(layers=[L("Linear")], n_iter=3, eval_subsample=4, random_state=1,
+                 callback={'on_epoch_finish': self._store})
+        X, y = nn._eval_subsample(pandas.DataFrame(a_in), pandas.DataFrame(a_out))
+        X_a, y_a = nn._eval_subsample(a_in, a_out)
+        assert_true(numpy.array_equal(X_a, numpy.asarray(X)))
+        assert_true(numpy.array_equal(y_a, numpy.asarray(y)))
+        nn._fit(pandas.DataFrame(a_in), pandas.DataFrame(a_out))
+        assert_true(all(t is not None for _, t, _ in self.errors))
+
+    def test_StableCountsEvaluations(self):
+        a_in, a_out = numpy.zeros((8,16)), numpy.zeros((8,4))
+        nn = MLP(layers=[L("Linear")], learning_rate=0.001, n_iter=12,
+                 n_stable=2, f_stable=0.0, eval_every=3, valid_set=(a_in, a_out),
+                 callback={'on_epoch_finish': self._store})
+        nn._fit(a_in, a_out)
+        assert_equals(0, self.errors[-1][0] % 3)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.epochs = []
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'nn.ckpt')
+        self.a_in, self.a_out = numpy.random.uniform(size=(32,4)), numpy.random.uniform(size=(32,2))
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        os.rmdir(os.path.dirname(self.checkpoint))
+
+    def _store(self, i, **_):
+        self.epochs.append(i)
+
+    def _stop_after(self, n):
+        def stop(i, **_):
+            self.epochs.append(i)
+            return i < n
+        return stop
+
+    def _build(self, callback):
+        return MLPR(layers=[L("Linear")], learning_rule='momentum', n_iter=6, random_state=1,
+                    valid_size=0.25, checkpoint=self.checkpoint, checkpoint_every=3,
+                    callback={'on_epoch_finish': callback})
+
+    def test_ResumeMatchesUninterrupted(self):
+        numpy.random.seed(0)
+        nn = self._build(self._store)
+        nn.fit(self.a_in, self.a_out)
+        expected = nn.get_parameters()
+
+        numpy.random.seed(0)
+        self._build(self._stop_after(4)).fit(self.a_in, self.a_out)
+        assert_equals(3, self._build(self._store).read_checkpoint()['i'])
+
+        self.epochs = []
+        nn = self._build(self._store)
+        nn.fit(self.a_in, self.a_out, resume=True)
+        assert_equals([4, 5, 6], self.epochs)
+        for e, p in zip(expected, nn.get_parameters()):
+            assert_true(numpy.allclose(e.weights, p.weights))
+            assert_true(numpy.allclose(e.biases, p.biases))
+
+    def test_ResumeWithoutCheckpoint(self):
+        nn = self._build(self._store)
+        assert_equals(None, nn.read_checkpoint())
+        nn.fit(self.a_in, self.a_out, resume=True)
+        assert_equals([1, 2, 3, 4, 5, 6], self.epochs)
+
+
 class TestBatchSize(unittest.TestCase):
 
     def setUp(self):
@@ -63,7 +181,10 @@ class TestBatchSize(unittest.TestCase):
                     learning_rate=0.001, n_iter=1,
                     callback={'on_batch_start': self.on_batch_start})
 
-    def on_batch_start(self, Xb, **args):
+    def on_batch_start(self, Xb, mode, **args):
+        # Only count the training batches, not those of the evaluation passes.
+        if mode != 'train':
+            return
         self.batch_count += 1
         self.batch_items += Xb.shape[0]
         assert Xb.shape[0] <= self.nn.batch_size
@@ -89,6 +210,14 @@ class TestBatchSize(unittest.TestCase):
         assert_equals(3, self.batch_count)
         assert_equals(9, self.batch_items)
 
+    def test_BatchSizePrefetch(self):
+        self.nn.batch_size = 4
+        self.nn.prefetch = 2
+        a_in, a_out = numpy.zeros((9,16)), numpy.ones((9,4))
+        self.nn._fit(a_in, a_out)
+        assert_equals(3, self.batch_count)
+        assert_equals(9, self.batch_items)
+
 
 class TestCustomLogging(unittest.TestCase):
 
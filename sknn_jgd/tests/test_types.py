@@ -6,19 +6,32 @@ import random
 import shutil
 import tempfile
 
+import sys
 import numpy
-import pandas
-import theano
 import scipy.sparse
 
+import sknn
 from sknn.mlp import MultiLayerPerceptron as MLP
 from sknn.mlp import Layer as L, Convolution as C
 
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
 
 # Sparse matrix must support indexing.  Other types but these do not work for this reason.
 SPARSE_TYPES = ['csr_matrix', 'csc_matrix', 'dok_matrix', 'lil_matrix']
 
 
+def set_floatX(dtype):
+    # Without Theano, the NumPy backend takes the type from `THEANO_FLAGS` instead.
+    if 'theano' in sys.modules:
+        sys.modules['theano'].config.floatX = dtype
+    else:
+        os.environ['THEANO_FLAGS'] = 'floatX=' + dtype
+
+
 class TestScipySparseMatrix(unittest.TestCase):
 
     def setUp(self):
@@ -62,7 +75,7 @@ class TestScipySparseMatrix(unittest.TestCase):
             assert_equal(8, self.count)
 
     def test_Predict64(self):
-        theano.config.floatX = 'float64'
+        set_floatX('float64')
         for t in SPARSE_TYPES:
             sparse_matrix = getattr(scipy.sparse, t)
             X = sparse_matrix((8, 4), dtype=numpy.float64)
@@ -70,7 +83,7 @@ class TestScipySparseMatrix(unittest.TestCase):
             assert_equal(yp.dtype, numpy.float64)
 
     def test_Predict32(self):
-        theano.config.floatX = 'float32'
+        set_floatX('float32')
         for t in SPARSE_TYPES:
             sparse_matrix = getattr(scipy.sparse, t)
             X = sparse_matrix((8, 4), dtype=numpy.float32)
@@ -95,18 +108,19 @@ class TestMemoryMap(unittest.TestCase):
 
     def test_FitAllTypes(self):
         for t in self.__types__:
-            theano.config.floatX = t
+            set_floatX(t)
             X = self.make('X', (12, 3), dtype=t)
             y = self.make('y', (12, 3), dtype=t)
             self.nn._fit(X, y)
 
     def test_PredictAllTypes(self):
         for t in self.__types__:
-            theano.config.floatX = t
+            set_floatX(t)
             X = self.make('X', (12, 3), dtype=t)
             yp = self.nn._predict(X)
 
 
+@unittest.skipIf(pandas is None, 'pandas not installed')
 class TestPandasDataFrame(TestMemoryMap):
     
     __types__ = ['float32']
@@ -115,6 +129,7 @@ class TestPandasDataFrame(TestMemoryMap):
         return pandas.DataFrame(numpy.random.uniform(-1.0, 1.0, size=shape), dtype=dtype)
 
 
+@unittest.skipIf(sknn.backend.name != 'lasagne', 'only lasagne')
 class TestConvolution(unittest.TestCase):
 
     def setUp(self):
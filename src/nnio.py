@@ -1,10 +1,20 @@
 import src.nnload as nnload
+from sknn_jgd.predict import Predictor
 from netCDF4 import Dataset
 import numpy as np
+import collections
+import glob
+import itertools
+import multiprocessing
+import os
 import pickle
+import resource
+import time
 
 
-def build_training_dataset(expt, t_step, t_beg, t_end, N_lon_samp=5):
+def build_training_dataset(expt, t_step, t_beg, t_end, N_lon_samp=5,
+                           randseed=None, n_workers=1, worker_mem_gb=None,
+                           filename=None, chunk_samples=256):
     """Builds training, testing, and cross-validation datasets from an
        idealized GCM run folder. Assumes tendencies are stored for
        instantaneous values once per day. Also assumes T42 resolution
@@ -13,6 +23,10 @@ def build_training_dataset(expt, t_step, t_beg, t_end, N_lon_samp=5):
        Note that because of the way the data is now stored, we no longer need
        to do any sort of shifting. Temperatures and humidities are explicitly
        stored before convection is called.
+       All of the data is written to a single compressed netCDF4 training
+       store (see create_training_store) one history file at a time, so only
+       one file's worth of data is ever held in memory. Use
+       nnload.store_path to point LoadData at a given target and split of it.
     Args:
      expt (str): Path to the experiment folder
      t_step (int): Number of days between when each file is saved
@@ -20,156 +34,313 @@ def build_training_dataset(expt, t_step, t_beg, t_end, N_lon_samp=5):
      t_end (int): Date of last time being saved
      N_lon_samp (int): Number of random longitude samples to take at each lat
                        at each time step. Default value is 5 (T42 resolution)
+     randseed (int): Seed for the longitude sampling and the train/test/valid
+                     split. Each file is sampled from its own random stream
+                     derived from this seed, so a given seed gives identical
+                     output for any number of workers.
+     n_workers (int): Number of processes used to read and sample the history
+                      files. 1 (default) reads them serially in this process
+     worker_mem_gb (float): If set, cap the address space of each worker
+                            process at this many GB
+     filename (str): Name of the store to write. Defaults to
+                     './<expt>_training_store.nc'
+     chunk_samples (int): Number of samples per chunk along the sample axis
+    Returns:
+     str: Name of the store that was written
     """
     file_days = np.arange(t_beg, t_end, t_step)  # file_days = [1010]
     N_files = np.size(file_days)
-    # Hardcoded values here
-    N_lev = 30
-    N_lat = 64
-    N_lon = 128
-    # Initialize
-    Tin = np.zeros((t_step, N_lev, N_lat, N_lon_samp, N_files))
-    qin = np.zeros((t_step, N_lev, N_lat, N_lon_samp, N_files))
-    Tout = np.zeros((t_step, N_lev, N_lat, N_lon_samp, N_files))
-    qout = np.zeros((t_step, N_lev, N_lat, N_lon_samp, N_files))
-    Pout = np.zeros((t_step, N_lat, N_lon_samp, N_files))
-    Tout_all = np.zeros((t_step, N_lev, N_lat, N_lon_samp, N_files))
-    qout_all = np.zeros((t_step, N_lev, N_lat, N_lon_samp, N_files))
-    Pout_all = np.zeros((t_step, N_lat, N_lon_samp, N_files))
+    if filename is None:
+        filename = './' + expt + '_training_store.nc'
+    # Draw a seed for every file up front so that the samples taken from a
+    # file do not depend on which process reads it or in what order
+    rng = np.random.RandomState(randseed)
+    seeds = rng.randint(0, 2**31 - 1, N_files)
+    tasks = [(_history_filename(expt, file_day), t_step, N_lon_samp, seed)
+             for file_day, seed in zip(file_days, seeds)]
+    ncfile = None
+    N_samp = 0
     # Loop over files in experiment folder (assumes stats stored daily)
-    for i, file_day in enumerate(file_days):
-        # Initialzie
-        zTin = np.zeros((t_step, N_lev, N_lat, N_lon))
-        zqin = np.zeros((t_step, N_lev, N_lat, N_lon))
-        zTout = np.zeros((t_step, N_lev, N_lat, N_lon))
-        zqout = np.zeros((t_step, N_lev, N_lat, N_lon))
-        zPout = np.zeros((t_step, N_lat, N_lon))
-        zTout_all = np.zeros((t_step, N_lev, N_lat, N_lon))
-        zqout_all = np.zeros((t_step, N_lev, N_lat, N_lon))
-        zPout_all = np.zeros((t_step, N_lat, N_lon))
-        # Get filename
-        filename = '/glade/u/home/jdwyer/scratch/fms_output/' + \
-            expt + '/history/day' + \
-            str(file_day).zfill(4) + 'h00/day' + \
-            str(file_day).zfill(4) + 'h00.1xday.nc'
-        print(filename)
-        # Open file and grab variables from it
-        f = Dataset(filename, mode='r')
-        # N_time x N_lev x N_lat x N_lon
-        zTin = f.variables['t_intermed'][:]
-        zqin = f.variables['q_intermed'][:]
-        zTout = f.variables['dt_tg_convection'][:]
-        zqout = f.variables['dt_qg_convection'][:]
-        zPout = f.variables['convection_rain'][:]  # N_time x N_lat x N_lon
-        zTout_all = zTout + f.variables['dt_tg_condensation'][:]
-        zqout_all = zqout + f.variables['dt_qg_condensation'][:]
-        zPout_all = zPout + f.variables['condensation_rain'][:]
-        lat = f.variables['lat'][:]
-        f.close()
-        # N_time x N_lev x N_lat x N_lon ->
-        # N_time x N_lev x N_lat x N_lon x N_file
-        # Loop over time steps in a given file
-        for k in range(zTin.shape[0]):
-            # Loop over latitudes
-            for j in range(zTin.shape[2]):
-                # Randomly choose a few longitudes
-                ind_lon = np.random.randint(0, zTin.shape[3], N_lon_samp)
-                # Numpy has some strange behavior when indexing and slicing are
-                # combined. See: http://stackoverflow.com/q/27094438
-                Tin[k, :, j, :, i] = zTin[k, :, j, :][:, ind_lon]
-                qin[k, :, j, :, i] = zqin[k, :, j, :][:, ind_lon]
-                Tout[k, :, j, :, i] = zTout[k, :, j, :][:, ind_lon]
-                qout[k, :, j, :, i] = zqout[k, :, j, :][:, ind_lon]
-                Tout_all[k, :, j, :, i] = zTout_all[k, :, j, :][:, ind_lon]
-                qout_all[k, :, j, :, i] = zqout_all[k, :, j, :][:, ind_lon]
-                Pout[k, j, :, i] = zPout[k, j, ind_lon]
-                Pout_all[k, j, :, i] = zPout_all[k, j, ind_lon]
-    # Permute arrays to be N_lev x N_lat x N_lon_samp x N_file x N_time
-    permute = [1, 2, 3, 4, 0]
-    Tin = np.transpose(Tin, permute)
-    qin = np.transpose(qin, permute)
-    Tout = np.transpose(Tout, permute)
-    qout = np.transpose(qout, permute)
-    Tout_all = np.transpose(Tout_all, permute)
-    qout_all = np.transpose(qout_all, permute)
-    permute = [1, 2, 3, 0]
-    Pout = np.transpose(Pout, permute)
-    Pout_all = np.transpose(Pout_all, permute)
-    # Reshape array to be N_lev x N_lat x t_step*N_samp*N_file
-    Tin = np.reshape(Tin, (N_lev, N_lat, -1))
-    qin = np.reshape(qin, (N_lev, N_lat, -1))
-    Tout = np.reshape(Tout, (N_lev, N_lat, -1))
-    qout = np.reshape(qout, (N_lev, N_lat, -1))
-    Pout = np.reshape(Pout, (N_lat, -1))
-    Tout_all = np.reshape(Tout_all, (N_lev, N_lat, -1))
-    qout_all = np.reshape(qout_all, (N_lev, N_lat, -1))
-    Pout_all = np.reshape(Pout_all, (N_lat, -1))
-    # Convert heating rates from K/s to K/day and from kg/kg/s to g/kg/day
-    Tout = Tout * 3600 * 24
-    qout = qout * 3600 * 24 * 1000
-    Tout_all = Tout_all * 3600 * 24
-    qout_all = qout_all * 3600 * 24 * 1000
-    # Convert precip from kg/m/m/s to mm/day
-    Pout = Pout * 3600 * 24
-    Pout_all = Pout_all * 3600 * 24
-    # Shuffle data and store it in separate training and validation files
-    N_trn_exs = Tin.shape[2]
-    randinds = np.random.permutation(N_trn_exs)
+    for block in _map_files(_sample_history_file, tasks, n_workers,
+                            worker_mem_gb):
+        Tin, qin, Tout, qout, Pout, Tout_all, qout_all, Pout_all, lat = block
+        if ncfile is None:
+            ncfile = create_training_store(filename, lat, Tin.shape[1],
+                                           chunk_samples=chunk_samples)
+        # Convert heating rates from K/s to K/day and from kg/kg/s to g/kg/day
+        Tout = Tout * 3600 * 24
+        qout = qout * 3600 * 24 * 1000
+        Tout_all = Tout_all * 3600 * 24
+        qout_all = qout_all * 3600 * 24 * 1000
+        # Convert precip from kg/m/m/s to mm/day
+        Pout = Pout * 3600 * 24
+        Pout_all = Pout_all * 3600 * 24
+        # Append the samples from this file to the store
+        N_new = Tin.shape[0] * Tin.shape[-1]
+        fields = {'Tin': Tin, 'qin': qin, 'Tout_conv': Tout,
+                  'qout_conv': qout, 'Pout_conv': Pout,
+                  'Tout_convcond': Tout_all, 'qout_convcond': qout_all,
+                  'Pout_convcond': Pout_all}
+        for var, z in fields.items():
+            ncfile.variables[var][..., N_samp:N_samp + N_new] = \
+                _block_to_samples(z)
+        N_samp = N_samp + N_new
+    # Shuffle data and store separate training, testing and validation indices
+    randinds = rng.permutation(N_samp)
     i70 = int(0.7*np.size(randinds))
     i90 = int(0.9*np.size(randinds))
-    randind_trn = randinds[:i70]
-    randind_tst = randinds[i70:i90]
-    randind_vld = randinds[i90:]
-    # Store the data in files
-    # For convection-only learning
-    pickle.dump([Tin[:, :, randind_trn], qin[:, :, randind_trn],
-                 Tout[:, :, randind_trn], qout[:, :, randind_trn],
-                 Pout[:, randind_trn], lat],
-                open('./' + expt + '_conv_training.pkl', 'wb'))
-    pickle.dump([Tin[:, :, randind_tst], qin[:, :, randind_tst],
-                 Tout[:, :, randind_tst], qout[:, :, randind_tst],
-                 Pout[:, randind_tst], lat],
-                open('./' + expt + '_conv_testing.pkl', 'wb'))
-    pickle.dump([Tin[:, :, randind_vld], qin[:, :, randind_vld],
-                 Tout[:, :, randind_vld], qout[:, :, randind_vld],
-                 Pout[:, randind_vld], lat],
-                open('./' + expt + '_conv_validation.pkl', 'wb'))
-    # For convection + condensation learning
-    pickle.dump([Tin[:, :, randind_trn], qin[:, :, randind_trn],
-                 Tout_all[:, :, randind_trn], qout_all[:, :, randind_trn],
-                 Pout_all[:, randind_trn], lat],
-                open('./' + expt + '_convcond_training.pkl', 'wb'))
-    pickle.dump([Tin[:, :, randind_tst], qin[:, :, randind_tst],
-                 Tout_all[:, :, randind_tst], qout_all[:, :, randind_tst],
-                 Pout_all[:, randind_tst], lat],
-                open('./' + expt + '_convcond_testing.pkl', 'wb'))
-    pickle.dump([Tin[:, :, randind_vld], qin[:, :, randind_vld],
-                 Tout_all[:, :, randind_vld], qout_all[:, :, randind_vld],
-                 Pout_all[:, randind_vld], lat],
-                open('./' + expt + '_convcond_validation.pkl', 'wb'))
+    write_store_split(ncfile, 'training', randinds[:i70])
+    write_store_split(ncfile, 'testing', randinds[i70:i90])
+    write_store_split(ncfile, 'validation', randinds[i90:])
+    ncfile.close()
+    return filename
+
+
+def create_training_store(filename, lat, N_lev, chunk_samples=256):
+    """Creates an empty training store: a netCDF4 file holding the inputs
+       once and the targets for both convection only (conv) and convection +
+       condensation (convcond), with an unlimited sample axis that is chunked
+       and compressed. Variables are N_lev x N_lat x N_samples (Tin, qin,
+       Tout_<target>, qout_<target>) or N_lat x N_samples (Pout_<target>),
+       matching the layout of the old training pickles."""
+    ncfile = Dataset(filename, 'w', format='NETCDF4')
+    ncfile.createDimension('lev', N_lev)
+    ncfile.createDimension('lat', len(lat))
+    ncfile.createDimension('sample', None)
+    nc_lat = ncfile.createVariable('lat', np.dtype('float64').char, ('lat'))
+    nc_lat[:] = lat
+    chunks3d = (N_lev, len(lat), chunk_samples)
+    for var, units in [('Tin', 'K'), ('qin', 'kg/kg'),
+                       ('Tout_conv', 'K/day'), ('qout_conv', 'g/kg/day'),
+                       ('Tout_convcond', 'K/day'),
+                       ('qout_convcond', 'g/kg/day')]:
+        nc_var = ncfile.createVariable(var, np.dtype('float64').char,
+                                       ('lev', 'lat', 'sample'), zlib=True,
+                                       chunksizes=chunks3d)
+        nc_var.units = units
+    for var in ['Pout_conv', 'Pout_convcond']:
+        nc_var = ncfile.createVariable(var, np.dtype('float64').char,
+                                       ('lat', 'sample'), zlib=True,
+                                       chunksizes=chunks3d[1:])
+        nc_var.units = 'mm/day'
+    return ncfile
+
+
+def write_store_split(ncfile, split, ind):
+    """Stores the (shuffled) sample indices that make up one split"""
+    ncfile.createDimension('N_' + split, len(ind))
+    nc_ind = ncfile.createVariable('ind_' + split, np.dtype('int64').char,
+                                   ('N_' + split))
+    nc_ind[:] = ind
+
+
+def _block_to_samples(z):
+    # t_step x [N_lev x] N_lat x N_lon_samp -> [N_lev x] N_lat x
+    # N_lon_samp*t_step
+    z = np.moveaxis(z, 0, -1)
+    return np.reshape(z, z.shape[:-2] + (-1,))
+
+
+def _history_filename(expt, file_day):
+    return '/glade/u/home/jdwyer/scratch/fms_output/' + \
+        expt + '/history/day' + \
+        str(file_day).zfill(4) + 'h00/day' + \
+        str(file_day).zfill(4) + 'h00.1xday.nc'
+
+
+def _sample_history_file(task):
+    """Reads one daily history file and randomly samples N_lon_samp
+       longitudes at every time step and latitude. Returns the sampled
+       Tin, qin, Tout, qout, Pout, Tout_all, qout_all, Pout_all (each
+       t_step x [N_lev x] N_lat x N_lon_samp) and lat"""
+    filename, t_step, N_lon_samp, seed = task
+    rng = np.random.RandomState(seed)
+    print(filename)
+    # Open file and grab variables from it
+    f = Dataset(filename, mode='r')
+    # N_time x N_lev x N_lat x N_lon
+    zTin = f.variables['t_intermed'][:]
+    zqin = f.variables['q_intermed'][:]
+    zTout = f.variables['dt_tg_convection'][:]
+    zqout = f.variables['dt_qg_convection'][:]
+    zPout = f.variables['convection_rain'][:]  # N_time x N_lat x N_lon
+    zTout_all = zTout + f.variables['dt_tg_condensation'][:]
+    zqout_all = zqout + f.variables['dt_qg_condensation'][:]
+    zPout_all = zPout + f.variables['condensation_rain'][:]
+    lat = f.variables['lat'][:]
+    f.close()
+    # Randomly choose a few longitudes at every time step and latitude
+    ind_lon = draw_lon_indices(rng, zTin.shape[0], zTin.shape[2],
+                               zTin.shape[3], N_lon_samp)
+    block = []
+    for z in [zTin, zqin, zTout, zqout, zPout, zTout_all, zqout_all,
+              zPout_all]:
+        zs = np.zeros((t_step,) + z.shape[1:-1] + (N_lon_samp,))
+        zs[:z.shape[0]] = sample_longitudes(z, ind_lon)
+        block.append(zs)
+    return tuple(block) + (lat,)
+
+
+def draw_lon_indices(rng, N_time, N_lat, N_lon, N_lon_samp):
+    """Draws N_lon_samp random longitude indices for every time step and
+       latitude (N_time x N_lat x N_lon_samp). The draws come out of rng in
+       the same order as calling rng.randint(0, N_lon, N_lon_samp) in a loop
+       over time and then latitude"""
+    return rng.randint(0, N_lon, (N_time, N_lat, N_lon_samp))
+
+
+def sample_longitudes(z, ind_lon):
+    """Gathers the longitudes in ind_lon (N_time x N_lat x N_lon_samp) from z.
+       Latitude and longitude are flattened together so that each time step
+       is a single np.take over all levels and latitudes.
+    Args:
+     z: N_time x N_lev x N_lat x N_lon or N_time x N_lat x N_lon array
+     ind_lon: Longitude indices, e.g. from draw_lon_indices
+    Returns:
+     N_time x N_lev x N_lat x N_lon_samp or N_time x N_lat x N_lon_samp array
+    """
+    N_time, N_lat, N_lon_samp = ind_lon.shape
+    # Index into the flattened N_lat*N_lon axis
+    ind_flat = ind_lon + (np.arange(N_lat) * z.shape[-1])[None, :, None]
+    z = np.reshape(z, z.shape[:-2] + (-1,))
+    out = np.empty(z.shape[:-1] + (N_lat, N_lon_samp))
+    for k in range(N_time):
+        out[k] = np.take(z[k], ind_flat[k], axis=-1)
+    return out
+
+
+def _sample_longitudes_loop(z, ind_lon):
+    # Reference implementation: the per (time, lat) loop that
+    # sample_longitudes replaces
+    out = np.zeros(z.shape[:-1] + (ind_lon.shape[2],))
+    for k in range(ind_lon.shape[0]):
+        for j in range(ind_lon.shape[1]):
+            if z.ndim == 3:
+                out[k, j, :] = z[k, j, ind_lon[k, j]]
+            else:
+                out[k, :, j, :] = z[k, :, j, :][:, ind_lon[k, j]]
+    return out
+
+
+def benchmark_lon_sampling(N_time=1, N_lev=30, N_lat=64, N_lon=128,
+                           N_lon_samp=5, n_repeat=20):
+    """Times sample_longitudes against the loop it replaced on random data
+       shaped like one T42 history file (8 variables, as in ingest)"""
+    rng = np.random.RandomState(0)
+    fields = [rng.randn(N_time, N_lev, N_lat, N_lon) for _ in range(6)] + \
+        [rng.randn(N_time, N_lat, N_lon) for _ in range(2)]
+    ind_lon = draw_lon_indices(rng, N_time, N_lat, N_lon, N_lon_samp)
+    timings = dict()
+    for name, kernel in [('loop', _sample_longitudes_loop),
+                         ('vectorized', sample_longitudes)]:
+        start = time.time()
+        for _ in range(n_repeat):
+            out = [kernel(z, ind_lon) for z in fields]
+        timings[name] = (time.time() - start) / n_repeat
+        timings[name + '_out'] = out
+    for a, b in zip(timings['loop_out'], timings['vectorized_out']):
+        if not np.array_equal(a, b):
+            raise ValueError('Vectorized sampling does not match the loop!')
+    print('Loop: {:.2f} ms/file, vectorized: {:.2f} ms/file ({:.1f}x)'.
+          format(1e3 * timings['loop'], 1e3 * timings['vectorized'],
+                 timings['loop'] / timings['vectorized']))
+    return timings['loop'], timings['vectorized']
+
+
+def _map_files(func, tasks, n_workers=1, worker_mem_gb=None):
+    """Applies func to each task, yielding results in task order. Uses a pool
+       of n_workers processes if n_workers > 1. At most n_workers tasks are
+       run ahead of the consumer, so that finished results do not pile up in
+       memory when it is slower than the workers"""
+    if n_workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    pool = multiprocessing.Pool(n_workers, initializer=_limit_worker_memory,
+                                initargs=(worker_mem_gb,))
+    try:
+        tasks = iter(tasks)
+        pending = collections.deque(
+            pool.apply_async(func, (task,))
+            for task in itertools.islice(tasks, n_workers))
+        while pending:
+            out = pending.popleft().get()
+            # Keep the workers busy while the result is consumed
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(func, (task,)))
+            yield out
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _limit_worker_memory(worker_mem_gb):
+    if worker_mem_gb is not None:
+        nbytes = int(worker_mem_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+
+
+def migrate_training_pickle(filename, dirname=None, verify=True):
+    """Converts a (python2-era, latin1) training pickle into the memory-mapped
+       format read by nnload.LoadData, so it only has to be unpickled once.
+       The checksum, shape and dtype of every array are recorded in the
+       header of the new copy.
+    Args:
+     filename (str): Training pickle, e.g. './data/conv_training_v3.pkl'
+     dirname (str): Output directory. Defaults to nnload.mmap_path(filename)
+     verify (bool): Read the written data back and check that it is
+                    bit-for-bit identical to the pickle
+    Returns:
+     str: Output directory
+    """
+    if dirname is None:
+        dirname = nnload.mmap_path(filename)
+    print('Migrating ' + filename + ' -> ' + dirname)
+    data = nnload.load_raw_data(filename)
+    expected = [(np.shape(z), np.asarray(z).dtype.str,
+                 nnload.array_checksum(z)) for z in data]
+    header = nnload.write_mmap_data(dirname, *data, source=filename)
+    del data
+    if verify:
+        for var, (shape, dtype, checksum) in zip(nnload.MMAP_VARS, expected):
+            info = header['variables'][var]
+            if (tuple(info['shape']) != shape or info['dtype'] != dtype):
+                raise ValueError('Shape or dtype of ' + var + ' changed ' +
+                                 'while migrating ' + filename)
+        nnload.verify_mmap_data(dirname, [e[2] for e in expected])
+        print('Verified ' + dirname)
+    return dirname
+
+
+def migrate_training_pickles(datadir='./data/', pattern='*_v3.pkl',
+                             overwrite=False, verify=True):
+    """Migrates every training pickle in datadir matching pattern. Pickles
+       that already have a memory-mapped copy are skipped unless overwrite is
+       true (their existing copy is still verified against its header)"""
+    dirnames = []
+    for filename in sorted(glob.glob(os.path.join(datadir, pattern))):
+        dirname = nnload.mmap_path(filename)
+        if os.path.exists(dirname) and not overwrite:
+            print('Already migrated: ' + filename)
+            if verify:
+                nnload.verify_mmap_data(dirname)
+        else:
+            migrate_training_pickle(filename, dirname, verify=verify)
+        dirnames.append(dirname)
+    return dirnames
 
 
 def write_netcdf_v4():
     mlp_str = 'X-StandardScaler-qTindi_Y-SimpleY-qTindi_' + \
         'Ntrnex100000_r_100R_mom0.9reg1e-06_Niter10000_v3'
-    datasource = './data/conv_training_v3.pkl'
     # Set output filename
     output_filename = './neural_weights_v4.nc'
     # Load ANN and preprocessors
     mlp, _, errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev = \
         pickle.load(open('./data/regressors/' + mlp_str + '.pkl', 'rb'))
-    # Need to transform some data for preprocessors to be able to export params
-    x_unscl, y_unscl, _, _, _, _, _, _ = nnload.LoadData(datasource,
-                                                         minlev=min(lev))
-    x_scl = nnload.transform_data(x_ppi, x_pp, x_unscl)
-    _ = nnload.transform_data(y_ppi, y_pp, y_unscl)
-    # Also need to use the predict method to be able to export ANN params
-    _ = mlp.predict(x_scl)
-    # Grab weights and input normalization
-    w1 = mlp.get_parameters()[0].weights
-    w2 = mlp.get_parameters()[1].weights
-    b1 = mlp.get_parameters()[0].biases
-    b2 = mlp.get_parameters()[1].biases
+    # Grab weights and input normalization (the pickled weights are read
+    # directly, so the network does not need to be built to export them)
+    (w1, b1), (w2, b2) = Predictor.from_mlp(mlp).weights
     xscale_mean = x_pp.mean_
     xscale_stnd = x_pp.scale_
     Nlev = len(lev)
@@ -217,47 +388,18 @@ def write_netcdf_ensemble1():
     base1 = 'X-StandardScaler-qTindi_Y-SimpleY-qTindi_Ntrnex'
     base2 = '_r_50R_mom0.9reg1e-06_Niter3000_v3'
     mlp_str = [base1 + str(ntrn) + base2 for ntrn in ntrns]
-    N_e = len(mlp_str)
-    datasource = './data/conv_training_v3.pkl'
     # Set output filename
     filename = '/Users/jgdwyer/neural_weights_ensemble1.nc'
-    # Load ANN and preprocessors
-    yscale_absmax = np.zeros((32, len(mlp_str)))
-    w1 = np.zeros((32, 50, N_e))
-    w2 = np.zeros((50, 32, N_e))
-    b1 = np.zeros((50, N_e))
-    b2 = np.zeros((32, N_e))
-    xscale_mean = np.zeros((32, N_e))
-    xscale_stnd = np.zeros((32, N_e))
-    yscale_absmax = np.zeros((32, N_e))
-
-    for i in range(len(mlp_str)):
-        mlp, _, errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev = \
-            pickle.load(open('./data/regressors/' + mlp_str[i] + '.pkl', 'rb'))
-        # Need to transform some data for preprocessors to be able to export
-        # params
-        x_unscl, y_unscl, _, _, _, _, _, _ = nnload.LoadData(datasource,
-                                                             minlev=min(lev))
-        x_scl = nnload.transform_data(x_ppi, x_pp, x_unscl)
-        y_scl = nnload.transform_data(y_ppi, y_pp, y_unscl)
-        # Also need to use the predict method to be able to export ANN params
-        _ = mlp.predict(x_scl)
-        # Grab weights and input normalization
-        w1[:, :, i] = mlp.get_parameters()[0].weights
-        w2[:, :, i] = mlp.get_parameters()[1].weights
-        b1[:, i] = mlp.get_parameters()[0].biases
-        b2[:, i] = mlp.get_parameters()[1].biases
-        xscale_mean[:, i] = x_pp.mean_
-        xscale_stnd[:, i] = x_pp.scale_
-        Nlev = len(lev)
-        yscale_absmax[:Nlev, i] = y_pp[0]
-        yscale_absmax[Nlev:, i] = y_pp[1]
+    # Load ANNs and preprocessors stacked along the first axis, N_e
+    ens = nnload.load_ensemble(mlp_str)
+    (w1, b1), (w2, b2) = ens.weights
+    N_e = ens.n_members
     # Write weights to file
     ncfile = Dataset(filename, 'w')
     # Write the dimensions
-    ncfile.createDimension('N_in', w1.shape[0])
-    ncfile.createDimension('N_h1', w1.shape[1])
-    ncfile.createDimension('N_out', w2.shape[1])
+    ncfile.createDimension('N_in', w1.shape[1])
+    ncfile.createDimension('N_h1', w1.shape[2])
+    ncfile.createDimension('N_out', w2.shape[2])
     ncfile.createDimension('N_e', N_e)
     # Create variable entries in the file
     # Variables need to "reversed" to be read in by Fortran GCM code
@@ -280,37 +422,27 @@ def write_netcdf_ensemble1():
                                              ('N_e', 'N_out'))
     # Write variables and close file - transpose because fortran reads it in
     # "backwards"
-    nc_w1[:] = np.transpose(w1, (2, 1, 0))
-    nc_w2[:] = np.transpose(w2, (2, 1, 0))
-    nc_b1[:] = b1.T
-    nc_b2[:] = b2.T
-    nc_xscale_mean[:] = xscale_mean.T
-    nc_xscale_stnd[:] = xscale_stnd.T
-    nc_yscale_absmax[:] = yscale_absmax.T
+    nc_w1[:] = np.transpose(w1, (0, 2, 1))
+    nc_w2[:] = np.transpose(w2, (0, 2, 1))
+    nc_b1[:] = b1
+    nc_b2[:] = b2
+    nc_xscale_mean[:] = ens.x_center
+    nc_xscale_stnd[:] = ens.x_scale
+    nc_yscale_absmax[:] = ens.y_scale
     ncfile.close()
 
 
 def write_netcdf_convcond_v1():
     mlp_str = 'convcond_X-StandardScaler-qTindi_Y-SimpleY-qTindi_' +\
         'Ntrnex100000_r_100R_mom0.9reg1e-05_Niter10000_v3'
-    datasource = './data/convcond_training_v3.pkl'
     # Set output filename
     filename = '/Users/jgdwyer/neural_weights_convcond_v1.nc'
     # Load ANN and preprocessors
     mlp, _, errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev = \
         pickle.load(open('./data/regressors/' + mlp_str + '.pkl', 'rb'))
-    # Need to first transform some data for preprocessors to be able to export params
-    x_unscl, y_unscl, _, _, _, _, _, _ = nnload.LoadData(datasource,
-                                                         minlev=min(lev))
-    x_scl = nnload.transform_data(x_ppi, x_pp, x_unscl)
-    y_scl = nnload.transform_data(y_ppi, y_pp, y_unscl)
-    # Also need to first use the predict method to be able to export ANN params
-    _ = mlp.predict(x_scl)
-    # Grab weights and input normalization
-    w1 = mlp.get_parameters()[0].weights
-    w2 = mlp.get_parameters()[1].weights
-    b1 = mlp.get_parameters()[0].biases
-    b2 = mlp.get_parameters()[1].biases
+    # Grab weights and input normalization (the pickled weights are read
+    # directly, so the network does not need to be built to export them)
+    (w1, b1), (w2, b2) = Predictor.from_mlp(mlp).weights
     xscale_mean = x_pp.mean_
     xscale_stnd = x_pp.scale_
     Nlev = len(lev)
@@ -394,7 +526,7 @@ def verify_netcdf_weights():
     yps_byhand = np.dot(xs_byhand, w1) + b1
     yps_byhand[yps_byhand < 0] = 0
     yps_byhand = np.dot(yps_byhand, w2) + b2
-    yps = r_mlp_eval.predict(xs)
+    yps = Predictor.from_mlp(r_mlp_eval).predict(xs)
     print('Difference between predicted tendencies: {:.1f}'.
           format(np.sum(np.abs(yps - yps_byhand))))
 
@@ -425,8 +557,8 @@ def compare_convcond_prediction(cv_str, cvcd_str, minlev):
     # Derived true y-values for cond only
     ytcd_scl = ytcvcd_scl - ytcvcd_scl
     # Calculate predicted y values for conv and convcond
-    ypcv_scl = cv_mlp.predict(x_scl)
-    ypcvcd_scl = cvcd_mlp.predict(x_scl)
+    ypcv_scl = Predictor.from_mlp(cv_mlp).predict(x_scl)
+    ypcvcd_scl = Predictor.from_mlp(cvcd_mlp).predict(x_scl)
     # Add true cond values to ycv_true and ycv_pred
     v = 'q'
     mse_cvcd_predictboth = nnload.calc_mse(nnload.unpack(ypcvcd_scl, v),
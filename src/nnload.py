@@ -3,7 +3,15 @@ from sklearn import preprocessing, metrics
 import scipy.stats
 import pickle
 import warnings
+import functools
+import hashlib
+import json
+import os
+import shutil
 from netCDF4 import Dataset
+import src.nnatmos as nnatmos
+from sknn_jgd.predict import Predictor, EnsemblePredictor
+from sknn_jgd.ensemble import EnsembleRegressor
 
 
 def LoadData(filename, minlev, all_lats=True, indlat=None, N_trn_exs=None,
@@ -14,6 +22,7 @@ def LoadData(filename, minlev, all_lats=True, indlat=None, N_trn_exs=None,
 
     Args:
       filename:  The file to be loaded. e.g., './data/convcond_training_v3.pkl'
+                 or a split of a training store from store_path()
       minlev:    The topmost model level for which to load data. Set to 0. to
                  load all data
       all_lats:  Logical value for whether to load data from all latitudes
@@ -54,86 +63,353 @@ def LoadData(filename, minlev, all_lats=True, indlat=None, N_trn_exs=None,
     # Data to read in is N_lev x N_lat (SH & NH) x N_samples
     # Samples are quasi indpendent with only 5 from each latitude range chosen
     # randomly over different longitudes and times within that 24 hour period.
-    # Need to use encoding because saved using python2 on yellowstone:
-    # http://stackoverflow.com/q/28218466
     v = dict()
     [v['Tin'], v['qin'], v['Tout'], v['qout'], Pout, lat] = \
-        pickle.load(open(filename, 'rb'), encoding='latin1')
+        load_raw_data(filename)
     # Use this to calculate the real sigma levels
     lev, dlev, indlev = get_levs(minlev)
+    levs = np.flatnonzero(indlev)
     varis = ['Tin', 'qin', 'Tout', 'qout']
-    # Reshape the arrays
+    rows = training_rows(Pout, v['Tout'], lat, levs, all_lats=all_lats,
+                         indlat=indlat, N_trn_exs=N_trn_exs, rainonly=rainonly,
+                         noshallow=noshallow, cosflag=cosflag,
+                         randseed=randseed, verbose=verbose)
+    Pout = np.reshape(Pout, -1)
+    # Converted heating rates to K/day and g/kg/day in
+    # prep_convection_output.py
+    # Concatenate input and output variables together
     for var in varis:
-        # Change shape of data to be N_samp x N_lev
-        if all_lats:
-            # print('error')
-            if cosflag:
-                v[var] = reshape_cos_lats(v[var], indlev, lat)
-            else:
-                v[var] = reshape_all_lats(v[var], indlev)
-        else:
-            if indlat is not None:
-                v[var] = reshape_one_lat(v[var], indlev, indlat)
-            else:
-                raise TypeError('Need to set an index value for indlat')
-    # Also reshape precipitation
+        v[var] = gather_rows(v[var], rows, levs)
+    Pout = Pout[rows]
+    x = pack(v['Tin'], v['qin'], axis=1)
+    y = pack(v['Tout'], v['qout'], axis=1)
+    # Store when convection occurs
+    cv, _ = whenconvection(y, verbose=verbose)
+    timestep = 10*60  # 10 minute timestep in seconds
+    return x, y, cv, Pout, lat, lev, dlev, timestep
+
+
+def training_rows(Pout, Tout, lat, levs, all_lats=True, indlat=None,
+                  N_trn_exs=None, rainonly=False, noshallow=False,
+                  cosflag=True, randseed=False, verbose=True):
+    """Returns the rows of the flattened N_lat*N_samples axis that LoadData
+       loads, in the order it loads them. Arguments are as for LoadData, with
+       Pout and Tout the raw N_lat x N_samples and N_lev x N_lat x N_samples
+       data and levs the level indices"""
+    # Work out which samples to load before touching the (possibly memory-
+    # mapped) data, so that only those samples are ever gathered. Samples are
+    # indexed along the flattened N_lat*N_samples axis
+    N_ex = Pout.shape[-1]
     if all_lats:
         if cosflag:
-            Pout = reshape_cos_lats(Pout, None, lat, is_precip=True)
+            rows = cos_lat_index(lat, N_ex)
         else:
-            # Need to do a transpose to be consistent with reshape_all_lats
-            Pout = np.reshape(Pout.transpose(), -1)
+            # Same ordering as reshape_all_lats
+            rows = np.arange(Pout.size)
+            rows = (rows % len(lat)) * N_ex + rows // len(lat)
     else:
-        Pout = Pout[indlat, :]
+        if indlat is not None:
+            rows = indlat * N_ex + np.arange(N_ex)
+        else:
+            raise TypeError('Need to set an index value for indlat')
+    Pout = np.reshape(Pout, -1)
     # Randomize the order of these events
-    m = v['Tin'].shape[0]
+    m = len(rows)
     if randseed:
         np.random.seed(0)
     randind = np.random.permutation(m)
-    for var in varis:
-        v[var] = v[var][randind, :]
-    Pout = Pout[randind]
-    # Converted heating rates to K/day and g/kg/day in
-    # prep_convection_output.py
-    # Concatenate input and output variables together
-    x = pack(v['Tin'], v['qin'], axis=1)
-    y = pack(v['Tout'], v['qout'], axis=1)
-    # The outputs get lined up in prep_convection_output.py
+    rows = rows[randind]
     # Print some statistics about rain and limit to when it's raining if True
-    x, y, Pout = limitrain(x, y, Pout, rainonly, noshallow=noshallow,
-                           verbose=verbose)
+    rows = select_rows(rows, Pout, Tout, levs, rainonly=rainonly,
+                       noshallow=noshallow, N_trn_exs=N_trn_exs,
+                       verbose=verbose)
     # Limit to only certain events if requested
     if N_trn_exs is not None:
-        if N_trn_exs > y.shape[0]:
+        if N_trn_exs > len(rows):
             warnings.warn('Requested more samples than available. Using the' +
                           'maximum number available')
-            N_trn_exs = y.shape[0]
-        ind = np.arange(N_trn_exs)
-        x = x[ind, :]
-        y = y[ind, :]
-        Pout = Pout[ind]
-    # Store when convection occurs
+        rows = rows[:N_trn_exs]
+    return rows
+
+
+def LoadDataByLat(filename, minlev, N_trn_exs=None, rainonly=False,
+                  noshallow=False, randseed=False, verbose=True):
+    """Loads the samples at every latitude separately in one pass over the
+       file. The samples at each latitude are the same as those returned by
+       LoadData(all_lats=False, indlat=i) called for each latitude in turn,
+       but the file is only read once.
+
+    Args:
+      filename, minlev, rainonly, noshallow, randseed, verbose: As for
+                 LoadData
+      N_trn_exs: Number of training examples to load at each latitude
+
+    Returns:
+      x, y, cv, Pout: As for LoadData, with the samples stored latitude by
+                 latitude
+      latind  : 1-d array giving the latitude index [0-63] of each sample
+      lat, lev, dlev, timestep: As for LoadData
+    """
+    v = dict()
+    [v['Tin'], v['qin'], v['Tout'], v['qout'], Pout, lat] = \
+        load_raw_data(filename)
+    lev, dlev, indlev = get_levs(minlev)
+    levs = np.flatnonzero(indlev)
+    N_ex = Pout.shape[-1]
+    Pout = np.reshape(Pout, -1)
+    # Build the latitude to sample index, drawing the random numbers in the
+    # same order as one call to LoadData per latitude would
+    rows = []
+    for i in range(len(lat)):
+        if randseed:
+            np.random.seed(0)
+        rows_i = i * N_ex + np.random.permutation(N_ex)
+        rows_i = select_rows(rows_i, Pout, v['Tout'], levs, rainonly=rainonly,
+                             noshallow=noshallow, N_trn_exs=N_trn_exs,
+                             verbose=False)
+        rows.append(rows_i[:N_trn_exs])
+    latind = np.repeat(np.arange(len(lat)), [len(r) for r in rows])
+    rows = np.concatenate(rows)
+    for var in ['Tin', 'qin', 'Tout', 'qout']:
+        v[var] = gather_rows(v[var], rows, levs)
+    Pout = Pout[rows]
+    x = pack(v['Tin'], v['qin'], axis=1)
+    y = pack(v['Tout'], v['qout'], axis=1)
     cv, _ = whenconvection(y, verbose=verbose)
     timestep = 10*60  # 10 minute timestep in seconds
-    return x, y, cv, Pout, lat, lev, dlev, timestep
+    return x, y, cv, Pout, latind, lat, lev, dlev, timestep
+
+
+def gather_rows(z, rows, levs):
+    """Gathers samples from N_lev x N_lat x N_samples data. rows index the
+       flattened N_lat*N_samples axis and levs the levels. Returns
+       len(rows) x len(levs)"""
+    z = np.reshape(z, (z.shape[0], -1))
+    return z[np.ix_(levs, rows)].T
+
+
+def select_rows(rows, Pout, Tout, levs, rainonly=False, noshallow=False,
+                N_trn_exs=None, verbose=True, chunk_size=10000):
+    """Applies the rainonly and noshallow filters of limitrain to a list of
+       (shuffled) rows without gathering the full dataset. Pout is the
+       flattened N_lat*N_samples precipitation. The convective heating needed
+       for noshallow is gathered from Tout only in chunks of rows, and only
+       until N_trn_exs rows have been kept. Returns the rows that are kept, in
+       their original order"""
+    P = Pout[rows]
+    indrain = np.greater(P, 0)
+    if verbose:
+        print('There is some amount of rain {:.1f}% of the time'.
+              format(100. * np.sum(indrain)/len(indrain)))
+        print('There is a rate of >3 mm/day {:.1f}% of the time'.
+              format(100. * np.sum(np.greater(P, 3))/len(indrain)))
+    if rainonly:
+        rows = rows[indrain]
+        P = P[indrain]
+        if verbose:
+            print('Only looking at times it is raining!')
+    if noshallow:
+        N_keep = len(rows) if N_trn_exs is None else N_trn_exs
+        chunk_size = max(chunk_size, N_keep)
+        keep = []
+        N_kept, N_seen, N_cv = 0, 0, 0
+        for i in range(0, len(rows), chunk_size):
+            # Same test as whenconvection: any temperature tendency at all
+            cv = np.sum(np.abs(gather_rows(Tout, rows[i:i + chunk_size],
+                                           levs)), axis=1) > 0
+            indnosha = np.logical_or(P[i:i + chunk_size] > 0, ~cv)
+            keep.append(rows[i:i + chunk_size][indnosha])
+            N_kept += np.sum(indnosha)
+            N_seen += len(cv)
+            N_cv += np.sum(cv)
+            if N_kept >= N_keep:
+                break
+        rows = np.concatenate(keep) if keep else rows[:0]
+        if verbose:
+            print('There is convection {:.1f}% of the time'.
+                  format(100. * N_cv/max(N_seen, 1)))
+            print('Excluding all shallow convective events...')
+    return rows
+
+
+def load_raw_data(filename):
+    """Loads [Tin, qin, Tout, qout, Pout, lat] from a training pickle, a
+       memory-mapped data directory (see write_mmap_data) or a training store
+       path made by store_path(). Tin, qin, Tout and qout are
+       N_lev x N_lat x N_samples and Pout is N_lat x N_samples"""
+    if STORE_SEP in filename:
+        return read_training_store(*split_store_path(filename))
+    if os.path.isdir(filename):
+        return read_mmap_data(filename)
+    # Need to use encoding because saved using python2 on yellowstone:
+    # http://stackoverflow.com/q/28218466
+    return pickle.load(open(filename, 'rb'), encoding='latin1')
+
+
+MMAP_VARS = ['Tin', 'qin', 'Tout', 'qout', 'Pout', 'lat']
+
+
+def mmap_path(filename):
+    """Name of the memory-mapped data directory for a training pickle, e.g.
+       './data/conv_training_v3.pkl' -> './data/conv_training_v3.mmap'"""
+    return os.path.splitext(filename)[0] + '.mmap'
+
+
+def write_mmap_data(dirname, Tin, qin, Tout, qout, Pout, lat, source=None):
+    """Writes training data as one raw C-ordered binary file per variable plus
+       a small JSON header (header.json) giving each file's shape, dtype and
+       sha256 checksum. The arrays keep the N_lev x N_lat x N_samples layout
+       of the training pickles, so that LoadData only pages in the levels and
+       samples that it slices out."""
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    header = {'variables': dict(), 'source': source}
+    for var, z in zip(MMAP_VARS, [Tin, qin, Tout, qout, Pout, lat]):
+        z = np.ascontiguousarray(z)
+        z.tofile(os.path.join(dirname, var + '.bin'))
+        header['variables'][var] = {'file': var + '.bin',
+                                    'shape': list(z.shape),
+                                    'dtype': z.dtype.str,
+                                    'sha256': array_checksum(z)}
+    with open(os.path.join(dirname, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=1, sort_keys=True)
+    return header
+
+
+def array_checksum(z):
+    """sha256 of the C-ordered bytes of an array"""
+    return hashlib.sha256(np.ascontiguousarray(z).view(np.uint8)).hexdigest()
+
+
+def verify_mmap_data(dirname, expected=None):
+    """Checks that every variable in a memory-mapped data directory matches
+       the shape, dtype and checksum in its header and, if given, the
+       expected list of [Tin, qin, Tout, qout, Pout, lat] arrays (or of their
+       checksums). Raises ValueError on the first mismatch."""
+    header = read_mmap_header(dirname)
+    for i, (var, z) in enumerate(zip(MMAP_VARS, read_mmap_data(dirname))):
+        info = header['variables'][var]
+        checksum = array_checksum(z)
+        if checksum != info['sha256']:
+            raise ValueError('Checksum of ' + var + ' in ' + dirname +
+                             ' does not match its header')
+        if expected is None:
+            continue
+        if isinstance(expected[i], str):
+            if checksum != expected[i]:
+                raise ValueError(var + ' in ' + dirname + ' does not match ' +
+                                 'the expected checksum')
+        else:
+            zexp = np.asarray(expected[i])
+            if (z.shape != zexp.shape or z.dtype != zexp.dtype or
+                    checksum != array_checksum(zexp)):
+                raise ValueError(var + ' in ' + dirname + ' does not match ' +
+                                 'the original data')
+    return header
+
+
+def read_mmap_header(dirname):
+    with open(os.path.join(dirname, 'header.json'), 'r') as f:
+        return json.load(f)
+
+
+def read_mmap_data(dirname):
+    """Opens the variables written by write_mmap_data as read-only memory maps
+       in the same [Tin, qin, Tout, qout, Pout, lat] format as the training
+       pickles. Nothing is read from disk until the arrays are indexed."""
+    header = read_mmap_header(dirname)
+    out = []
+    for var in MMAP_VARS:
+        info = header['variables'][var]
+        out.append(np.memmap(os.path.join(dirname, info['file']),
+                             dtype=np.dtype(info['dtype']), mode='r',
+                             shape=tuple(info['shape'])))
+    return out
+
+
+STORE_SEP = '#'
+
+
+def store_path(filename, target, split):
+    """Path used to load one target ('conv' or 'convcond') and split
+       ('training', 'testing' or 'validation') of a training store written by
+       nnio.build_training_dataset, e.g. 'expt_training_store.nc#conv_testing'
+    """
+    return filename + STORE_SEP + target + '_' + split
+
+
+def split_store_path(path):
+    """Reverse of store_path. Returns filename, target and split"""
+    filename, key = path.rsplit(STORE_SEP, 1)
+    target, split = key.split('_')
+    return filename, target, split
+
+
+def read_training_store(filename, target, split, block_samples=4096):
+    """Reads one target and split of a training store in the same
+       [Tin, qin, Tout, qout, Pout, lat] format as the training pickles.
+       The store is read in contiguous blocks of block_samples samples and
+       only the samples in the split are kept, so memory use is set by the
+       size of the split rather than the size of the store."""
+    f = Dataset(filename, mode='r')
+    ind = f.variables['ind_' + split][:]
+    # Read samples in increasing order, but put them back in split order
+    order = np.argsort(ind)
+    ind_sorted = ind[order]
+    out = []
+    for var in ['Tin', 'qin', 'Tout_' + target, 'qout_' + target,
+                'Pout_' + target]:
+        out.append(_read_store_samples(f.variables[var], ind_sorted, order,
+                                       block_samples))
+    out.append(f.variables['lat'][:])
+    f.close()
+    return out
+
+
+def _read_store_samples(nc_var, ind_sorted, order, block_samples):
+    N_samp = nc_var.shape[-1]
+    z = np.empty(nc_var.shape[:-1] + (len(ind_sorted),))
+    # Position in ind_sorted where each block starts
+    bounds = np.searchsorted(ind_sorted,
+                             np.arange(0, N_samp + block_samples,
+                                       block_samples))
+    for start, i0, i1 in zip(range(0, N_samp, block_samples), bounds[:-1],
+                             bounds[1:]):
+        if i1 > i0:
+            zb = nc_var[..., start:start + block_samples]
+            z[..., order[i0:i1]] = zb[..., ind_sorted[i0:i1] - start]
+    return z
 
 
 def reshape_cos_lats(z, indlev, lat, is_precip=False):
+    """Takes the first N_samples*cos(lat) samples at each latitude and stacks
+       them latitude by latitude. Expects data to be N_lev x N_lat x N_samples
+       (or N_lat x N_samples if is_precip) and returns N x N_lev (or N)"""
+    N_ex = z.shape[-1]
+    ind = cos_lat_index(lat, N_ex)
+    # Gather from the flattened lat*sample axis in one go. Only the selected
+    # levels and samples are read, which matters for memory-mapped data
     if is_precip:
-        z = z.swapaxes(0, 1)
-        z2 = np.empty((0))
-    else:
-        z = z[indlev, :, :]
-        z = z.swapaxes(0, 2)
-        z2 = np.empty((0, sum(indlev)))
-    N_ex = z.shape[0]
-    for i, latval in enumerate(lat):
-        Ninds = int(N_ex * np.cos(np.deg2rad(latval)))
-        if is_precip:
-            z2 = np.concatenate((z2, z[0: Ninds, i]), axis=0)
-        else:
-            z2 = np.concatenate((z2, z[0:Ninds, i, :]), axis=0)
-    return z2
+        return np.take(np.reshape(z, -1), ind)
+    z = np.reshape(z, (z.shape[0], -1))
+    return z[np.ix_(np.flatnonzero(indlev), ind)].T
+
+
+def cos_lat_index(lat, N_ex):
+    """Index into the flattened N_lat*N_samples axis that picks the samples
+       used by reshape_cos_lats. Cached for each set of latitudes and number
+       of samples"""
+    return _cos_lat_index(tuple(np.asarray(lat, dtype=float)), N_ex)
+
+
+@functools.lru_cache(maxsize=16)
+def _cos_lat_index(lat, N_ex):
+    Ninds = [int(N_ex * np.cos(np.deg2rad(latval))) for latval in lat]
+    ind = np.concatenate([i * N_ex + np.arange(n) for i, n in
+                          enumerate(Ninds)])
+    # Shared between calls, so make sure it can't be changed in place
+    ind.setflags(write=False)
+    return ind
 
 
 def reshape_all_lats(z, indlev):
@@ -166,6 +442,14 @@ def unpack(data, vari, axis=1):
 
 # Initialize & fit scaler
 def init_pp(ppi, raw_data):
+    pp = _new_pp(ppi)
+    # Initialize scalers with data
+    for scaler, z in _pp_fit_data(ppi, pp, raw_data):
+        scaler.fit(z)
+    return pp
+
+
+def _new_pp(ppi):
     # Initialize list of scaler objects
     if ppi['name'] == 'MinMax':
         pp = [preprocessing.MinMaxScaler(feature_range=(-1.0, 1.0)),  # temp
@@ -182,78 +466,238 @@ def init_pp(ppi, raw_data):
     elif ppi['name'] == 'SimpleY':
         pp = [10./1., 10./2.5]  # for temperature
     else:
-        ValueError('Incorrect scaler name')
-    # Initialize scalers with data
-    if ppi['method'] == 'individually':
-        pp[0].fit(unpack(raw_data, 'T'))
-        pp[1].fit(unpack(raw_data, 'q'))
-    elif ppi['method'] == 'alltogether':
-        pp[0].fit(np.reshape(unpack(raw_data, 'T'), (-1, 1)))
-        pp[1].fit(np.reshape(unpack(raw_data, 'q'), (-1, 1)))
-    elif ppi['method'] == 'qTindividually':
-        if ppi['name'] != 'SimpleY':
-            pp = pp[0]
-            pp.fit(raw_data)
-    else:
-        raise ValueError('Incorrect scaler method')
+        raise ValueError('Incorrect scaler name')
+    if ppi['method'] == 'qTindividually' and ppi['name'] != 'SimpleY':
+        pp = pp[0]
     return pp
 
 
-# Transform data using initialized scaler
-def transform_data(ppi, pp, raw_data):
+def _pp_fit_data(ppi, pp, raw_data):
+    """Returns (scaler, data) pairs giving the data each scaler of pp is
+       fitted on"""
     if ppi['method'] == 'individually':
-        T_data = pp[0].transform(unpack(raw_data, 'T'))
-        q_data = pp[1].transform(unpack(raw_data, 'q'))
+        return [(pp[0], unpack(raw_data, 'T')), (pp[1], unpack(raw_data, 'q'))]
     elif ppi['method'] == 'alltogether':
-        T_data = pp[0].transform(np.reshape(unpack(raw_data, 'T'), (-1, 1)))
-        q_data = pp[1].transform(np.reshape(unpack(raw_data, 'q'), (-1, 1)))
-        # Return to original shape (N_samples x N_features) rather than
-        # (N_s*N_f x 1)
-        shp = unpack(raw_data, 'T').shape
-        T_data = np.reshape(T_data, shp)
-        q_data = np.reshape(q_data, shp)
+        return [(pp[0], np.reshape(unpack(raw_data, 'T'), (-1, 1))),
+                (pp[1], np.reshape(unpack(raw_data, 'q'), (-1, 1)))]
     elif ppi['method'] == 'qTindividually':
         if ppi['name'] == 'SimpleY':
-            T_data = unpack(raw_data, 'T')/pp[0]
-            q_data = unpack(raw_data, 'q')/pp[1]
-        else:
-            all_data = pp.transform(raw_data)
-            T_data = unpack(all_data, 'T')
-            q_data = unpack(all_data, 'q')
+            return []
+        return [(pp, raw_data)]
     else:
-        print('Given method is ' + ppi['method'])
         raise ValueError('Incorrect scaler method')
-    # Return single transformed array as output
-    return pack(T_data, q_data)
+
+
+def init_pp_chunked(ppis, chunks):
+    """Fits preprocessors in a single pass over chunks of data, so they can be
+       fitted on datasets that do not fit in memory. Means and variances are
+       accumulated exactly and min/max/absmax as running extrema with the
+       scalers' partial_fit. The RobustScaler quantiles come from a mergeable
+       quantile sketch (see init_quantile_sketch) and are exact while the data
+       seen fits within the sketch.
+
+    Args:
+      ppis:   List of preprocessing dictionaries, e.g. [x_ppi, y_ppi]
+      chunks: Iterable giving, for each chunk, a tuple of one N_samples x
+              N_features array per entry of ppis, e.g. iter_training_chunks
+
+    Returns:
+      pps: List of fitted preprocessors, the same as init_pp would give
+    """
+    pps = [_new_pp(ppi) for ppi in ppis]
+    sketches = [dict() for _ in ppis]
+    for data in chunks:
+        for ppi, pp, sketch, z in zip(ppis, pps, sketches, data):
+            for i, (scaler, zi) in enumerate(_pp_fit_data(ppi, pp, z)):
+                if isinstance(scaler, preprocessing.RobustScaler):
+                    if i not in sketch:
+                        sketch[i] = init_quantile_sketch(zi.shape[1])
+                    update_quantile_sketch(sketch[i], zi)
+                else:
+                    scaler.partial_fit(zi)
+    for pp, sketch in zip(pps, sketches):
+        scalers = pp if isinstance(pp, list) else [pp]
+        for i, scaler in enumerate(scalers):
+            if i in sketch:
+                _fit_robust_from_sketch(scaler, sketch[i])
+    return pps
+
+
+def _fit_robust_from_sketch(scaler, sketch):
+    q_min, q_max = getattr(scaler, 'quantile_range', (25.0, 75.0))
+    q = sketch_percentile(sketch, [q_min, 50., q_max])
+    scaler.center_ = q[1]
+    scale = q[2] - q[0]
+    # Same handling of constant features as the sklearn scalers
+    scale[scale == 0.] = 1.
+    scaler.scale_ = scale
+
+
+def init_quantile_sketch(N_feat, k=4096, seed=0):
+    """Initializes a mergeable quantile sketch of N_feat columns. Each level h
+       of the sketch holds values that each stand for 2**h samples. When a
+       level holds more than k values it is sorted and every other value
+       (from a random start) is promoted to the next level, so memory is
+       O(k log(N/k)) and the rank error is O(log(N/k)/k)"""
+    return {'levels': [np.empty((0, N_feat))], 'k': k,
+            'rng': np.random.RandomState(seed)}
+
+
+def update_quantile_sketch(sketch, z):
+    """Adds the N_samples x N_feat array z to the sketch"""
+    sketch['levels'][0] = np.concatenate((sketch['levels'][0], z))
+    _compact_quantile_sketch(sketch)
+    return sketch
+
+
+def merge_quantile_sketch(sketch, other):
+    """Merges the sketch other into sketch"""
+    for h, z in enumerate(other['levels']):
+        if h == len(sketch['levels']):
+            sketch['levels'].append(z[:0])
+        sketch['levels'][h] = np.concatenate((sketch['levels'][h], z))
+    _compact_quantile_sketch(sketch)
+    return sketch
+
+
+def _compact_quantile_sketch(sketch):
+    levels = sketch['levels']
+    h = 0
+    while h < len(levels):
+        z = levels[h]
+        if z.shape[0] > sketch['k']:
+            # An odd value out stays at this level
+            N_pair = z.shape[0] // 2 * 2
+            zs = np.sort(z[:N_pair], axis=0)
+            if h + 1 == len(levels):
+                levels.append(z[:0])
+            start = sketch['rng'].randint(2)
+            levels[h + 1] = np.concatenate((levels[h + 1], zs[start::2]))
+            levels[h] = z[N_pair:]
+        h += 1
+
+
+def sketch_percentile(sketch, q):
+    """Returns the q-th percentiles (len(q) x N_feat) of each column of the
+       data in the sketch. Exact, with the same interpolation as
+       np.percentile, while no compaction has happened"""
+    levels = sketch['levels']
+    if all(z.shape[0] == 0 for z in levels[1:]):
+        return np.percentile(levels[0], q, axis=0)
+    z = np.concatenate(levels)
+    w = np.concatenate([np.full(zh.shape[0], 2. ** h)
+                        for h, zh in enumerate(levels)])
+    order = np.argsort(z, axis=0)
+    z = z[order, np.arange(z.shape[1])]
+    cumw = np.cumsum(w[order], axis=0)
+    out = np.empty((len(q), z.shape[1]))
+    for i, qi in enumerate(q):
+        # First value whose cumulative weight reaches the requested rank
+        ind = np.argmax(cumw >= qi / 100. * cumw[-1], axis=0)
+        out[i] = z[ind, np.arange(z.shape[1])]
+    return out
+
+
+def iter_training_chunks(filename, minlev, chunk_size=10000, **kwargs):
+    """Yields the (x, y) samples that LoadData(filename, minlev, **kwargs)
+       would load, chunk_size samples at a time and in storage order rather
+       than in random order. With a memory-mapped data directory (see
+       write_mmap_data) only one chunk is held in memory at a time, so
+       preprocessors can be fitted on more data than fits in memory with
+       init_pp_chunked(..., iter_training_chunks(...))"""
+    v = dict()
+    [v['Tin'], v['qin'], v['Tout'], v['qout'], Pout, lat] = \
+        load_raw_data(filename)
+    _, _, indlev = get_levs(minlev)
+    levs = np.flatnonzero(indlev)
+    rows = np.sort(training_rows(Pout, v['Tout'], lat, levs, **kwargs))
+    for i in range(0, len(rows), chunk_size):
+        r = rows[i:i + chunk_size]
+        x = pack(gather_rows(v['Tin'], r, levs), gather_rows(v['qin'], r, levs))
+        y = pack(gather_rows(v['Tout'], r, levs),
+                 gather_rows(v['qout'], r, levs))
+        yield x, y
+
+
+# Transform data using initialized scaler
+def transform_data(ppi, pp, raw_data, out=None):
+    return apply_pp(compile_pp(ppi, pp, raw_data.shape[1]), raw_data, out=out)
 
 
 # Apply inverse transformation to unscale data
-def inverse_transform_data(ppi, pp, trans_data):
+def inverse_transform_data(ppi, pp, trans_data, out=None):
+    return apply_pp(compile_pp(ppi, pp, trans_data.shape[1]), trans_data,
+                    out=out, inverse=True)
+
+
+def compile_pp(ppi, pp, N_feat):
+    """Reduces an initialized preprocessor to per-column coefficients so that
+       transformed = raw * scale + offset and raw = trans * inv_scale +
+       inv_offset. This covers every scaler and method combination that
+       init_pp creates.
+
+    Args:
+      ppi:    Preprocessing dictionary with 'name' and 'method'
+      pp:     Initialized scaler(s) returned by init_pp
+      N_feat: Number of columns (T and q together) of the data
+
+    Returns:
+      cpp: Dictionary of the four coefficient vectors, each of length N_feat
+    """
+    N = N_feat // 2
     if ppi['method'] == 'individually':
-        T_data = pp[0].inverse_transform(unpack(trans_data, 'T'))
-        q_data = pp[1].inverse_transform(unpack(trans_data, 'q'))
+        coefs = [_scaler_coefs(pp[0]), _scaler_coefs(pp[1])]
     elif ppi['method'] == 'alltogether':
-        T_data = pp[0].inverse_transform(np.reshape(unpack(trans_data, 'T'),
-                                                    (-1, 1)))
-        q_data = pp[1].inverse_transform(np.reshape(unpack(trans_data, 'q'),
-                                                    (-1, 1)))
-        # Return to original shape (N_samples x N_features) rather than
-        # (N_s*N_f x 1)
-        shp = unpack(trans_data, 'T').shape
-        T_data = np.reshape(T_data, shp)
-        q_data = np.reshape(q_data, shp)
+        # One scalar set of coefficients for all levels of each variable
+        coefs = [[np.repeat(c, N) for c in _scaler_coefs(p)] for p in pp]
     elif ppi['method'] == 'qTindividually':
         if ppi['name'] == 'SimpleY':
-            T_data = unpack(trans_data, 'T') * pp[0]
-            q_data = unpack(trans_data, 'q') * pp[1]
+            coefs = [[np.full(N, 1. / p), np.zeros(N), np.full(N, p),
+                      np.zeros(N)] for p in pp]
         else:
-            all_data = pp.inverse_transform(trans_data)
-            T_data = unpack(all_data, 'T')
-            q_data = unpack(all_data, 'q')
+            coefs = [_scaler_coefs(pp)]
     else:
         raise ValueError('Incorrect scaler method')
-    # Return single transformed array as output
-    return pack(T_data, q_data)
+    keys = ['scale', 'offset', 'inv_scale', 'inv_offset']
+    cpp = {key: np.concatenate([c[i] for c in coefs]).astype(float)
+           for i, key in enumerate(keys)}
+    return cpp
+
+
+def _scaler_coefs(scaler):
+    """Returns scale, offset, inv_scale and inv_offset of a fitted sklearn
+       scaler"""
+    if isinstance(scaler, preprocessing.MinMaxScaler):
+        scale, offset = scaler.scale_, scaler.min_
+        return scale, offset, 1. / scale, -offset / scale
+    if isinstance(scaler, preprocessing.MaxAbsScaler):
+        scale = scaler.scale_
+        return 1. / scale, np.zeros_like(scale), scale, np.zeros_like(scale)
+    if isinstance(scaler, preprocessing.StandardScaler):
+        center, scale = scaler.mean_, scaler.scale_
+    elif isinstance(scaler, preprocessing.RobustScaler):
+        center, scale = scaler.center_, scaler.scale_
+    else:
+        raise ValueError('Incorrect scaler name')
+    return 1. / scale, -center / scale, scale, center
+
+
+def apply_pp(cpp, z, out=None, inverse=False):
+    """Applies the preprocessing compiled by compile_pp to the N_samples x
+       N_feat array z, or its inverse if inverse is True. The result is
+       written to out, which may be z itself for an in-place transform. If
+       out is None a new array is allocated (the dtype of z is kept if it is
+       floating point, as the sklearn scalers do)"""
+    if inverse:
+        scale, offset = cpp['inv_scale'], cpp['inv_offset']
+    else:
+        scale, offset = cpp['scale'], cpp['offset']
+    if out is None:
+        dtype = z.dtype if np.issubdtype(z.dtype, np.floating) else float
+        out = np.empty(z.shape, dtype=dtype)
+    np.multiply(z, scale, out=out, casting='unsafe')
+    np.add(out, offset, out=out, casting='unsafe')
+    return out
 
 
 def limitrain(x, y, Pout, rainonly=False, noshallow=False, verbose=True):
@@ -332,41 +776,343 @@ def load_one_lat(x_ppi, y_ppi, x_pp, y_pp, r_mlp, indlat, datafile, minlev=0.,
 
 
 def stats_by_latlev(x_ppi, y_ppi, x_pp, y_pp, r_mlp, lat, lev, datafile):
-    # Initialize
-    Tmean = np.zeros((len(lat), len(lev)))
-    qmean = np.zeros((len(lat), len(lev)))
-    Tbias = np.zeros((len(lat), len(lev)))
-    qbias = np.zeros((len(lat), len(lev)))
-    rmseT = np.zeros((len(lat), len(lev)))
-    rmseq = np.zeros((len(lat), len(lev)))
-    rT = np.zeros((len(lat), len(lev)))
-    rq = np.zeros((len(lat), len(lev)))
-    for i in range(len(lat)):
-        print('Loading data for latitude {:d} of {:d}'.format(i, len(lat)))
-        T_true, q_true, T_pred, q_pred = \
-            load_one_lat(x_ppi, y_ppi, x_pp, y_pp, r_mlp, i, datafile,
-                         minlev=np.min(lev))
-        # Get means of true output
-        Tmean[i, :] = np.mean(T_true, axis=0)
-        qmean[i, :] = np.mean(q_true, axis=0)
-        # Get bias from means
-        Tbias[i, :] = np.mean(T_pred, axis=0) - Tmean[i, :]
-        qbias[i, :] = np.mean(q_pred, axis=0) - qmean[i, :]
-        # Get rmse
-        rmseT[i, :] = np.sqrt(
-            metrics.mean_squared_error(T_true, T_pred,
-                                       multioutput='raw_values'))
-        rmseq[i, :] = np.sqrt(
-            metrics.mean_squared_error(q_true, q_pred,
-                                       multioutput='raw_values'))
-        # Get correlation coefficients
-        for j in range(len(lev)):
-            rT[i, j], _ = scipy.stats.pearsonr(T_true[:, j], T_pred[:, j])
-            rq[i, j], _ = scipy.stats.pearsonr(q_true[:, j], q_pred[:, j])
-    return Tmean.T, qmean.T, Tbias.T, qbias.T, rmseT.T, rmseq.T, rT.T, rq.T
-
-
-def GetDataPath(cirrusflag, convcond):
+    # Load the data at every latitude at once and then split it by latitude
+    print('Loading data for all latitudes')
+    x, y, _, _, latind, _, _, _, _ = \
+        LoadDataByLat(datafile, np.min(lev), N_trn_exs=2500, verbose=False)
+    x = transform_data(x_ppi, x_pp, x)
+    y_pred = r_mlp.predict(x)
+    y_pred = inverse_transform_data(y_ppi, y_pp, y_pred)
+    mean, bias, rmse, r = grouped_stats(y, y_pred, latind, len(lat))
+    # Split into temperature and humidity and return as N_lev x N_lat
+    Tmean, qmean = unpack(mean, 'T').T, unpack(mean, 'q').T
+    Tbias, qbias = unpack(bias, 'T').T, unpack(bias, 'q').T
+    rmseT, rmseq = unpack(rmse, 'T').T, unpack(rmse, 'q').T
+    rT, rq = unpack(r, 'T').T, unpack(r, 'q').T
+    return Tmean, qmean, Tbias, qbias, rmseT, rmseq, rT, rq
+
+
+def grouped_stats(y_true, y_pred, group, N_group):
+    """Computes skill statistics of each column of y_pred against y_true
+       separately for each group of samples (e.g. each latitude), using a few
+       grouped sums over all samples at once.
+
+    Args:
+      y_true:  N_samples x N_features array of true values
+      y_pred:  N_samples x N_features array of predicted values
+      group:   1-d integer array of the group [0, N_group) of each sample
+      N_group: Number of groups
+
+    Returns:
+      mean : N_group x N_features mean of y_true
+      bias : Mean of y_pred minus mean of y_true
+      rmse : Root mean squared error
+      r    : Pearson correlation coefficient between y_true and y_pred
+      Groups without samples are NaN.
+    """
+    # Sort samples by group so each group can be summed with reduceat
+    order = np.argsort(group, kind='mergesort')
+    counts = np.bincount(group, minlength=N_group)
+    ind = np.flatnonzero(counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[ind]
+    N = counts[:, None].astype(float)
+
+    def group_sum(z):
+        out = np.zeros((N_group, z.shape[1]))
+        out[ind] = np.add.reduceat(z[order], starts, axis=0)
+        return out
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_true = group_sum(y_true) / N
+        mean_pred = group_sum(y_pred) / N
+        # Use deviations from the group means for the second moments
+        dtrue = y_true - mean_true[group]
+        dpred = y_pred - mean_pred[group]
+        cov = group_sum(dtrue * dpred)
+        var_true = group_sum(dtrue ** 2)
+        var_pred = group_sum(dpred ** 2)
+        rmse = np.sqrt(group_sum((y_pred - y_true) ** 2) / N)
+        r = cov / np.sqrt(var_true * var_pred)
+    return mean_true, mean_pred - mean_true, rmse, r
+
+
+def init_stream_stats(N_feat, hist_range=None, N_bins=50):
+    """Initializes a streaming accumulator of skill statistics for N_feat
+       output columns. Chunks of (y_true, y_pred) are added with
+       update_stream_stats and the statistics are read out with
+       finalize_stream_stats, so the full arrays never need to be in memory.
+
+    Args:
+      N_feat:     Number of output columns (e.g. 2*N_lev)
+      hist_range: N_feat x 2 array of the lower and upper histogram edge of
+                  each column (values outside are not counted). If None no
+                  histograms are kept
+      N_bins:     Number of equally spaced histogram bins
+    """
+    stats = {'n': 0}
+    for key in ['mean_true', 'mean_pred', 'M2_true', 'M2_pred', 'C', 'sse']:
+        stats[key] = np.zeros(N_feat)
+    stats['true_eq0'] = np.zeros(N_feat, dtype=np.int64)
+    stats['pred_lt0'] = np.zeros(N_feat, dtype=np.int64)
+    if hist_range is not None:
+        stats['hist_range'] = np.asarray(hist_range, dtype=float)
+        stats['hist_true'] = np.zeros((N_feat, N_bins), dtype=np.int64)
+        stats['hist_pred'] = np.zeros((N_feat, N_bins), dtype=np.int64)
+    return stats
+
+
+def update_stream_stats(stats, y_true, y_pred):
+    """Adds a chunk of N_samples x N_feat true and predicted values to stats.
+       The chunk moments are merged with the running moments using the
+       pairwise update of Chan et al., which stays accurate over many chunks"""
+    n_b = y_true.shape[0]
+    if n_b == 0:
+        return stats
+    n_a = stats['n']
+    n = n_a + n_b
+    mean_true = np.mean(y_true, axis=0)
+    mean_pred = np.mean(y_pred, axis=0)
+    dtrue = y_true - mean_true
+    dpred = y_pred - mean_pred
+    d_t = mean_true - stats['mean_true']
+    d_p = mean_pred - stats['mean_pred']
+    f = n_a * n_b / n
+    stats['M2_true'] += np.sum(dtrue ** 2, axis=0) + d_t ** 2 * f
+    stats['M2_pred'] += np.sum(dpred ** 2, axis=0) + d_p ** 2 * f
+    stats['C'] += np.sum(dtrue * dpred, axis=0) + d_t * d_p * f
+    stats['mean_true'] += d_t * n_b / n
+    stats['mean_pred'] += d_p * n_b / n
+    stats['sse'] += np.sum((y_pred - y_true) ** 2, axis=0)
+    stats['true_eq0'] += np.sum(y_true == 0.0, axis=0)
+    stats['pred_lt0'] += np.sum(y_pred < 0.0, axis=0)
+    stats['n'] = n
+    if 'hist_range' in stats:
+        stats['hist_true'] += _column_histogram(y_true, stats['hist_range'],
+                                                stats['hist_true'].shape[1])
+        stats['hist_pred'] += _column_histogram(y_pred, stats['hist_range'],
+                                                stats['hist_pred'].shape[1])
+    return stats
+
+
+def _column_histogram(z, hist_range, N_bins):
+    """Counts the values of each column of z in N_bins equal bins spanning
+       hist_range of that column. As np.histogram the last bin includes its
+       right edge and values outside the range are dropped"""
+    N_feat = z.shape[1]
+    lo = hist_range[:, 0]
+    hi = hist_range[:, 1]
+    ind = np.floor((z - lo) / (hi - lo) * N_bins).astype(np.int64)
+    ind[z == hi] = N_bins - 1
+    valid = (ind >= 0) & (ind < N_bins)
+    ind = ind + np.arange(N_feat) * N_bins
+    counts = np.bincount(ind[valid], minlength=N_feat * N_bins)
+    return counts.reshape(N_feat, N_bins)
+
+
+def finalize_stream_stats(stats):
+    """Returns a dictionary of per-column statistics from the accumulator:
+       mean and std of the true and predicted values, rmse, pearson r,
+       explained variance, the fraction of true values equal to zero and of
+       predicted values below zero, and the histograms if kept"""
+    n = float(stats['n'])
+    out = dict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['mean_true'] = stats['mean_true'].copy()
+        out['mean_pred'] = stats['mean_pred'].copy()
+        out['std_true'] = np.sqrt(stats['M2_true'] / n)
+        out['std_pred'] = np.sqrt(stats['M2_pred'] / n)
+        out['rmse'] = np.sqrt(stats['sse'] / n)
+        out['r'] = stats['C'] / np.sqrt(stats['M2_true'] * stats['M2_pred'])
+        # Same conventions as metrics.explained_variance_score for zero
+        # variance columns
+        var_err = np.maximum(stats['M2_true'] + stats['M2_pred'] -
+                             2 * stats['C'], 0.)
+        expl_var = 1. - var_err / stats['M2_true']
+        expl_var[stats['M2_true'] == 0.] = 0.
+        expl_var[(stats['M2_true'] == 0.) & (var_err == 0.)] = 1.
+        out['expl_var'] = expl_var
+        out['true_eq0'] = stats['true_eq0'] / n
+        out['pred_lt0'] = stats['pred_lt0'] / n
+    if 'hist_range' in stats:
+        out['hist_edges'] = np.array([np.linspace(lo, hi, stats['hist_true']
+                                                  .shape[1] + 1)
+                                      for lo, hi in stats['hist_range']])
+        out['hist_true'] = stats['hist_true'].copy()
+        out['hist_pred'] = stats['hist_pred'].copy()
+    return out
+
+
+def get_stream_stats(r_str, training_file, minlev, chunk_size=10000,
+                     hist_range=None, N_bins=50):
+    """Evaluates a saved regressor on training_file chunk by chunk and returns
+       finalized statistics of the unscaled outputs and of precipitation. The
+       samples are read with iter_training_chunks, so with a memory-mapped
+       data directory (see write_mmap_data) only one chunk of chunk_size
+       samples is in memory at a time"""
+    mlp, _, _, x_ppi, y_ppi, x_pp, y_pp, _, _, dlev = \
+        pickle.load(open('./data/regressors/' + r_str + '.pkl', 'rb'))
+    mlp = numpy_predictor(mlp)
+    stats, P_stats = None, init_stream_stats(1)
+    for x_unscl, ytrue in iter_training_chunks(training_file, minlev,
+                                               chunk_size=chunk_size,
+                                               verbose=False):
+        if stats is None:
+            stats = init_stream_stats(ytrue.shape[1], hist_range, N_bins)
+        x_scl = transform_data(x_ppi, x_pp, x_unscl, out=x_unscl)
+        ypred = mlp.predict(x_scl)
+        inverse_transform_data(y_ppi, y_pp, ypred, out=ypred)
+        update_stream_stats(stats, ytrue, ypred)
+        P_true = nnatmos.calc_precip(unpack(ytrue, 'q'), dlev)
+        P_pred = nnatmos.calc_precip(unpack(ypred, 'q'), dlev)
+        update_stream_stats(P_stats, P_true[:, None], P_pred[:, None])
+    return finalize_stream_stats(stats), finalize_stream_stats(P_stats)
+
+
+# Part of the keys of the scaled data cache, to be changed with its contents
+CACHE_VERSION = 2
+
+
+def load_scaled_data(filename, minlev, x_ppi, y_ppi, pp=None, rainonly=False,
+                     noshallow=False, N_trn_exs=None, cachedir='./data/cache/',
+                     budget_gb=50., randseed=False, raw=False):
+    """Loads data with LoadData and scales it, going through an on-disk cache
+       so that repeated loads with the same settings (e.g. every run of a
+       parameter sweep) skip loading and preprocessing. Entries are keyed by
+       the content of filename, minlev, the filters, N_trn_exs and the
+       preprocessing, and the scaled arrays are returned memory-mapped and
+       read-only. The unscaled arrays are cached too, as scaling them back
+       would not give exact zeros. Note that the samples of a cached entry
+       are those drawn by the first load.
+
+    Args:
+      filename, minlev, rainonly, noshallow, N_trn_exs, randseed: As for
+                 LoadData
+      x_ppi, y_ppi: Preprocessing dictionaries
+      pp:        Optional (x_pp, y_pp) of already fitted preprocessors to
+                 scale with (e.g. for testing data). If None they are fitted
+                 on the data with init_pp
+      cachedir:  Directory of the cache
+      budget_gb: Disk budget of the cache. The least recently used entries
+                 are removed once it is exceeded
+      raw:       If true, also return the unscaled x and y
+
+    Returns:
+      x, y, cv, Pout, lat, lev, dlev, timestep: As for LoadData, with x and y
+                 scaled
+      x_pp, y_pp: The preprocessors
+      x_unscl, y_unscl: The unscaled x and y, if raw is true
+    """
+    spec = {'data': data_file_hash(filename), 'minlev': minlev,
+            'rainonly': rainonly, 'noshallow': noshallow,
+            'N_trn_exs': N_trn_exs, 'x_ppi': x_ppi, 'y_ppi': y_ppi,
+            'pp': None if pp is None else
+            hashlib.sha256(pickle.dumps(pp, protocol=2)).hexdigest(),
+            'randseed': randseed, 'version': CACHE_VERSION}
+    key = hashlib.sha256(json.dumps(spec, sort_keys=True,
+                                    default=_json_scalar).encode())\
+        .hexdigest()[:20]
+    path = os.path.join(cachedir, key)
+    if os.path.isdir(path):
+        # Mark as recently used
+        os.utime(path, None)
+    else:
+        x, y, cv, Pout, lat, lev, dlev, timestep = \
+            LoadData(filename, minlev, rainonly=rainonly, noshallow=noshallow,
+                     N_trn_exs=N_trn_exs, randseed=randseed)
+        if pp is None:
+            pp = (init_pp(x_ppi, x), init_pp(y_ppi, y))
+        _write_cache_entry(path, {'x': transform_data(x_ppi, pp[0], x),
+                                  'y': transform_data(y_ppi, pp[1], y),
+                                  'cv': cv, 'Pout': Pout,
+                                  'x_unscl': x, 'y_unscl': y},
+                           [pp[0], pp[1], lat, lev, dlev, timestep, spec])
+        evict_cache(cachedir, budget_gb, keep=key)
+    varis = ['x', 'y', 'cv', 'Pout'] + (['x_unscl', 'y_unscl'] if raw else [])
+    v = {var: np.load(os.path.join(path, var + '.npy'), mmap_mode='r')
+         for var in varis}
+    x_pp, y_pp, lat, lev, dlev, timestep, _ = \
+        pickle.load(open(os.path.join(path, 'meta.pkl'), 'rb'))
+    out = (v['x'], v['y'], v['cv'], v['Pout'], lat, lev, dlev, timestep,
+           x_pp, y_pp)
+    if raw:
+        out = out + (v['x_unscl'], v['y_unscl'])
+    return out
+
+
+def _json_scalar(v):
+    # numpy scalars (e.g. from np.array grids) are keyed as python numbers
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError(repr(v) + ' is not JSON serializable')
+
+
+def _write_cache_entry(path, arrays, meta):
+    # Write to a temporary directory and rename it so that other processes
+    # never see a partly written entry
+    tmp = path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp)
+    for var, z in arrays.items():
+        np.save(os.path.join(tmp, var + '.npy'), z)
+    pickle.dump(meta, open(os.path.join(tmp, 'meta.pkl'), 'wb'))
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process wrote the same entry first
+        shutil.rmtree(tmp)
+
+
+def evict_cache(cachedir, budget_gb, keep=None):
+    """Removes the least recently used entries of the scaled data cache until
+       it uses less than budget_gb of disk. The entry keep is never removed"""
+    entries = []
+    for key in os.listdir(cachedir):
+        path = os.path.join(cachedir, key)
+        if '.tmp' in key or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, key))
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= budget_gb * 1e9:
+            break
+        if key != keep:
+            shutil.rmtree(os.path.join(cachedir, key), ignore_errors=True)
+            total -= size
+
+
+def data_file_hash(filename):
+    """Hash of the content of a training pickle, memory-mapped data directory
+       or training store path"""
+    if STORE_SEP in filename:
+        filename, key = filename.rsplit(STORE_SEP, 1)
+        return _file_hash(filename) + STORE_SEP + key
+    if os.path.isdir(filename):
+        # The header already holds checksums of all the arrays
+        return hashlib.sha256(open(os.path.join(filename, 'header.json'),
+                                   'rb').read()).hexdigest()
+    return _file_hash(filename)
+
+
+def _file_hash(filename):
+    st = os.stat(filename)
+    return _file_hash_cached(os.path.abspath(filename), st.st_size,
+                             st.st_mtime)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_hash_cached(filename, size, mtime):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(functools.partial(f.read, 2**24), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def GetDataPath(cirrusflag, convcond, store=None, mmap=False):
+    """Returns the data directory, the training and testing files and the
+       prefix used in the names of trained models. If store is given, the
+       training and testing files are splits of that training store. If mmap
+       is true, they are the memory-mapped copies of the training pickles."""
     if cirrusflag:
         datadir = '/disk7/jgdwyer/chickpea/nndata/'
     else:
@@ -379,6 +1125,13 @@ def GetDataPath(cirrusflag, convcond):
         trainfile = datadir + 'conv_training_v3.pkl'
         testfile = datadir + 'conv_testing_v3.pkl'
         pp_str = ''
+    if mmap:
+        trainfile = mmap_path(trainfile)
+        testfile = mmap_path(testfile)
+    if store is not None:
+        target = 'convcond' if convcond else 'conv'
+        trainfile = store_path(store, target, 'training')
+        testfile = store_path(store, target, 'testing')
     return datadir, trainfile, testfile, pp_str
 
 
@@ -413,11 +1166,75 @@ def get_levs(minlev):
     return lev, dlev, indlev
 
 
+def numpy_predictor(mlp):
+    """Returns an object predicting in NumPy for a loaded regressor. For an
+       ensemble it predicts the mean of the members (see load_ensemble)"""
+    if isinstance(mlp, EnsembleRegressor):
+        return mlp.predictor()
+    return Predictor.from_mlp(mlp)
+
+
+def load_ensemble(r_strs, batch_size=8192):
+    """Loads the saved regressors r_strs as one EnsemblePredictor, which
+       predicts all their members in one pass. The weights and the
+       preprocessing of the members are stacked with the member first, as
+       N_e in write_netcdf_ensemble1, so the predictor takes and returns
+       unscaled data. A saved ensemble adds all its members"""
+    members = []
+    scalings = []
+    for r_str in r_strs:
+        mlp, _, _, x_ppi, y_ppi, x_pp, y_pp, _, lev, _ = \
+            pickle.load(open('./data/regressors/' + r_str + '.pkl', 'rb'))
+        if isinstance(mlp, EnsembleRegressor):
+            ens = mlp.predictor()
+            p = [Predictor(ens.layers, [[z[i] for z in w] for w in ens.weights])
+                 for i in range(ens.n_members)]
+        else:
+            p = [Predictor.from_mlp(mlp)]
+        # Inputs and outputs are T and q at every level
+        cx = compile_pp(x_ppi, x_pp, 2 * len(lev))
+        cy = compile_pp(y_ppi, y_pp, 2 * len(lev))
+        members.extend(p)
+        scalings.extend(len(p) * [(cx['inv_offset'], cx['inv_scale'],
+                                   cy['inv_offset'], cy['inv_scale'])])
+    x_center, x_scale, y_center, y_scale = [np.array(z) for z in
+                                            zip(*scalings)]
+    return EnsemblePredictor.from_predictors(members, x_center=x_center,
+                                             x_scale=x_scale,
+                                             y_center=y_center,
+                                             y_scale=y_scale,
+                                             batch_size=batch_size)
+
+
+def get_ensemble_pred_true(r_strs, training_file, minlev):
+    """Predicts the outputs of training_file with every member of the saved
+       regressors r_strs in a single pass (see load_ensemble). Returns the
+       unscaled inputs and true outputs, the mean and spread of the
+       predictions and the predictions of each member (N_members x N_samples
+       x N_feat)"""
+    ens = load_ensemble(r_strs)
+    x_unscl, ytrue_unscl, _, _, _, _, _, _ = \
+        LoadData(training_file, minlev=minlev, N_trn_exs=None)
+    ypred_mean, ypred_spread, ypred = ens.predict_spread(x_unscl, members=True)
+    return x_unscl, ytrue_unscl, ypred_mean, ypred_spread, ypred
+
+
 def get_x_y_pred_true(r_str, training_file, minlev, noshallow=False,
-                      rainonly=False):
+                      rainonly=False, cachedir=None):
     # Load model and preprocessors
     mlp, _, errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, _ = \
         pickle.load(open('./data/regressors/' + r_str + '.pkl', 'rb'))
+    # Predict in NumPy from the pickled weights without building the network
+    mlp = numpy_predictor(mlp)
+    if cachedir is not None:
+        # Load the scaled and unscaled data from the cache
+        data = load_scaled_data(training_file, minlev, x_ppi, y_ppi,
+                                pp=(x_pp, y_pp), cachedir=cachedir, raw=True)
+        x_scl, ytrue_scl = data[:2]
+        x_unscl, ytrue_unscl = data[-2:]
+        ypred_scl = mlp.predict(x_scl)
+        ypred_unscl = inverse_transform_data(y_ppi, y_pp, ypred_scl)
+        return x_scl, ypred_scl, ytrue_scl, x_unscl, ypred_unscl, ytrue_unscl
     # Load raw data from file
     x_unscl, ytrue_unscl, _, _, _, _, _, _ = \
         LoadData(training_file, minlev=minlev, N_trn_exs=None)
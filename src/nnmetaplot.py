@@ -2,10 +2,14 @@ import numpy as np
 from sklearn import metrics
 import matplotlib.pyplot as plt
 import src.nnload as nnload
+import src.nnsweep as nnsweep
 # ----  META-PLOTTING SCRIPTS  ---- #
 
 
-def load_r_mlps():
+def load_r_mlps(results_file=None):
+    """Loads the final training and cross-validation errors of the sweep.
+       If results_file is given they are read from the results table written
+       by nnsweep.run_sweep rather than from each saved regressor"""
     neur_strL = ['5R', '10R', '5R_5R', '50R', '100R', '10R_10R', '200R',
                  '50R_50R', '100R_100R', '200R_200R']
     neur_str = ['5', '10', '5-5', '50', '100', '10-10', '200',
@@ -16,11 +20,19 @@ def load_r_mlps():
     tr = np.nan * np.zeros((len(neur_str), len(trn_ex), len(regs)))
     cv = np.nan * np.zeros((len(neur_str), len(trn_ex), len(regs)))
     ptf = 'X-StandardScaler-qTindi_Y-SimpleY-qTindi_Ntrnex'
+    if results_file is not None:
+        results = {row['r_str']: row for row in
+                   nnsweep.load_sweep_results(results_file)}
     for i, hid in enumerate(neur_strL):
         for j, nex in enumerate(trn_ex):
             for k, reg in enumerate(regs):
                 r_str = ptf + str(nex) + '_r_' + hid + \
                     '_mom0.9reg' + str(reg) + '_Niter10000_v3'
+                if results_file is not None:
+                    if r_str in results:
+                        tr[i, j, k] = results[r_str]['train_error']
+                        cv[i, j, k] = results[r_str]['valid_error']
+                    continue
                 try:
                     err = nnload.load_error_history(r_str)
                     tr[i, j, k] = err[-1, 4]
@@ -18,14 +18,16 @@ matplotlib.rcParams['agg.path.chunksize'] = 10000
 
 
 def PlotAllFigs(r_str, training_file, validation=True, noshallow=False,
-                  rainonly=False):
+                  rainonly=False, cachedir=None):
     # Open the neural network and the preprocessing scheme
     r_mlp_eval, _, errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev = \
         pickle.load(open('./data/regressors/' + r_str + '.pkl', 'rb'))
+    r_mlp_eval = nnload.numpy_predictor(r_mlp_eval)
     # Load the data from the training/testing/validation file
     x_scl, ypred_scl, ytrue_scl, x_unscl, ypred_unscl, ytrue_unscl = \
         nnload.get_x_y_pred_true(r_str, training_file, minlev=min(lev),
-                                 noshallow=False, rainonly=False)
+                                 noshallow=False, rainonly=False,
+                                 cachedir=cachedir)
     # Set figure path and create directory if it does not exist
     figpath = './figs/' + r_str + '/'
     # If plotting on training data create a new subfolder
@@ -143,6 +145,50 @@ def plot_error_stats(y3_true, y3_pred, lev, figpath):
     plt.close()
 
 
+# Plot means, standard deviations and error statistics from the statistics
+# accumulated chunk by chunk by nnload.get_stream_stats
+def plot_stream_stats(stats, lev, figpath):
+    out_str_dict = {'T': 'K/day', 'q': 'g/kg/day'}
+    fig = plt.figure()
+    for ind, (method, vari) in enumerate([('mean', 'T'), ('mean', 'q'),
+                                          ('std', 'T'), ('std', 'q')]):
+        plt.subplot(2, 2, ind + 1)
+        plt.plot(unpack(stats[method + '_true'], vari, axis=0), lev,
+                 label='true')
+        plt.plot(unpack(stats[method + '_pred'], vari, axis=0), lev,
+                 label='pred')
+        plt.ylim(np.amax(lev), np.amin(lev))
+        plt.ylabel('$\sigma$')
+        if ind > 1:
+            plt.xlabel(out_str_dict[vari])
+        plt.title(r'$\Delta$ ' + vari + ' ' +
+                  {'mean': 'Mean', 'std': 'Standard Deviation'}[method])
+        plt.legend()
+    fig.savefig(figpath + 'regress_means_stds.png', bbox_inches='tight',
+                dpi=450)
+    plt.close()
+    fig = plt.figure()
+    rmse = stats['rmse'] / stats['mean_true']
+    for ind, (key, vari, titstr) in enumerate(
+            [('r', None, 'Correlation Coefficient'),
+             ('expl_var', None, 'Explained Variance Regression Score'),
+             ('rmse', 'T', 'Root Mean Squared Error/mean'),
+             ('rmse', 'q', 'Root Mean Squared Error/mean')]):
+        plt.subplot(2, 2, ind + 1)
+        z = rmse if key == 'rmse' else stats[key]
+        for v in ([vari] if vari else ['T', 'q']):
+            plt.plot(unpack(z, v, axis=0), lev, label=v)
+        plt.ylim([np.amax(lev), np.amin(lev)])
+        plt.ylabel('$\sigma$')
+        if vari:
+            plt.xlabel(out_str_dict[vari])
+        plt.title(titstr)
+        if ind == 0:
+            plt.legend(loc="upper left")
+    fig.savefig(figpath + 'regress_stats.png', bbox_inches='tight', dpi=450)
+    plt.close()
+
+
 # Plot a time series of precipitaiton
 def plot_precip(y_true, y_pred, dlev, figpath):
     fig = plt.figure()
@@ -467,7 +513,11 @@ def plot_model_error_over_time(errors, mlp_str, fig_dir):
 
 
 def plot_neural_fortran(training_file, mlp_str, latind=None, timeind=None,
-                        ensemble=False):
+                        ensemble=False, ensemble_strs=None):
+    """Plots the GCM, NN and DBM tendencies of one column. If ensemble, also
+       plots the ensemble members computed in the GCM. If ensemble_strs is
+       given, the members of these saved regressors are predicted here and
+       plotted with their mean"""
     # mlp_str = 'X-StandardScaler-qTindi_Y-SimpleY-qTindi_' + \
     #     'Ntrnex100000_r_100R_mom0.9reg1e-06_Niter10000_v3'
     mlp, _, errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev = \
@@ -477,9 +527,13 @@ def plot_neural_fortran(training_file, mlp_str, latind=None, timeind=None,
                                     timeind=timeind, ensemble=ensemble)
     ind = 0
     x_scl = nnload.transform_data(x_ppi, x_pp, x_unscl)
-    ypred_scl = mlp.predict(x_scl)
+    ypred_scl = nnload.numpy_predictor(mlp).predict(x_scl)
     ypred_unscl = nnload.inverse_transform_data(y_ppi, y_pp, ypred_scl)
     Ppred = nnatmos.calc_precip(nnload.unpack(ypred_unscl, 'q'), dlev)
+    yens = []
+    if ensemble_strs is not None:
+        ens = nnload.load_ensemble(ensemble_strs)
+        yens_mean, _, yens = ens.predict_spread(x_unscl, members=True)
     f, (a1, a2) = plt.subplots(1, 2)
     a1.plot(unpack(ytrue_unscl, 'T')[ind, :], lev, label='GCM dT')
     a1.plot(unpack(ypred_unscl, 'T')[ind, :], lev, label='NN dT')
@@ -487,6 +541,10 @@ def plot_neural_fortran(training_file, mlp_str, latind=None, timeind=None,
     if ensemble:
         for key in ten:
             a1.plot(ten[key], lev, color='gray')
+    for y in yens:
+        a1.plot(unpack(y, 'T')[ind, :], lev, color='gray', linestyle='--')
+    if ensemble_strs is not None:
+        a1.plot(unpack(yens_mean, 'T')[ind, :], lev, label='NN ens. dT')
     a1.set_xlabel('K/day')
     a1.set_ylim(1, 0)
     a1.legend()
@@ -496,6 +554,10 @@ def plot_neural_fortran(training_file, mlp_str, latind=None, timeind=None,
     if ensemble:
         for key in qen:
             a2.plot(qen[key], lev, color='gray')
+    for y in yens:
+        a2.plot(unpack(y, 'q')[ind, :], lev, color='gray', linestyle='--')
+    if ensemble_strs is not None:
+        a2.plot(unpack(yens_mean, 'q')[ind, :], lev, label='NN ens. dq')
     a2.set_xlabel('g/kg/day')
     a2.set_ylim(1, 0)
     a2.legend()
@@ -0,0 +1,276 @@
+import numpy as np
+import csv
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import time
+import traceback
+import src.nnload as nnload
+import src.nntrain as nntrain
+
+# Environment variables that set the number of BLAS/OpenMP threads
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+RESULT_FIELDS = ['id', 'r_str', 'train_error', 'valid_error', 'epochs',
+                 'seconds', 'config']
+# Arguments that do not change the model that is trained
+RUN_ONLY_ARGS = ['cachedir', 'on_epoch_finish', 'checkpoint_every',
+                 'checkpoint_secs', 'resume']
+
+
+def run_sweep(grid, base=None, n_workers=None, threads_per_worker=None,
+              results_file='./data/sweep_results.csv',
+              cachedir='./data/cache/', halving=None):
+    """Trains a neural network with TrainNNwrapper for every point of a grid
+       of settings in a pool of local worker processes. Each finished config
+       is appended to results_file, and configs already in it are skipped, so
+       a sweep can be restarted after a crash.
+
+    Args:
+      grid:      Dictionary of TrainNNwrapper argument -> list of values, e.g.
+                 {'hidneur': [5, 10, 50], 'N_trn_exs': [1000, 10000],
+                  'weight_decay': [1e-7, 1e-6, 1e-5]}
+      base:      Dictionary of the TrainNNwrapper arguments shared by all
+                 runs, e.g. {'num_layers': 1, 'x_ppi': x_ppi, 'y_ppi': y_ppi,
+                 'n_iter': 10000, 'minlev': 0.2}
+      n_workers, threads_per_worker: How to split the cores between worker
+                 processes and the BLAS/OpenMP threads of each (split_cores)
+      results_file: CSV table with one row per finished config
+      cachedir:  Scaled data cache shared by the workers (see
+                 nnload.load_scaled_data)
+      halving:   If given, a dictionary of asha_on_epoch_finish arguments
+                 (min_epochs, eta) to stop poorly performing configs early
+                 by asynchronous successive halving, e.g.
+                 {'min_epochs': 100, 'eta': 3}
+
+    Returns:
+      results: List of dictionaries of all rows of results_file
+    """
+    base = dict(base or {})
+    base.setdefault('cachedir', cachedir)
+    configs = sweep_configs(grid, base)
+    done = set(row['id'] for row in load_sweep_results(results_file))
+    todo = [c for c in configs if config_id(c) not in done]
+    if halving is not None:
+        # The rung tables are kept next to the results so that they survive
+        # a restart of the sweep
+        rung_dir = os.path.splitext(results_file)[0] + '_rungs'
+        if not os.path.exists(rung_dir):
+            os.makedirs(rung_dir)
+        for c in todo:
+            c['on_epoch_finish'] = functools.partial(
+                asha_on_epoch_finish, rung_dir=rung_dir, trial=config_id(c),
+                **halving)
+    print('{:d} of {:d} configs are already done'.format(
+        len(configs) - len(todo), len(configs)))
+    if not todo:
+        return load_sweep_results(results_file)
+    n_workers, threads = split_cores(n_workers, threads_per_worker)
+    n_workers = min(n_workers, len(todo))
+    print('Running {:d} configs on {:d} workers with {:d} threads each'
+          .format(len(todo), n_workers, threads))
+    # Load and scale each dataset once here. The workers then share the
+    # memory-mapped cache entries read-only through the page cache
+    _warm_cache(todo)
+    # Workers are started fresh (not forked) with the thread limits in their
+    # environment, so that BLAS reads them when it is first loaded. Each
+    # worker then runs many configs, reusing the Theano functions compiled
+    # for configs with the same network architecture. Both the compiled
+    # functions and the uploaded training data are bounded per worker (see
+    # the caches of sknn_jgd.backend.lasagne.mlp), so workers are not recycled
+    env = {var: os.environ.get(var) for var in THREAD_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_VARS})
+    try:
+        pool = multiprocessing.get_context('spawn').Pool(n_workers)
+    finally:
+        for var, val in env.items():
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
+    try:
+        for row in pool.imap_unordered(_run_config, todo):
+            if row is not None:
+                append_sweep_result(results_file, row)
+    finally:
+        pool.close()
+        pool.join()
+    return load_sweep_results(results_file)
+
+
+def sweep_configs(grid, base=None):
+    """Returns the list of TrainNNwrapper keyword arguments for every point of
+       grid, each combined with base"""
+    keys = sorted(grid)
+    configs = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        config = dict(base or {})
+        config.update(zip(keys, values))
+        configs.append(config)
+    return configs
+
+
+def config_id(config):
+    """Short hash identifying a config (arguments in RUN_ONLY_ARGS are
+       ignored)"""
+    config = {k: v for k, v in config.items() if k not in RUN_ONLY_ARGS}
+    return hashlib.sha1(_config_json(config).encode()).hexdigest()[:12]
+
+
+def _config_json(config):
+    # numpy scalars (e.g. from np.array grids) are stored as python numbers
+    return json.dumps(config, sort_keys=True,
+                      default=lambda v: v.item() if hasattr(v, 'item')
+                      else str(v))
+
+
+def split_cores(n_workers=None, threads_per_worker=None, n_cores=None):
+    """Splits n_cores (default all) between worker processes and the
+       BLAS/OpenMP threads of each worker so that the machine is not
+       oversubscribed. Returns n_workers, threads_per_worker"""
+    if n_cores is None:
+        n_cores = multiprocessing.cpu_count()
+    if n_workers is None:
+        n_workers = max(1, n_cores // (threads_per_worker or 1))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, n_cores // n_workers)
+    return n_workers, threads_per_worker
+
+
+def _warm_cache(configs):
+    defaults = {k: p.default for k, p in
+                inspect.signature(nntrain.TrainNNwrapper).parameters.items()}
+    warmed = set()
+    for config in configs:
+        c = dict(defaults)
+        c.update(config)
+        _, trainfile, _, _ = nnload.GetDataPath(c['cirrusflag'],
+                                                c['convcond'])
+        args = (trainfile, c['minlev'], c['x_ppi'], c['y_ppi'])
+        kwargs = {'rainonly': c['rainonly'], 'noshallow': c['noshallow'],
+                  'N_trn_exs': c['N_trn_exs'], 'cachedir': c['cachedir'],
+                  'randseed': nntrain.SeedData(c['checkpoint_every'],
+                                               c['checkpoint_secs'],
+                                               c['resume'])}
+        key = _config_json([args, kwargs])
+        if key not in warmed:
+            nnload.load_scaled_data(*args, **kwargs)
+            warmed.add(key)
+
+
+def _run_config(config):
+    start = time.time()
+    try:
+        r_str = nntrain.TrainNNwrapper(**config)
+    except Exception:
+        print('Config ' + config_id(config) + ' failed:\n' +
+              traceback.format_exc())
+        return None
+    _, _, errors, _, _, _, _, _, _, _ = \
+        pickle.load(open('./data/regressors/' + r_str + '.pkl', 'rb'))
+    errors = last_evaluated(errors)
+    return {'id': config_id(config), 'r_str': r_str,
+            'train_error': errors[4], 'valid_error': errors[2],
+            'epochs': len(errors), 'seconds': time.time() - start,
+            'config': _config_json({k: v for k, v in config.items()
+                                    if k not in RUN_ONLY_ARGS})}
+
+
+def last_evaluated(errors):
+    """Returns the last evaluated (not NaN) value of each column of the error
+       history stored by nntrain.store_stats"""
+    errors = np.asarray(errors, dtype=float)
+    out = np.full(errors.shape[1], np.nan)
+    for j in range(errors.shape[1]):
+        ind = np.flatnonzero(np.isfinite(errors[:, j]))
+        if len(ind) > 0:
+            out[j] = errors[ind[-1], j]
+    return out
+
+
+def append_sweep_result(results_file, row):
+    """Appends one row to the sweep results table"""
+    new = not os.path.exists(results_file)
+    dirname = os.path.dirname(results_file)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(results_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if new:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def load_sweep_results(results_file='./data/sweep_results.csv'):
+    """Returns the rows of a sweep results table as a list of dictionaries,
+       with errors as floats and config as a dictionary"""
+    if not os.path.exists(results_file):
+        return []
+    rows = []
+    with open(results_file, newline='') as f:
+        for row in csv.DictReader(f):
+            for key in ['train_error', 'valid_error', 'seconds']:
+                row[key] = float(row[key])
+            row['epochs'] = int(row['epochs'])
+            row['config'] = json.loads(row['config'])
+            rows.append(row)
+    return rows
+
+
+def asha_on_epoch_finish(i, avg_train_error, avg_valid_error, rung_dir, trial,
+                         min_epochs=100, eta=3, i_prev_eval=None, **variables):
+    """on_epoch_finish callback that stores the errors with
+       nntrain.store_stats and stops configs early by asynchronous successive
+       halving. At epochs min_epochs, min_epochs*eta, min_epochs*eta**2, ...
+       the validation error is recorded in a table shared by all runs of the
+       sweep. Training only continues if the error is within the best 1/eta
+       of the errors recorded so far at that epoch. Use through
+       functools.partial to set rung_dir (directory of the shared tables) and
+       trial (id of the config). If the errors are only evaluated every few
+       epochs a rung is checked at the first evaluation after it"""
+    nntrain.store_stats(i=i, avg_train_error=avg_train_error,
+                        avg_valid_error=avg_valid_error,
+                        i_prev_eval=i_prev_eval, **variables)
+    if i_prev_eval is None:
+        i_prev_eval = i - 1
+    if avg_valid_error is None and variables.get('is_eval_epoch') is False:
+        return True
+    # Latest rung passed since the previous evaluation
+    rung = None
+    r = min_epochs
+    while r <= i:
+        if r > i_prev_eval:
+            rung = r
+        r *= eta
+    if rung is None:
+        return True
+    error = avg_valid_error if avg_valid_error is not None else \
+        avg_train_error
+    errors = record_rung(rung_dir, rung, trial, error)
+    # Error of the last of the best ceil(n/eta) trials recorded at this rung
+    n_keep = int(np.ceil(len(errors) / float(eta)))
+    cutoff = np.sort(list(errors.values()))[n_keep - 1]
+    if error > cutoff:
+        print('Stopping {:s} at epoch {:d}: error {:.4f} is worse than the '
+              'best 1/{:d} ({:.4f})'.format(trial, i, error, eta, cutoff))
+        return False
+    return True
+
+
+def record_rung(rung_dir, rung, trial, error):
+    """Appends the error of trial at epoch rung to the shared rung table and
+       returns the errors of all trials recorded at that rung (the first
+       record of a trial is kept if it was rerun)"""
+    filename = os.path.join(rung_dir, 'rung_{:d}.txt'.format(rung))
+    # Single short appends so that runs in other processes can write too
+    with open(filename, 'a') as f:
+        f.write('{:s} {!r}\n'.format(trial, float(error)))
+    errors = dict()
+    for line in open(filename):
+        t, e = line.split()
+        errors.setdefault(t, float(e))
+    return errors
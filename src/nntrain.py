@@ -1,5 +1,6 @@
 import numpy as np
 import sknn_jgd.mlp
+import sknn_jgd.ensemble
 import time
 from sklearn.ensemble import RandomForestRegressor
 import src.nnload as nnload
@@ -13,7 +14,10 @@ def TrainNNwrapper(num_layers, hidneur, x_ppi, y_ppi,
                      minlev=0.0, weight_precip=False, weight_shallow=False,
                      weight_decay=0.0, rainonly=False, noshallow=False,
                      N_trn_exs=None, convcond=False, doRF=False,
-                     cirrusflag=False, plot_training_results=False):
+                     cirrusflag=False, plot_training_results=False,
+                     cachedir=None, on_epoch_finish=None, eval_every=1,
+                     eval_subsample=None, checkpoint_every=None,
+                     checkpoint_secs=None, resume=False, n_members=None):
     """Loads training data and trains and stores neural network
 
     Args:
@@ -34,16 +38,47 @@ def TrainNNwrapper(num_layers, hidneur, x_ppi, y_ppi,
         doRF (bool): Use a random forest rather than an ANN
         cirrusflag (bool): Run on the cirrus machine
         plot_training_results (bool): Whether to also plot the model on training data
+        cachedir (str): If given, load the scaled data through the on-disk
+            cache in this directory (see nnload.load_scaled_data)
+        on_epoch_finish (function): Callback after each epoch in place of
+            store_stats. Must call store_stats and may stop training early by
+            returning False (see nnsweep.asha_on_epoch_finish)
+        eval_every (int): Epochs between evaluations of the training and
+            validation error. Errors of other epochs are stored as NaN
+        eval_subsample (int): Number of training examples to evaluate the
+            training error on (None for all)
+        checkpoint_every (int): Save the training state to
+            ./data/checkpoints/ every this many epochs
+        checkpoint_secs (float): Save the training state to
+            ./data/checkpoints/ every this many seconds
+        resume (bool): Continue training from the saved training state of
+            this NN if there is one
+        n_members (int): Train an ensemble of this many NNs at once, each on
+            its own bootstrap sample of the training data (None for one NN)
     Returns:
         str: String id of trained NN
     """
+    if n_members and (checkpoint_every or checkpoint_secs or resume):
+        raise ValueError('Ensembles can not be checkpointed or resumed')
+    randseed = SeedData(checkpoint_every, checkpoint_secs, resume)
     # Loads data
     datadir, trainfile, testfile, pp_str = nnload.GetDataPath(cirrusflag, convcond)
-    x, y, cv, Pout, lat, lev, dlev, timestep = nnload.LoadData(trainfile, minlev, rainonly=rainonly,
-                                                               noshallow=noshallow, N_trn_exs=N_trn_exs)
-    # Prepare data
-    w = TrainingWeights(y, Pout, lev, weight_precip, weight_shallow)
-    x_pp, x, y_pp, y, pp_str = PreprocessData(x_ppi, x, y_ppi, y, pp_str, N_trn_exs)
+    if cachedir is None:
+        x, y, cv, Pout, lat, lev, dlev, timestep = nnload.LoadData(trainfile, minlev, rainonly=rainonly,
+                                                                   noshallow=noshallow, N_trn_exs=N_trn_exs,
+                                                                   randseed=randseed)
+        # Prepare data
+        w = TrainingWeights(y, Pout, lev, weight_precip, weight_shallow)
+        x_pp, x, y_pp, y, pp_str = PreprocessData(x_ppi, x, y_ppi, y, pp_str, N_trn_exs)
+    else:
+        x, y, cv, Pout, lat, lev, dlev, timestep, x_pp, y_pp = \
+            nnload.load_scaled_data(trainfile, minlev, x_ppi, y_ppi, rainonly=rainonly,
+                                    noshallow=noshallow, N_trn_exs=N_trn_exs, cachedir=cachedir,
+                                    randseed=randseed)
+        # Shallow convection weights are set from the unscaled humidity
+        y_unscl = nnload.inverse_transform_data(y_ppi, y_pp, y) if weight_shallow else y
+        w = TrainingWeights(y_unscl, Pout, lev, weight_precip, weight_shallow)
+        pp_str = PreprocessString(x_ppi, y_ppi, pp_str, N_trn_exs)
     regularize = CatchRegularization(weight_decay)
     # Either build a random forest or build a neural netowrk
     if doRF:
@@ -56,22 +91,32 @@ def TrainNNwrapper(num_layers, hidneur, x_ppi, y_ppi,
                                 learning_momentum=0.9, learning_rate=0.01,
                                 regularize=regularize,
                                 weight_decay=weight_decay,
-                                valid_size=0.2)
+                                valid_size=0.2,
+                                on_epoch_finish=on_epoch_finish,
+                                eval_every=eval_every,
+                                eval_subsample=eval_subsample,
+                                n_members=n_members,
+                                random_state=0 if randseed else None)
     r_str = UpdateMLPname(weight_precip, weight_shallow, r_str)
+    if not doRF and (checkpoint_every or checkpoint_secs or resume):
+        r_mlp.checkpoint = CheckpointPath(r_str)
+        r_mlp.checkpoint_every = checkpoint_every
+        r_mlp.checkpoint_secs = checkpoint_secs
     # Print details about the ML algorithm we are using
     print(r_str + ' Using ' + str(x.shape[0]) + ' training examples with ' +
           str(x.shape[1]) + ' input features and ' + str(y.shape[1]) +
           ' output targets')
     # Train the neural network
-    r_mlp, r_errors = TrainNN(r_mlp, r_str, x, y, w)
+    r_mlp, r_errors = TrainNN(r_mlp, r_str, x, y, w, resume=resume and not doRF)
     # Save the neural network to access it later
     SaveNN(r_mlp, r_str, r_errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev)
     # Plot figures with validation data (and with training data)
     nnplot.PlotAllFigs(r_str, testfile, noshallow=noshallow,
-                         rainonly=rainonly)
+                         rainonly=rainonly, cachedir=cachedir)
     if plot_training_results:
         nnplot.PlotAllFigs(r_str, trainfile, validation=False,
-                             noshallow=noshallow, rainonly=rainonly)
+                             noshallow=noshallow, rainonly=rainonly,
+                             cachedir=cachedir)
     return r_str
 
 
@@ -100,15 +145,20 @@ def PreprocessData(x_ppi, x, y_ppi, y, pp_str, N_trn_exs):
     """Transform data according to input preprocessor requirements and make
     make preprocessor string for saving"""
     x_pp = nnload.init_pp(x_ppi, x)
-    x = nnload.transform_data(x_ppi, x_pp, x)
+    # The unscaled data is not needed after this so transform in place
+    x = nnload.transform_data(x_ppi, x_pp, x, out=x)
     y_pp = nnload.init_pp(y_ppi, y)
-    y = nnload.transform_data(y_ppi, y_pp, y)
-    # Make preprocessor string for saving
+    y = nnload.transform_data(y_ppi, y_pp, y, out=y)
+    pp_str = PreprocessString(x_ppi, y_ppi, pp_str, N_trn_exs)
+    return x_pp, x, y_pp, y, pp_str
+
+def PreprocessString(x_ppi, y_ppi, pp_str, N_trn_exs):
+    """Make preprocessor string for saving"""
     pp_str = pp_str + 'X-' + x_ppi['name'] + '-' + x_ppi['method'][:6] + '_'
     pp_str = pp_str + 'Y-' + y_ppi['name'] + '-' + y_ppi['method'][:6] + '_'
     # Add number of training examples to string
     pp_str = pp_str + 'Ntrnex' + str(N_trn_exs) + '_'
-    return x_pp, x, y_pp, y, pp_str
+    return pp_str
 
 def CatchRegularization(weight_decay):
     """scikit-neuralnetwork seems to have a bug if regularization is set to zero"""
@@ -126,6 +176,18 @@ def UpdateMLPname(weight_precip, weight_shallow, r_str):
     r_str = r_str + '_v3'  # reflects that we are loading v3 of training data
     return r_str
 
+def SeedData(checkpoint_every, checkpoint_secs, resume):
+    """Whether the data is loaded with randseed. A resumed run has to draw the
+    same training examples and validation split as the run it continues, so
+    these are drawn from fixed seeds when checkpointing"""
+    return bool(checkpoint_every or checkpoint_secs or resume)
+
+def CheckpointPath(r_str):
+    """Path of the file that the training state of a NN is saved to"""
+    if not os.path.exists('./data/checkpoints/'):
+        os.makedirs('./data/checkpoints/')
+    return './data/checkpoints/' + r_str + '.ckpt'
+
 def SaveNN(r_mlp, r_str, r_errors, x_ppi, y_ppi, x_pp, y_pp, lat, lev, dlev):
     """Save neural network"""
     if not os.path.exists('./data/regressors/'):
@@ -139,18 +201,30 @@ def store_stats(i, avg_train_error, best_train_error, avg_valid_error,
     if i == 1:
         global errors_stored
         errors_stored = []
-    errors_stored.append((avg_train_error, best_train_error,
-                          avg_valid_error, best_valid_error,
-                          avg_train_obj_error, best_train_obj_error))
+    errors_stored.append(_errors_tuple((avg_train_error, best_train_error,
+                                        avg_valid_error, best_valid_error,
+                                        avg_train_obj_error,
+                                        best_train_obj_error)))
+
+
+def _errors_tuple(errors):
+    # Errors that were not evaluated this epoch (see eval_every) are None
+    return tuple(np.nan if e is None else e for e in errors)
 
 
 def BuildNN(method, num_layers, actv_fnc, hid_neur, learning_rule, pp_str,
              batch_size=100, n_iter=None, n_stable=None,
              learning_rate=0.01, learning_momentum=0.9,
              regularize='L2', weight_decay=0.0, valid_size=0.5,
-             f_stable=.001):
-    """Builds a multi-layer perceptron via the scikit neural network interface
+             f_stable=.001, on_epoch_finish=None, eval_every=1,
+             eval_subsample=None, n_members=None, random_state=None):
+    """Builds a multi-layer perceptron via the scikit neural network interface.
+    If n_members is given, builds an ensemble of that many regressors that are
+    trained together (see sknn_jgd.ensemble.EnsembleRegressor). random_state
+    seeds the initial weights and the validation split
     """
+    if on_epoch_finish is None:
+        on_epoch_finish = store_stats
     # First build layers
     actv_fnc = num_layers*[actv_fnc]
     hid_neur = num_layers*[hid_neur]
@@ -171,7 +245,11 @@ def BuildNN(method, num_layers, actv_fnc, hid_neur, learning_rule, pp_str,
                                      n_stable=n_stable,
                                      valid_size=valid_size,
                                      f_stable=f_stable,
-                                     callback={'on_epoch_finish': store_stats})
+                                     eval_every=eval_every,
+                                     eval_subsample=eval_subsample,
+                                     random_state=random_state,
+                                     callback={'on_epoch_finish':
+                                               on_epoch_finish})
     if method == 'classify':
         layers.append(sknn_jgd.mlp.Layer("Softmax"))
         mlp = sknn_jgd.mlp.Classifier(layers,
@@ -184,8 +262,11 @@ def BuildNN(method, num_layers, actv_fnc, hid_neur, learning_rule, pp_str,
                                       weight_decay=weight_decay,
                                       n_stable=n_stable,
                                       valid_size=valid_size,
+                                      eval_every=eval_every,
+                                      eval_subsample=eval_subsample,
+                                      random_state=random_state,
                                       callback={'on_epoch_finish':
-                                                store_stats})
+                                                on_epoch_finish})
     # Write nn string
     layerstr = '_'.join([str(h) + f[0] for h, f in zip(hid_neur, actv_fnc)])
     if learning_rule == 'momentum':
@@ -200,6 +281,9 @@ def BuildNN(method, num_layers, actv_fnc, hid_neur, learning_rule, pp_str,
         mlp_str = mlp_str + 'reg' + str(weight_decay)
     # Add the number of iterations too
     mlp_str = mlp_str + '_Niter' + str(n_iter)
+    if n_members:
+        mlp = sknn_jgd.ensemble.EnsembleRegressor(mlp, n_members=n_members)
+        mlp_str = mlp_str + '_ens' + str(n_members)
     return mlp, mlp_str
 
 
@@ -209,13 +293,22 @@ def BuildRandomForest(N_trees, mlp_str):
     return mlp, mlp_str
 
 
-def TrainNN(mlp, mlp_str, x, y, w=None):
+def TrainNN(mlp, mlp_str, x, y, w=None, resume=False):
     """Train each item in a list of multi-layer perceptrons and then score
-    on test data. Expects that mlp is a list of MLP objects"""
+    on test data. Expects that mlp is a list of MLP objects. If resume, the
+    training continues from the checkpoint of mlp (if it exists)"""
     # Initialize
     start = time.time()
     # Train the model using training data
-    mlp.fit(x, y, w)
+    if resume:
+        state = mlp.read_checkpoint()
+        if state is not None:
+            # store_stats continues the error history of the checkpoint
+            global errors_stored
+            errors_stored = [_errors_tuple(e) for e in state['history']]
+        mlp.fit(x, y, w, resume=True)
+    else:
+        mlp.fit(x, y, w)
     train_score = mlp.score(x, y)
     end = time.time()
     print("Training Score: {:.4f} for Model {:s} ({:.1f} seconds)".format(
@@ -0,0 +1,113 @@
+import unittest
+from nose.tools import (assert_equal, assert_true)
+
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+import src.nnload as nnload
+from sknn_jgd.mlp import Regressor, Layer
+
+
+class TestScaledDataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs('./data/regressors/')
+        rng = np.random.RandomState(0)
+        lat = np.array([-45., -15., 15., 45.])
+        shape = (30, len(lat), 50)
+        Tout, qout = rng.normal(size=shape), rng.normal(size=shape)
+        # Columns without convection have tendencies of exactly zero
+        Tout[:, :, ::2] = 0.
+        qout[:, :, ::2] = 0.
+        data = [rng.uniform(250., 300., shape), rng.uniform(0., .02, shape),
+                Tout, qout, rng.uniform(0., 1e-4, shape[1:]), lat]
+        self.file = './data/conv_testing_v3.pkl'
+        pickle.dump(data, open(self.file, 'wb'))
+        self.x_ppi = {'name': 'StandardScaler', 'method': 'qTindividually'}
+        self.y_ppi = {'name': 'SimpleY', 'method': 'qTindividually'}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_CachedMatchesUncached(self):
+        x, y, _, _, lat, lev, dlev, _ = nnload.LoadData(self.file, 0.)
+        x_pp = nnload.init_pp(self.x_ppi, x)
+        y_pp = nnload.init_pp(self.y_ppi, y)
+        mlp = Regressor(layers=[Layer('Linear')], n_iter=1)
+        mlp.fit(nnload.transform_data(self.x_ppi, x_pp, x),
+                nnload.transform_data(self.y_ppi, y_pp, y))
+        pickle.dump([mlp, 'r', None, self.x_ppi, self.y_ppi, x_pp, y_pp, lat,
+                     lev, dlev], open('./data/regressors/r.pkl', 'wb'))
+
+        np.random.seed(0)
+        uncached = nnload.get_x_y_pred_true('r', self.file, 0.)
+        for _ in range(2):
+            # Once to fill the cache and once to read from it
+            np.random.seed(0)
+            cached = nnload.get_x_y_pred_true('r', self.file, 0.,
+                                              cachedir='./data/cache/')
+            for a, b in zip(uncached, cached):
+                assert_true(np.array_equal(a, b))
+        assert_true((uncached[-1] == 0.).all(axis=1).any())
+
+    def test_NumpyScalarSettings(self):
+        for N_trn_exs in [np.int64(20), 20]:
+            nnload.load_scaled_data(self.file, np.float64(0.), self.x_ppi,
+                                    self.y_ppi, N_trn_exs=N_trn_exs,
+                                    cachedir='./data/cache/')
+        assert_equal(len(os.listdir('./data/cache/')), 1)
+
+
+class TestStreamStats(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs('./data/regressors/')
+        rng = np.random.RandomState(0)
+        lat = np.array([-45., -15., 15., 45.])
+        shape = (30, len(lat), 50)
+        self.file = './data/conv_testing_v3.mmap'
+        nnload.write_mmap_data(self.file, rng.uniform(250., 300., shape),
+                               rng.uniform(0., .02, shape),
+                               rng.normal(size=shape), rng.normal(size=shape),
+                               rng.uniform(0., 1e-4, shape[1:]), lat)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_ChunksMatchFullData(self):
+        x, y, _, _, lat, lev, dlev, _ = nnload.LoadData(self.file, 0.)
+        x_ppi = {'name': 'StandardScaler', 'method': 'qTindividually'}
+        y_ppi = {'name': 'SimpleY', 'method': 'qTindividually'}
+        x_pp = nnload.init_pp(x_ppi, x)
+        y_pp = nnload.init_pp(y_ppi, y)
+        mlp = Regressor(layers=[Layer('Linear')], n_iter=1)
+        mlp.fit(nnload.transform_data(x_ppi, x_pp, x),
+                nnload.transform_data(y_ppi, y_pp, y))
+        pickle.dump([mlp, 'r', None, x_ppi, y_ppi, x_pp, y_pp, lat, lev,
+                     dlev], open('./data/regressors/r.pkl', 'wb'))
+
+        hist_range = np.tile([-2., 2.], (y.shape[1], 1))
+        full = nnload.get_stream_stats('r', self.file, 0.,
+                                       chunk_size=x.shape[0],
+                                       hist_range=hist_range)
+        chunked = nnload.get_stream_stats('r', self.file, 0., chunk_size=7,
+                                          hist_range=hist_range)
+        ypred = nnload.inverse_transform_data(
+            y_ppi, y_pp, mlp.predict(nnload.transform_data(x_ppi, x_pp, x)))
+        assert_true(np.allclose(full[0]['rmse'],
+                                np.sqrt(np.mean((ypred - y) ** 2, axis=0))))
+        for a, b in zip(full, chunked):
+            assert_equal(sorted(a), sorted(b))
+            for key in a:
+                assert_true(np.allclose(a[key], b[key], equal_nan=True))
@@ -0,0 +1,62 @@
+import unittest
+from nose.tools import (assert_equal, assert_true, assert_false)
+from unittest import mock
+
+import functools
+import shutil
+import tempfile
+import numpy as np
+
+import src.nnload as nnload
+import src.nnsweep as nnsweep
+import src.nntrain as nntrain
+
+
+class TestSuccessiveHalving(unittest.TestCase):
+
+    def setUp(self):
+        self.rung_dir = tempfile.mkdtemp()
+        nntrain.errors_stored = []
+
+    def tearDown(self):
+        shutil.rmtree(self.rung_dir)
+
+    def decide(self, trial, error, eta=3):
+        callback = functools.partial(nnsweep.asha_on_epoch_finish,
+                                     rung_dir=self.rung_dir, trial=trial,
+                                     min_epochs=10, eta=eta)
+        return callback(i=10, avg_train_error=error, avg_valid_error=error,
+                        best_train_error=error, best_valid_error=error,
+                        avg_train_obj_error=None, best_train_obj_error=None)
+
+    def test_PromoteBestThird(self):
+        errors = np.random.RandomState(0).permutation(9) + 1.0
+        for t, e in enumerate(errors):
+            nnsweep.record_rung(self.rung_dir, 10, str(t), e)
+        promoted = [t for t, e in enumerate(errors) if self.decide(str(t), e)]
+        assert_equal(sorted(errors[promoted]), [1.0, 2.0, 3.0])
+
+    def test_PromoteAsynchronously(self):
+        # Trials arriving one at a time are judged on the ones seen so far
+        errors = np.random.RandomState(1).uniform(size=90)
+        promoted = sum(self.decide(str(t), e) for t, e in enumerate(errors))
+        assert_true(20 <= promoted <= 40)
+
+    def test_FirstTrialContinues(self):
+        assert_true(self.decide('a', 5.0))
+        assert_false(self.decide('b', 6.0, eta=2))
+
+
+class TestWarmCache(unittest.TestCase):
+
+    def test_SeedLikeTraining(self):
+        # Checkpointed configs load their data with randseed, as in
+        # TrainNNwrapper, so they have to warm their own cache entry
+        base = {'minlev': 0.2, 'x_ppi': {'name': 'SimpleY'},
+                'y_ppi': {'name': 'SimpleY'}, 'cachedir': '/tmp/cache/'}
+        configs = nnsweep.sweep_configs({'checkpoint_every': [None, 10, 20]},
+                                        base)
+        with mock.patch.object(nnload, 'load_scaled_data') as load:
+            nnsweep._warm_cache(configs)
+        seeds = [kwargs['randseed'] for _, kwargs in load.call_args_list]
+        assert_equal(sorted(seeds), [False, True])
@@ -0,0 +1,62 @@
+import unittest
+from nose.tools import (assert_equal, assert_true)
+from unittest import mock
+
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+import src.nntrain as nntrain
+from sknn_jgd.predict import Predictor
+
+
+def stop_after_2(i, **variables):
+    # Interrupts training, at module level so the network can be pickled
+    nntrain.store_stats(i=i, **variables)
+    return i < 2
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs('./data/')
+        rng = np.random.RandomState(0)
+        lat = np.array([-45., -15., 15., 45.])
+        shape = (30, len(lat), 100)
+        data = [rng.uniform(250., 300., shape), rng.uniform(0., .02, shape),
+                rng.normal(size=shape), rng.normal(size=shape),
+                rng.uniform(0., 1e-4, shape[1:]), lat]
+        for split in ['training', 'testing']:
+            pickle.dump(data, open('./data/conv_' + split + '_v3.pkl', 'wb'))
+        self.x_ppi = {'name': 'StandardScaler', 'method': 'qTindividually'}
+        self.y_ppi = {'name': 'SimpleY', 'method': 'qTindividually'}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def train(self, **kwargs):
+        # Draws from the global random state must not change the data drawn
+        np.random.seed(len(kwargs))
+        with mock.patch('src.nnplot.PlotAllFigs'):
+            r_str = nntrain.TrainNNwrapper(1, 8, self.x_ppi, self.y_ppi,
+                                           n_iter=4, N_trn_exs=200,
+                                           checkpoint_every=1, **kwargs)
+        mlp = pickle.load(open('./data/regressors/' + r_str + '.pkl',
+                               'rb'))[0]
+        return Predictor.from_mlp(mlp).weights
+
+    def test_ResumeMatchesUninterrupted(self):
+        expected = self.train()
+        self.train(on_epoch_finish=stop_after_2)
+        resumed = self.train(resume=True)
+
+        assert_equal(len(expected), len(resumed))
+        for e, p in zip(expected, resumed):
+            assert_true(np.allclose(e[0], p[0]))
+            assert_true(np.allclose(e[1], p[1]))